@@ -5,16 +5,15 @@ import pandas as pd
 import numpy as np
 
 from PyQt5.QtWidgets import QTableWidgetItem
-from PyQt5 import QtWidgets
-from PyQt5.QtCore import QTimer, QSettings
+from PyQt5 import QtWidgets, QtGui
+from PyQt5.QtCore import QTimer, QSettings, pyqtSignal, QPointF
 from acquisitionWindow import  Ui_MainWindow
 
-from logger import XStream
+from logger import connectLogWidget
 import json
 import pickle
 
 from ntplib import NTPClient
-from epics import PV
 
 import struct
 from bitstring import BitArray
@@ -31,76 +30,129 @@ import scTDC
 
 from prodigy_remote import ProdigyRemote
 from write_ports import PhaseShifter
-
-#%% TDC user callbacks
-class callback(scTDC.usercallbacks_pipe):
-    def __init__(self, lib, dev_desc):
-        super().__init__(lib, dev_desc) # <-- mandatory
+from scan_engine import (PhaseShifterScanEngine, KineticEnergyScanEngine,
+                         VendorFileSink, SingleFileSink,
+                         MAX_DELAY_PS, PS_PER_CODE)
+import scan_writer
+import scan_timing
+from scan_plan import ScanPlan, ORDERS
+from preview import NativePreview
+from live_histogram import LiveHistogramPipe
+from adaptive_dwell import AdaptiveDwell, StepCounter
+from charge_alignment import ClockOffset, MeasurementLog
+from metadata_sampler import MetadataSampler
+
+LOG_MAX_LINES = 5000 # lines kept in the log widget
+METADATA_PVS = ('MOCounter:FREQUENCY',)
+PREVIEW_WINDOW_S = 10.0 # seconds shown by the rolling preview window
+
+#%% TDC rate meter
+class RateMeter(scTDC.buffered_data_callbacks_pipe):
+    """ Count rate meter on the BUFFERED_DATA_CALLBACKS pipe. The counts per
+    millisecond are taken from the ms_indices array of each buffer with one
+    np.diff, instead of calling into python for every millisecond and every
+    event batch like the USER_CALLBACKS pipe does. """
+    def __init__(self, lib, dev_desc, max_buffered_data_len=(1<<16)):
+        # the library needs at least one data field; TIME is the cheapest
+        super().__init__(lib, dev_desc,
+                         data_field_selection=scTDC.SC_DATA_FIELD_TIME,
+                         max_buffered_data_len=max_buffered_data_len) # <-- mandatory
         self.reset_counters()
-    
-    def on_millisecond(self):
-        self.msecs += 1
-        
-        if self.msecs and (not (self.msecs % 1000)):
-            print("Count rate: %7i per sec" % ((self.counts - self.co) / (self.msecs- self.mo) *1000 ), 
-                  " after %5i secs." %(self.msecs/1000)
-                  )
-           
-            self.mo  = self.msecs
-            self.co = self.counts
 
-    def on_start_of_meas(self):
-        self.reset_counters()
-       
+    def on_data(self, data):
+        if 'som_indices' in data and len(data['som_indices']):
+            self.reset_counters()
+            self.som_index = int(data['som_indices'][-1])
+            self.last_ms_index = self.som_index
+        self.counts = data['event_index'] + data['data_len'] - self.som_index
+
+        if 'ms_indices' in data and len(data['ms_indices']):
+            ms = data['ms_indices']
+            self.per_ms = np.diff(ms.astype(np.int64),
+                                  prepend=self.last_ms_index)
+            self.last_ms_index = int(ms[-1])
+            msecs_old = self.msecs
+            self.msecs += len(ms)
+
+            if self.msecs // 1000 > msecs_old // 1000:
+                counts_at_ms = self.last_ms_index - self.som_index
+                self.rate = ((counts_at_ms - self.co)
+                             / (self.msecs - self.mo) * 1000)
+                print("Count rate: %7i per sec" % self.rate,
+                      " after %5i secs." %(self.msecs/1000)
+                      )
+                self.mo = self.msecs
+                self.co = counts_at_ms
 
     def on_end_of_meas(self):
-        pass
-
-    def on_tdc_event(self, tdc_events, nr_tdc_events):
-        self.counts += nr_tdc_events
-
+        return True # flush, so that the last milliseconds are counted
 
-    def on_dld_event(self, dld_events, nr_dld_events):
-        self.counts += nr_dld_events
-    
     def reset_counters(self):
         self.counts = 0
         self.msecs = 0
-        
+        self.rate = 0
+        self.per_ms = np.zeros(0, dtype=np.int64)
+
+        self.som_index = 0
+        self.last_ms_index = 0
         self.co = 0
         self.mo = 0
-        
+
 
 #%% Main Window
 class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
+
+    # emitted from the TDC library thread, delivered in the GUI thread
+    staticMeasurementFinished = pyqtSignal(int)
+    scanStepFinished = pyqtSignal(int, int, float)
+    energyStepFinished = pyqtSignal(int, float, float)
+    scanFinished = pyqtSignal(bool)
     
-    def __init__(self, debug=True):
+    def __init__(self, debug=True, tdc_lib=None, ul_backend=None,
+                 pv_factory=None, tdc_libh5=None):
         super(AcquisitionUI, self).__init__()
 
         self.setupUi(self)
         self.settings = QSettings('AqcuisitionUI','GUI_Settings')
         self.DEBUG = debug
+        self.tdc_lib = tdc_lib # e.g. scTDC_sim.scTDClib_sim() for offline use
+        self.tdc_libh5 = tdc_libh5 # e.g. scTDC_sim.scTDC_hdf5lib_sim()
+        self.ul_backend = ul_backend # e.g. mcculw_sim.SimulatedUL()
+        self.pv_factory = pv_factory # e.g. epics_sim.PV
         self.DAQdirectory = os.getcwd()
         
         
 
         ### Logging
         if not self.DEBUG:
-            XStream.stdout().messageWritten.connect( self.logBrowser.insertPlainText )
-            XStream.stderr().messageWritten.connect( self.logBrowser.insertPlainText )
+            # batched and capped, so that prints during long scans stay cheap
+            connectLogWidget( self.logBrowser, max_lines=LOG_MAX_LINES )
 
         ### Meta Params
-        self.freq = PV('MOCounter:FREQUENCY')
+        # machine PVs, monitored in the background and sampled once per step
+        self.metadata = MetadataSampler(METADATA_PVS, self.pv_factory)
         self.ntp = NTPClient()
+        # measurement windows on the NTP time scale of the EPICS timestamps,
+        # for charge_alignment.py
+        self.clock = ClockOffset(self.ntp)
+        self.clock.refresh_async()
+        self.measurementLog = MeasurementLog(
+            os.path.join(self.DAQdirectory, 'DAQ_measurements.csv'))
 
         ### Timer
         self.cps_timer = QTimer()
-        # self.cps_timer.timeout.connect(self.update_counts)
+        self.cps_timer.timeout.connect(self.update_counts)
         self.tStart = time.time()
         self.msecs_cur = 0
         self.msecs_old = 0
         self.dldev_cur = 0
         self.dldev_old = 0
+        # live TOF preview, 10 Hz, rolling window of PREVIEW_WINDOW_S
+        self.preview_timer = QTimer()
+        self.preview_timer.timeout.connect(self.updatePreview)
+        self.previewScene = QtWidgets.QGraphicsScene()
+        self.plotCountsLog.setScene(self.previewScene)
+        self.preview_generation = -1
 
         #%% Open and Save Files
         self.picklepath_dir = os.path.join(self.DAQdirectory, 'DAQ_pickle_dir')
@@ -139,8 +191,13 @@ class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
         #                 autoinit=False) #TDC(debug=self.DEBUG)
                         
 
-        self.ps = PhaseShifter()
-        self.remote = ProdigyRemote(debug=self.DEBUG)
+        # MCC board layout, reused on later connects instead of probing
+        self.picklepath_mcc = os.path.join(self.DAQdirectory, 'DAQ_pickle_mcc')
+        self.ps = PhaseShifter(cache_path=self.picklepath_mcc,
+                               ul_backend=self.ul_backend)
+        # analyzer parameter info and last values survive restarts
+        self.remote = ProdigyRemote(debug=self.DEBUG,
+            cache_path=os.path.join(self.DAQdirectory, 'DAQ_pickle_prodigy'))
 
         #%% TDC Section
         
@@ -240,7 +297,39 @@ class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
 
         ### Acquire Static Spectrum
         self.pushStaticAcquire.clicked.connect( self.acquireStatic ) 
+        self.staticMeasurementFinished.connect( self.finishStatic )
         self.pushScanAbort.setEnabled( False )
+        self.pushScanAbort.clicked.connect( self.abortPhaseShifterScan )
+        self.scanStepFinished.connect( self.onScanStep )
+        self.energyStepFinished.connect( self.onEnergyStep )
+        # no button in the .ui file for energy scans (yet)
+        self.actionScanKinEng = self.menubar.addAction('Kinetic energy scan...')
+        self.actionScanKinEng.triggered.connect( self.scanKinEng )
+        # order of the delay steps (see scan_plan.ORDERS)
+        self.scanOrder = 'table'
+        self.scanPlanCache = None
+        menuOrder = self.menubar.addMenu('Scan order')
+        self.scanOrderGroup = QtWidgets.QActionGroup(self)
+        for order in ORDERS:
+            action = menuOrder.addAction(order.capitalize())
+            action.setCheckable(True)
+            action.setChecked(order == self.scanOrder)
+            action.triggered.connect(
+                lambda checked, order=order: self.setScanOrder(order))
+            self.scanOrderGroup.addAction(action)
+        # count-based exposure per step instead of the fixed time per step
+        self.actionAdaptiveDwell = self.menubar.addAction('Adaptive dwell...')
+        self.actionAdaptiveDwell.triggered.connect( self.setAdaptiveDwell )
+        self.dwellSettings = None # (target counts, rel. error, min s, max s)
+        self.stepCounter = None
+        self.scanFinished.connect( self.onScanFinished )
+        self.scanEngine = None
+        self.staticFuture = None # of the running static measurement
+        self.events = None # ringbuffer_pipe of the single-file scans, initTDC
+        self.preview = None # NativePreview or LiveHistogramPipe, initTDC
+        # write all steps of a scan into one file (needs h5py), instead of
+        # one file per step through the scTDC_hdf5 streamer
+        self.scanSingleFile = scan_writer.h5py is not None
 
 
         self.cps_timer.start(1000)
@@ -257,9 +346,23 @@ class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
             pickle.dump(self.voltDict, f_volt)
         
         
+        # the scan thread uses the device, the pipes and the metadata, so it
+        # has to end before any of them is closed
+        if self.scanEngine is not None and self.scanEngine.is_running():
+            self.scanEngine.abort()
+            self.scanEngine.join()
+        
         if self.remote.connected:
             self.remote.disconnect()
         
+        self.preview_timer.stop()
+        self.metadata.close()
+        if self.tdc.is_initialized():
+            for pipe in (self.preview, self.events, self.stepCounter):
+                if pipe is not None:
+                    pipe.close()
+            self.preview = self.events = self.stepCounter = None
+        
         self.deinitTDC()
         
 #       if self.tdc.is_initialized:
@@ -281,14 +384,20 @@ class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
         file_exists = os.path.exists(self.path)
         # pathsplit = os.path.split(self.path)
         # print(pathsplit[0] + '\\PS_Scan_' + pathsplit[1][:-3])
-        folder_exists = os.path.exists(self.dataFolder + '\\' + 'PS_Scan_' + self.dataFileName + '-run%03i' % (self.runningNoSpinBox.value()))
+        scanpath = self.dataFolder + '\\' + 'PS_Scan_' + self.dataFileName + '-run%03i' % (self.runningNoSpinBox.value())
+        kepath = self.dataFolder + '\\' + 'KE_Scan_' + self.dataFileName + '-run%03i' % (self.runningNoSpinBox.value())
+        folder_exists = (os.path.exists(scanpath) or os.path.exists(scanpath + '.h5')
+                         or os.path.exists(kepath) or os.path.exists(kepath + '.h5'))
         print(self.dataFolder + '\\' + 'PS_Scan_' + self.dataFileName + '-run%03i' % (self.runningNoSpinBox.value()))
         while file_exists or folder_exists:
             self.runningValue += 1
             self.runningNoSpinBox.setValue(self.runningValue)
             self.createFileName()
             file_exists = os.path.exists(self.path)
-            folder_exists = os.path.exists(self.dataFolder + '\\' + 'PS_Scan_' + self.dataFileName + '-run%03i' % (self.runningNoSpinBox.value()))
+            scanpath = self.dataFolder + '\\' + 'PS_Scan_' + self.dataFileName + '-run%03i' % (self.runningNoSpinBox.value())
+            kepath = self.dataFolder + '\\' + 'KE_Scan_' + self.dataFileName + '-run%03i' % (self.runningNoSpinBox.value())
+            folder_exists = (os.path.exists(scanpath) or os.path.exists(scanpath + '.h5')
+                             or os.path.exists(kepath) or os.path.exists(kepath + '.h5'))
 
     def selectDirectory(self):
         self.dataFolder = QtWidgets.QFileDialog.getExistingDirectory(self, 'Open File', 'C:\\Data\\',
@@ -306,32 +415,49 @@ class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
     ### Count Timer
 
     def update_counts(self):
-        if self.tdc.is_initialized():
+        if hasattr(self, 'cb') and self.tdc.is_initialized():
             self.msecs_old = self.msecs_cur
             self.dldev_old = self.dldev_cur
             
 
 #            self.msecs_cur, self.dldev_cur = self.tdc.get_time_and_counts()
             
-            if (self.cb.msecs):
-                self.cps = (self.cb.counts//self.cb.msecs * 1000)
-            else:
-                self.cps = 0
+            self.cps = int(self.cb.rate)
 #            if self.DEBUG:
 #                print("Count rate: ", self.cb.msecs, " Seconds elapsed: ", time.time() - self.tStart  )
 
             self.lcdCPS.display(self.cps)
 
 #            if self.msecs_cur:
-            self.progressScan.setValue( (time.time() - self.tStart) / (self.acquisitionTimeSecsSpinBox.value() ) * 100 )  ###an integer is required somewhere
+            self.progressScan.setValue( min(100, int((time.time() - self.tStart) / (self.acquisitionTimeSecsSpinBox.value() ) * 100 )) )
 
 
+    def updatePreview(self):
+        """ Draws the TOF histogram of the preview pipes (log scale) """
+        t_hist, _, events, generation = self.preview.poll()
+        if events == 0 and generation == self.preview_generation:
+            return
+        self.preview_generation = generation
+        w = self.plotCountsLog.viewport().width()
+        h = self.plotCountsLog.viewport().height()
+        # sum neighbouring bins down to about one bin per pixel
+        step = max(1, len(t_hist) // max(w, 1))
+        y = np.log10(1.0 + np.add.reduceat(t_hist,
+                                           np.arange(0, len(t_hist), step)))
+        y = y / max(y.max(), 1.0) * (h - 4)
+        line = QtGui.QPainterPath()
+        line.addPolygon(QtGui.QPolygonF([QPointF(i * w / len(y), h - 2 - v)
+                                         for i, v in enumerate(y)]))
+        self.previewScene.clear()
+        self.previewScene.setSceneRect(0, 0, w, h)
+        self.previewScene.addPath(line)
+
     #%% TDC Methods
 
     def initTDC(self):
            
         self.tdc = scTDC.Device(inifilepath=self.ini_file,
-                autoinit=False) #TDC(debug=self.DEBUG)
+                autoinit=False, lib=self.tdc_lib, libh5=self.tdc_libh5) #TDC(debug=self.DEBUG)
         
         retcode, errmsg = self.tdc.initialize()
         if retcode < 0:
@@ -350,10 +476,33 @@ class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
         a = scTDC.HDF5DataSelection # short alias
         self.datasel = scTDC.HDF5DataSelection(a.X | a.TIME)
         
-        self.cb = callback(self.tdc.lib, self.tdc.dev_desc)
+        self.cb = RateMeter(self.tdc.lib, self.tdc.dev_desc)
+        
+        # event data for the python-side writers, same fields as self.datasel
+        retcode, self.events = self.tdc.add_ringbuffer_pipe(
+            scTDC.SC_DATA_FIELD_DIF1 | scTDC.SC_DATA_FIELD_TIME)
+        if retcode < 0:
+            print("Error while opening the event pipe : ({}) {}".format(
+                self.events, retcode))
+            self.events = None
+            return
+        
+        # binned by the library, read without copying by the preview timer
+        try:
+            self.preview = NativePreview(self.tdc,
+                                         window_s=PREVIEW_WINDOW_S)
+        except RuntimeError as e:
+            # binned in python instead, cleared at every start of measurement
+            print(e, '- using the python-side preview')
+            self.preview = LiveHistogramPipe(self.tdc.lib, self.tdc.dev_desc)
+            if self.preview._pipe_desc < 0:
+                print('Could not open the preview pipe')
+                return
+        self.preview_timer.start(100)
         
 
     def deinitTDC(self):
+        self.preview_timer.stop()
         if self.tdc.is_initialized():
             self.tdc.hdf5_disable()
             self.tdc.deinitialize()
@@ -372,8 +521,7 @@ class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
     
     def connectProdigy(self):
         if not self.remote.connected:
-            self.remote.connect()
-            self.remote.allParams = self.remote.getParams()
+            self.remote.connect() # also reads the parameter names and values
             self.statusbar.showMessage("Prodigy connected.")
 
     def disconnectProdigy(self):
@@ -386,9 +534,11 @@ class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
 
         if self.remote.connected:
             self.statusbar.showMessage('Ramping Voltages...')
-            self.remote.setVoltagesDirectly(self.voltDict['"Kinetic Energy"'],
-                                            self.voltDict['"Pass Energy"']   )    
-            self.statusbar.showMessage('Alrighty.')
+            sent = self.remote.setVoltagesDirectly(
+                self.voltDict['"Kinetic Energy"'],
+                self.voltDict['"Pass Energy"']   )    
+            self.statusbar.showMessage('Alrighty. %i parameters changed.'
+                                       % len(sent))
 
     def setSafeState(self):
         if self.remote.connected:
@@ -440,6 +590,9 @@ class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
     #%% TDC Methods
 
     def acquireStatic(self):
+        if self.staticFuture is not None and not self.staticFuture.done():
+            print('A measurement is already running')
+            return
         if self.tdc.is_initialized:
             self.statusbar.showMessage('Starting a Measurement')
             self.checkExistingPath()
@@ -461,30 +614,157 @@ class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
             return
         
         print("Starting a measurement")
-        retcode, errmsg = self.tdc.do_measurement(time_ms=acquTime * 1000, synchronous = True)
-        # self.cb.do_measurement(time_ms=acquTime * 1000, )
-        
-        if retcode < 0:
+        self.pushStaticAcquire.setEnabled(False) # until finishStatic
+        if self.clock.stale(): # a network query only every few minutes
+            self.clock.refresh_async()
+        self.tStaticStart = self.clock.time()
+        # don't block the event loop for the exposure, finishStatic is
+        # invoked via a queued signal when the library reports the end
+        self.staticFuture = self.tdc.measure_future(time_ms=int(acquTime * 1000))
+        self.staticFuture.add_done_callback(
+            lambda f: self.staticMeasurementFinished.emit(f.result()))
+
+    def finishStatic(self, reason):
+        if reason < 0:
             print("Error while starting measurement : ({}) {}".format(
-                errmsg, retcode))
+                self.tdc.lib.sc_get_err_msg(reason), reason))
         # print("Finished measurements")
         
         print("Closing the HDF5 file") # this is very important: the HDF5 will be
         # incomplete and most likely not even readable at all if it is not closed
+        tStaticStop = self.clock.time()
         success, errmsg = self.tdc.hdf5_close()
         if not success:
             print("Error while closing the HDF5 file")
-
-#            self.tdc.measure( acquTime * 1000 )
         else:
             print(" ---------- Measurement finished ----------" + self.dataFileName + '-run%03i.h5' % (self.runningNoSpinBox.value()))
+        self.pushStaticAcquire.setEnabled(True)
+        try:
+            self.measurementLog.add(self.path, self.tStaticStart, tStaticStop)
+        except OSError as e:
+            print('Could not log the measurement window:', e)
         self.statusbar.showMessage(' ---------- Measurement finished ----------' + self.dataFileName + '-run%03i.h5' % (self.runningNoSpinBox.value()))
 
     def abortStatic(self):
         pass
 
     def scanKinEng(self):
-        pass
+        """ Kinetic-energy scan at the pass energy of the GUI. Each step sets
+        only the kinetic energy, waits for Prodigy to finish the ramp and
+        acquires with the TDC; all steps go into one indexed file. """
+        if not self.remote.connected:
+            print('Connect to Prodigy first')
+            return
+        if self.scanEngine is not None and self.scanEngine.is_running():
+            print('A scan is already running')
+            return
+        if self.tdc.is_initialized:
+            text, ok = QtWidgets.QInputDialog.getText(
+                self, 'Kinetic energy scan', 'start, stop, step [eV]:',
+                text='%i, %i, 1' % (self.kineticEnergySpinBox.value(),
+                                    self.kineticEnergySpinBox.value() + 10))
+            if not ok:
+                return
+            try:
+                start, stop, step = [float(v) for v in text.split(',')]
+            except ValueError:
+                print('Expected three numbers: start, stop, step')
+                return
+            energies = np.arange(start, stop + step / 2, step)
+            if len(energies) == 0:
+                return
+            
+            self.statusbar.showMessage('Starting a Measurement')
+            self.checkExistingPath()
+            self.gatherVoltages()
+            self.remote.analyzr_volts.update(self.voltDict)
+            self.tStart = time.time()
+            daqtime = self.acquisitionTimePerStepSecsSpinBox.value()
+            
+            runname = self.dataFileName + '-run%03i' % (self.runningNoSpinBox.value())
+            scanpath = self.dataFolder + '\\' + 'KE_Scan_' + runname
+            if self.scanSingleFile and self.events is not None:
+                writer = scan_writer.ScanFileWriter(
+                    scanpath + '.h5',
+                    [('dif1', np.uint32), ('time', np.uint64)],
+                    comment="kinetic energy scan " + runname,
+                    step_dtype=scan_writer.make_step_dtype('kinetic_energy',
+                                                           np.float64))
+                sink = SingleFileSink(writer, self.events.events.add_cursor())
+            else:
+                os.mkdir(scanpath)
+                def path_for_step(index, energy):
+                    return os.path.join(scanpath,
+                                        runname + '_ke%08.2f.h5' % energy)
+                sink = VendorFileSink(self.tdc, self.datasel, path_for_step,
+                                      comment="kinetic energy scan")
+            
+            self.scanEnergies = energies
+            self.scanName = 'KE_Scan_' + runname
+            self.scanTimingPath = scanpath + '_timing.csv'
+            self.progressScan.setMaximum(len(energies))
+            self.progressScan.setValue(0)
+            self.pushScanAcquire.setEnabled(False)
+            self.pushScanAbort.setEnabled(True)
+            
+            self.scanEngine = KineticEnergyScanEngine(
+                self.tdc, self.remote,
+                pass_energy=self.voltDict['"Pass Energy"'],
+                on_step=self.energyStepFinished.emit,
+                on_finished=self.scanFinished.emit,
+                dwell=self.createDwell())
+            self.scanEngine.clock = self.clock # refreshed in the scan thread
+            self.scanEngine.metadata = self.metadata
+            self.scanEngine.start(energies, int(daqtime * 1000), sink)
+    
+    def onEnergyStep(self, index, energy, overhead):
+        self.progressScan.setValue(index + 1)
+        self.statusbar.showMessage('Kinetic energy %.2f eV, step %i of %i (overhead %.0f ms, duty cycle %.0f %%)'
+                                   % (energy, index + 1, len(self.scanEnergies), overhead * 1e3,
+                                      self.scanEngine.timer.duty_cycle() * 100))
+
+    def setAdaptiveDwell(self):
+        """ Asks for the adaptive dwell settings; 0 for both the target
+        counts and the relative error switches back to fixed exposures. """
+        target, rel_error, min_s, max_s = self.dwellSettings or (
+            0, 0.01, 1, 4 * self.acquisitionTimePerStepSecsSpinBox.value())
+        text, ok = QtWidgets.QInputDialog.getText(
+            self, 'Adaptive dwell',
+            'target counts, relative error, min s, max s (0, 0: fixed time):',
+            text='%i, %g, %g, %g' % (target, rel_error, min_s, max_s))
+        if not ok:
+            return
+        try:
+            target, rel_error, min_s, max_s = [float(v) for v in text.split(',')]
+        except ValueError:
+            print('Expected four numbers: target counts, relative error, min s, max s')
+            return
+        if target <= 0 and rel_error <= 0:
+            self.dwellSettings = None
+        elif not 0 <= min_s <= max_s:
+            print('Need 0 <= min s <= max s')
+            return
+        else:
+            self.dwellSettings = (int(target), rel_error, min_s, max_s)
+        self.actionAdaptiveDwell.setText('Adaptive dwell...'
+                                         + (' (on)' if self.dwellSettings else ''))
+        self.tableClick()
+
+    def createDwell(self):
+        """ The AdaptiveDwell of the next scan, or None for fixed exposures """
+        if self.dwellSettings is None:
+            return None
+        target, rel_error, min_s, max_s = self.dwellSettings
+        if self.stepCounter is None:
+            try:
+                self.stepCounter = StepCounter(self.tdc)
+            except RuntimeError as e:
+                print(e, '- using the fixed time per step')
+                return None
+        return AdaptiveDwell(self.stepCounter,
+                             target_counts=target if target > 0 else None,
+                             rel_error=rel_error if rel_error > 0 else None,
+                             min_s=min_s, max_s=max_s)
 
     def inifile_radio(self):
         if self.radioButton_ExtStart_ini.isChecked():
@@ -497,7 +777,8 @@ class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
 
     #%% Phase Shifter Methods
     def initPhaseShifter(self):
-        self.ps = PhaseShifter(0)
+        self.ps = PhaseShifter(0, cache_path=self.picklepath_mcc,
+                               ul_backend=self.ul_backend)
         ### Would be good to test if connected before attempting connection
         #sometimes a second connect command is enough, this is a hack but idk
         #why it doesn't play nice sometimes
@@ -546,29 +827,49 @@ class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
         else:
             self.tableOfDelayRanges.removeRow(totrows-1)
     
+    def readDelayTable(self):
+        """ Returns the (start, stop, step) rows of the table of delay ranges,
+        without incomplete rows """
+        rows = []
+        for row in range(self.tableOfDelayRanges.rowCount()):
+            try:
+                rows.append(tuple(int(self.tableOfDelayRanges.item(row, col).text())
+                                  for col in range(3)))
+            except (AttributeError, ValueError): # empty or not a number
+                pass
+        return rows
+
+    def compileScanPlan(self):
+        """ The ScanPlan of the table; recompiled only if the table or the
+        order changed. Random orders are seeded with the run number. """
+        key = (tuple(self.readDelayTable()), self.scanOrder,
+               self.runningNoSpinBox.value())
+        if self.scanPlanCache is None or self.scanPlanCache[0] != key:
+            plan = ScanPlan(key[0], order=self.scanOrder,
+                            limits=(0, MAX_DELAY_PS), resolution=PS_PER_CODE,
+                            seed=key[2])
+            self.scanPlanCache = (key, plan)
+        return self.scanPlanCache[1]
+
+    def setScanOrder(self, order):
+        self.scanOrder = order
+        self.tableClick()
+
     def stepthroughPhaseShifter(self):
-        nrows = self.tableOfDelayRanges.rowCount()
         daqtime = self.acquisitionTimePerStepSecsSpinBox.value()
     
-        for row in range(nrows):
-            startps = int(self.tableOfDelayRanges.item(row,0).text())
-            endps = int(self.tableOfDelayRanges.item(row,1).text())
-            stepsize = int(self.tableOfDelayRanges.item(row,2).text())
-        
-            nsteps = (endps - startps)//stepsize
-        
-            if row == nrows-1:
-                nsteps = nsteps + 1
-        
-            for step in range(nsteps):
-                self.delayPsecSpinBox.setValue(startps + stepsize*step)
-                self.setPhaseShifter()
-                
-                time.sleep(daqtime)
+        for delay in self.compileScanPlan():
+            self.delayPsecSpinBox.setValue(delay)
+            self.setPhaseShifter()
+            
+            time.sleep(daqtime)
         
     def AcquirePhaseShifterScan(self):
         
         if self.tdc.is_initialized:
+            if self.scanEngine is not None and self.scanEngine.is_running():
+                print('A scan is already running')
+                return
             self.statusbar.showMessage('Starting a Measurement')
             self.checkExistingPath()
             self.tStart = time.time()
@@ -576,58 +877,89 @@ class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
             self.msecs_old, self.dldev_old = 0, 0
             
             subfolderpath = self.dataFolder + '\\' + 'PS_Scan_' + self.dataFileName + '-run%03i' % (self.runningNoSpinBox.value())
-            os.mkdir(subfolderpath)
             
             
-            nrows = self.tableOfDelayRanges.rowCount()
             daqtime = self.acquisitionTimePerStepSecsSpinBox.value()
-        
-            for row in range(nrows):
-                startps = int(self.tableOfDelayRanges.item(row,0).text())
-                endps = int(self.tableOfDelayRanges.item(row,1).text())
-                stepsize = int(self.tableOfDelayRanges.item(row,2).text())
+            plan = self.compileScanPlan()
+            delays = list(plan)
+            if plan.duplicates:
+                print('%i delays planned more than once, measuring them once' % plan.duplicates)
             
-                nsteps = (endps - startps)//stepsize
+            runname = self.dataFileName + '-run%03i' % (self.runningNoSpinBox.value())
+            if self.scanSingleFile and self.events is not None:
+                # one file next to the static runs, steps indexed in /steps
+                writer = scan_writer.ScanFileWriter(
+                    subfolderpath + '.h5',
+                    [('dif1', np.uint32), ('time', np.uint64)],
+                    comment="phase shifter scan " + runname)
+                sink = SingleFileSink(writer, self.events.events.add_cursor())
+            else:
+                os.mkdir(subfolderpath)
+                def path_for_step(index, delay):
+                    ps_filename = runname + '_ps%03i.h5' % (delay)
+                    return os.path.join(self.dataFolder, subfolderpath, ps_filename)
+                sink = VendorFileSink(self.tdc, self.datasel, path_for_step,
+                                      comment="output of example_hdf5.py")
             
-                if row == nrows-1:
-                    nsteps = nsteps + 1
+            self.scanDelays = delays
+            self.scanName = 'PS_Scan_' + runname
+            self.scanTimingPath = subfolderpath + '_timing.csv'
+            self.progressScan.setMaximum(max(len(delays), 1))
+            self.progressScan.setValue(0)
+            self.pushScanAcquire.setEnabled(False)
+            self.pushScanAbort.setEnabled(True)
             
-                for step in range(nsteps):
-                    self.delayPsecSpinBox.setValue(startps + stepsize*step)
-                    self.setPhaseShifter()
-                    
-                    
-                    ps_filename = self.dataFileName + '-run%03i' % (self.runningNoSpinBox.value()) + '_ps%03i.h5' % (self.delayPsecSpinBox.value())
-                    print(self.dataFolder)
-                    print(subfolderpath)
-                    print(ps_filename)
-                    ps_newpath = os.path.join(self.dataFolder, subfolderpath, ps_filename)
-                    
-                    self.statusbar.showMessage('Setting Phaseshifter to ' + str(startps + stepsize*step))
-                    
-                    success, errmsg = self.tdc.hdf5_open(
-                        ps_newpath, "output of example_hdf5.py", self.datasel)
-                    if not success:
-                        print("Error while opening HDF5 file : " + errmsg)
-                        return
-                    
-                    print('Starting a Measurement')
-                    # retcode, errmsg = self.tdc.do_measurement(time_ms=acquTime * 1000, synchronous = True)
-                    self.cb.do_measurement(time_ms=daqtime * 1000, )
-                    print('Finished Measurement')
-                    
-                    print('closing the HDF5 file')
-                    success, errmsg = self.tdc.hdf5_close()
-                    if not success:
-                        print("Error while closing the HDF5 file")
-
-                    else:
-                        print(" ---------- Measurement finished ----------" + self.dataFileName + '-run%03i.h5' % (self.runningNoSpinBox.value()))
-                    
-                    time.sleep(1)
-                    # self.progressScan.setBar((startps+stepsize*step)/5000)
+            # runs in a worker thread, results come back via queued signals
+            self.scanEngine = PhaseShifterScanEngine(
+                self.tdc, self.ps,
+                on_step=self.scanStepFinished.emit,
+                on_finished=self.scanFinished.emit,
+                dwell=self.createDwell())
+            self.scanEngine.clock = self.clock # refreshed in the scan thread
+            self.scanEngine.metadata = self.metadata
+            self.scanEngine.start(delays, int(daqtime * 1000), sink)
             
+    def abortPhaseShifterScan(self):
+        if self.scanEngine is not None and self.scanEngine.is_running():
+            self.statusbar.showMessage('Aborting scan...')
+            self.scanEngine.abort()
+    
+    def onScanStep(self, index, delay, overhead):
+        self.delayPsecSpinBox.setValue(delay)
+        self.lcdDelay.display(delay)
+        self.progressScan.setValue(index + 1)
+        self.statusbar.showMessage('Phase shifter at %i ps, step %i of %i (overhead %.0f ms, duty cycle %.0f %%)'
+                                   % (delay, index + 1, len(self.scanDelays), overhead * 1e3,
+                                      self.scanEngine.timer.duty_cycle() * 100))
+    
+    def onScanFinished(self, completed):
+        self.pushScanAcquire.setEnabled(True)
+        self.pushScanAbort.setEnabled(False)
+        if self.stepCounter is not None:
+            self.stepCounter.close()
+            self.stepCounter = None
+        print(self.scanEngine.summary())
+        # per-step phase times next to the data, one line per scan in the
+        # beamtime log (duty cycle)
+        timer = self.scanEngine.timer
+        print(timer.summary())
+        try:
+            timer.save(self.scanTimingPath)
+            self.metadata.save(self.scanTimingPath.replace('_timing.csv',
+                                                           '_metadata.csv'))
+            scan_timing.append_scan_log(
+                os.path.join(self.DAQdirectory, 'DAQ_scan_timing.csv'),
+                self.scanName, timer)
+            table = timer.table()
+            if len(table):
+                self.measurementLog.add(self.scanName, table['t_start'][0],
+                                        table['t_stop'][-1])
+        except OSError as e:
+            print('Could not save the scan timing:', e)
+        if completed:
             self.statusbar.showMessage('---------- Measurement finished ----------' + self.dataFileName + '-run%03i.h5' % (self.runningNoSpinBox.value()))
+        else:
+            self.statusbar.showMessage('---------- Scan aborted ----------' + self.dataFileName + '-run%03i.h5' % (self.runningNoSpinBox.value()))
             
     def savePSScans(self):
         nrows = self.tableOfDelayRanges.rowCount()
@@ -666,21 +998,18 @@ class AcquisitionUI(QtWidgets.QMainWindow, Ui_MainWindow):
             
             
     def tableClick(self):
-        nrows = self.tableOfDelayRanges.rowCount()
-        npts = 0
-        for n in range(nrows):
-            try:
-                startpt = int(self.tableOfDelayRanges.item(n,0).text())
-                endpt = int(self.tableOfDelayRanges.item(n,1).text())
-                stepsize = int(self.tableOfDelayRanges.item(n,2).text())
-                currnpts = (endpt - startpt)//stepsize
-                npts = npts + currnpts
-            except:
-                pass
-            
-        totaltime = npts * self.acquisitionTimePerStepSecsSpinBox.value()
-        
-        self.estTimeLine.setText(str(totaltime) + ' s')
+        plan = self.compileScanPlan()
+        # overhead per step as measured in the last scan, if any
+        overhead = 0.0
+        if self.scanEngine is not None and self.scanEngine.overheads:
+            overhead = float(np.mean(self.scanEngine.overheads))
+        if self.dwellSettings is not None: # upper bound
+            totaltime = plan.estimated_time(self.dwellSettings[3], overhead)
+            self.estTimeLine.setText('< %.0f s (%i steps)' % (totaltime, len(plan)))
+        else:
+            totaltime = plan.estimated_time(
+                self.acquisitionTimePerStepSecsSpinBox.value(), overhead)
+            self.estTimeLine.setText('%.0f s (%i steps)' % (totaltime, len(plan)))
             
             
     #%% Manip
@@ -726,7 +1055,20 @@ if __name__ == "__main__":
     import sys
     app = QtWidgets.QApplication(sys.argv)
 #   MainWindow = QtWidgets.QMainWindow()
-    ui = AcquisitionUI()
+    tdc_lib = None
+    ul_backend = None
+    pv_factory = None
+    tdc_libh5 = None
+    if '--simulate' in sys.argv:
+        import scTDC_sim
+        import mcculw_sim
+        import epics_sim
+        tdc_lib = scTDC_sim.scTDClib_sim()
+        tdc_libh5 = scTDC_sim.scTDC_hdf5lib_sim() # per-step files are not written
+        ul_backend = mcculw_sim.SimulatedUL()
+        pv_factory = epics_sim.PV
+    ui = AcquisitionUI(tdc_lib=tdc_lib, ul_backend=ul_backend,
+                       pv_factory=pv_factory, tdc_libh5=tdc_libh5)
     ui.show()
 #   ui.setupUi(MainWindow)
 #   MainWindow.show()
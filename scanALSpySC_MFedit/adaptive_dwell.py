@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive exposure per scan step.
+
+Instead of a fixed exposure for every step, AdaptiveDwell starts the
+measurement of a step with the maximum exposure and interrupts it as soon as
+the step has enough counts: a target number of counts, or a target relative
+statistical error (1/sqrt(N) for Poisson counts, i.e. N = 1/rel_error**2),
+whichever is reached first. The exposure stays between min_s and max_s, so
+that steps without signal do not run forever and every step gets at least
+the minimum exposure.
+
+The live counts come from StepCounter, a time-histogram pipe that the scTDC
+library fills during the measurement and that is read without copying, so
+polling it costs no python time per event. Its time range can be restricted
+to the region of interest (e.g. the photoelectron peak), so that the error
+refers to the signal and not to the background.
+"""
+
+import concurrent.futures
+import math
+import time
+
+import scTDC
+
+from preview import binned_roi
+
+
+class StepCounter(object):
+    """ Counts the events of the running measurement in a time window """
+    def __init__(self, device, t_roi=(0, 1<<22), t_bin=1<<12,
+                 x_roi=(0, 1<<16), y_roi=(0, 1<<16)):
+        """
+        Parameters
+        ----------
+        device : scTDC.Device
+          an initialized device.
+        t_roi : (int, int), optional
+          offset and size of the counted time window in detector units.
+          The default counts all events.
+        t_bin : int, optional
+          bin width of the internal histogram, a power of 2. Only the
+          number of bins depends on it. The default is 4096.
+        x_roi, y_roi : (int, int), optional
+          integration ranges in x and y. The defaults accept all events.
+        """
+        self.device = device
+        roi = (x_roi, y_roi, binned_roi(t_roi, t_bin, "time"))
+        pipeid, pipe = device.add_t_pipe(scTDC.BS64, 0, (1, 1, t_bin), roi)
+        if pipeid < 0:
+            raise RuntimeError("could not open counter pipe: ({}) {}".format(
+                pipe, pipeid))
+        self.pipe_id = pipeid
+        self._pipe = pipe
+        self._hist = pipe.get_buffer_view()
+
+    def reset(self):
+        self._pipe.clear()
+
+    def counts(self):
+        return int(self._hist.sum())
+
+    def close(self):
+        if self.pipe_id is not None:
+            self.device.remove_pipe(self.pipe_id)
+            self.pipe_id = None
+
+
+class AdaptiveDwell(object):
+    """ Ends the measurement of a step when it has enough counts.
+
+    Parameters
+    ----------
+    counter : StepCounter
+      or any object with reset() and counts() for the running measurement.
+    target_counts : int, optional
+      counts after which the step ends. The default is None.
+    rel_error : float, optional
+      relative statistical error after which the step ends. The default is
+      None. At least one of target_counts and rel_error is needed.
+    min_s, max_s : float, optional
+      bounds of the exposure per step in seconds. The defaults are 0.1 and
+      10.
+    poll_interval : float, optional
+      seconds between two reads of the counter. The default is 0.02.
+    """
+    def __init__(self, counter, target_counts=None, rel_error=None,
+                 min_s=0.1, max_s=10.0, poll_interval=0.02):
+        if target_counts is None and rel_error is None:
+            raise ValueError("need target_counts or rel_error")
+        if not 0 <= min_s <= max_s:
+            raise ValueError("need 0 <= min_s <= max_s")
+        self.counter = counter
+        self.target_counts = target_counts
+        self.rel_error = rel_error
+        self.min_s = min_s
+        self.max_s = max_s
+        self.poll_interval = poll_interval
+        self.last_counts = 0
+        self.last_exposure = 0.0
+
+    def required_counts(self):
+        """ Counts that end a step, the smaller of both criteria """
+        required = []
+        if self.target_counts is not None:
+            required.append(int(self.target_counts))
+        if self.rel_error is not None and self.rel_error > 0:
+            required.append(int(math.ceil(self.rel_error ** -2)))
+        return min(required) if required else 0
+
+    def measure(self, device):
+        """ Runs the measurement of one step and returns the reason of its
+        end (as Device.measure_future). Afterwards, last_counts and
+        last_exposure hold the counts and the exposure time of the step. """
+        required = self.required_counts()
+        self.counter.reset()
+        t0 = time.perf_counter()
+        future = device.measure_future(int(round(self.max_s * 1000)))
+        while True:
+            try:
+                reason = future.result(timeout=self.poll_interval)
+                break
+            except concurrent.futures.TimeoutError:
+                pass
+            if (time.perf_counter() - t0 >= self.min_s
+                    and self.counter.counts() >= required):
+                device.interrupt_measurement()
+                reason = future.result()
+                break
+        self.last_exposure = time.perf_counter() - t0
+        self.last_counts = self.counter.counts()
+        return reason
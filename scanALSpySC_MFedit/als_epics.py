@@ -7,16 +7,14 @@ cainfo('SR:BCM:BunchQ')
 import pandas as pd
 from epics import PV
 
+from charge_logger import BunchChargeLogger
+
 bq = PV('SR:BCM:BunchQ')
 freq = PV('MOCounter:FREQUENCY')
 
+bunchq = BunchChargeLogger("charges.h5")
+bq.add_callback(bunchq.callback)
 
-def cb(**kw): 
-    bunchq.append('charge', 
-                  pd.Series(kw['value'], name=kw['timestamp']
-                            ).to_frame().T
-                  )
-bunchq = pd.HDFStore("charges.h5")
-bq.add_callback(cb)
-
-bunchq.charge
+bunchq.stats()
+# bunchq.close()
+# pd.read_hdf("charges.h5", "charge")
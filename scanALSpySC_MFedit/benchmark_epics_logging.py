@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the bunch charge logger and the metadata sampler on simulated
+EPICS PVs (epics_sim.py).
+
+For every update rate, SR:BCM:BunchQ is simulated with the given waveform
+length and logged by charge_logger.BunchChargeLogger into a temporary HDF5
+file, while a metadata_sampler.MetadataSampler on MOCounter:FREQUENCY and
+SR:BCM:BunchQ is sampled at 'step rate' like a scan would. Reports the
+updates delivered, the time spent in the logger callback, the backlog and
+flush latency of the logger and the cost of one metadata sample.
+
+Example:
+    python benchmark_epics_logging.py --rates 10 50 100 --duration 10
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import charge_logger
+import epics_sim
+import metadata_sampler
+
+
+def run(rate, nelm, duration, flush_rows, flush_interval, step_rate):
+    provider = epics_sim.PVProvider(rates={'SR:BCM:BunchQ' : rate},
+                                    nelm=nelm, jitter=0.1, seed=0)
+    path = os.path.join(tempfile.mkdtemp(), "charges.h5")
+    logger = charge_logger.BunchChargeLogger(path, flush_rows=flush_rows,
+                                             flush_interval=flush_interval)
+    callback_time = [0.0, 0]
+    def timed_callback(**kw):
+        t0 = time.perf_counter()
+        logger.callback(**kw)
+        callback_time[0] += time.perf_counter() - t0
+        callback_time[1] += 1
+    bq = provider.PV('SR:BCM:BunchQ', callback=timed_callback)
+    sampler = metadata_sampler.MetadataSampler(
+        ['MOCounter:FREQUENCY', 'SR:BCM:BunchQ'], pv_factory=provider.PV)
+
+    max_backlog = 0
+    sample_time = 0.0
+    t_end = time.perf_counter() + duration
+    i = 0
+    while time.perf_counter() < t_end:
+        t0 = time.perf_counter()
+        sampler.sample(i, time.time())
+        sample_time += time.perf_counter() - t0
+        i += 1
+        max_backlog = max(max_backlog, logger.backlog())
+        time.sleep(1.0 / step_rate)
+    provider.stop()
+    sampler.close()
+    bq.disconnect()
+    t0 = time.perf_counter()
+    logger.close()
+    close_time = time.perf_counter() - t0
+    stats = logger.stats()
+    print("%6.0f Hz: %6d updates (%d late), callback %6.1f us, "
+          "max backlog %5d rows, flush latency max %6.1f ms, last write "
+          "%6.1f ms, close %6.1f ms, dropped %d, sample %5.1f us"
+          % (rate, callback_time[1], provider.late,
+             callback_time[0] / max(callback_time[1], 1) * 1e6, max_backlog,
+             stats['max_flush_latency'] * 1e3,
+             stats['last_write_time'] * 1e3, close_time * 1e3,
+             stats['dropped'], sample_time / max(i, 1) * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rates", type=float, nargs="+",
+                        default=[10, 50, 100])
+    parser.add_argument("--nelm", type=int, default=328)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--flush-rows", type=int, default=1024)
+    parser.add_argument("--flush-interval", type=float, default=5.0)
+    parser.add_argument("--step-rate", type=float, default=20.0,
+                        help="metadata samples per second")
+    args = parser.parse_args()
+    for rate in args.rates:
+        run(rate, args.nelm, args.duration, args.flush_rows,
+            args.flush_interval, args.step_rate)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the python-side EventStreamWriter (event_writer.py) for several
+compression filters with the scTDC_hdf5 streamer of the vendor. The vendor
+streamer is only measured on real hardware (--inifile); an offline run
+compares the python writer settings among themselves.
+
+The python writer is fed from the simulated library (scTDC_sim) unless
+--inifile is given, in which case the real hardware is used for both the
+python writer and the vendor streamer (the latter needs scTDC_hdf50.dll).
+Reported are the event data rate in MB/s (uncompressed size of the written
+fields divided by the wall time from the start of the measurement until the
+file is closed), the file size, the compression ratio and the back-pressure
+statistics of the python writer.
+
+Example:
+    python benchmark_hdf5_writer.py --rate 2e6 --time-ms 5000
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import scTDC
+import scTDC_sim
+import event_writer
+
+FILTERS = [(None, None), ("lzf", None), ("gzip", 1), ("gzip", 4),
+           ("lz4", None), ("blosc", 5)]
+
+
+def _measure(device, time_ms):
+    done = threading.Event()
+    cbid = device.add_end_of_measurement_callback(lambda reason: done.set())
+    device.do_measurement(time_ms)
+    done.wait()
+    device.remove_end_of_measurement_callback(cbid)
+
+
+def bench_python_writer(device, compression, level, time_ms, outdir):
+    try:
+        writer = event_writer.EventStreamWriter(
+            device.lib, device.dev_desc, compression=compression, level=level)
+    except ImportError as e:
+        return dict(name="python %s" % compression, error=str(e))
+    path = os.path.join(outdir, "python_%s_%s.h5" % (compression, level))
+    writer.open(path, "benchmark_hdf5_writer.py")
+    t0 = time.perf_counter()
+    _measure(device, time_ms)
+    writer.close_file()
+    wall = time.perf_counter() - t0
+    writer.close()
+    st = writer.stats
+    size = os.path.getsize(path)
+    return dict(name="python %s%s" % (compression,
+                                      "" if level is None else "/%d" % level),
+                events=st["events_written"], raw_bytes=st["bytes_written"],
+                file_bytes=size, wall=wall, dropped=st["dropped"],
+                blocked_s=st["blocked_s"], max_queue=st["max_queue"])
+
+
+def bench_vendor_streamer(device, time_ms, outdir):
+    success, errmsg = device.hdf5_enable()
+    if not success:
+        return dict(name="scTDC_hdf5", error=errmsg)
+    path = os.path.join(outdir, "vendor.h5")
+    a = scTDC.HDF5DataSelection
+    t0 = time.perf_counter()
+    device.hdf5_open(path, "benchmark_hdf5_writer.py",
+                     scTDC.HDF5DataSelection(a.X | a.TIME))
+    _measure(device, time_ms)
+    device.hdf5_close()
+    wall = time.perf_counter() - t0
+    device.hdf5_disable()
+    size = os.path.getsize(path)
+    events = raw = 0
+    try:
+        import h5py
+        with h5py.File(path, "r") as f:
+            def _visit(name, obj):
+                if isinstance(obj, h5py.Dataset):
+                    d[0] = max(d[0], obj.shape[0] if obj.shape else 0)
+                    d[1] += obj.size * obj.dtype.itemsize
+            d = [0, 0]
+            f.visititems(_visit)
+            events, raw = d
+    except ImportError:
+        pass
+    return dict(name="scTDC_hdf5", events=events, raw_bytes=raw,
+                file_bytes=size, wall=wall, dropped=0, blocked_s=0.0,
+                max_queue=0)
+
+
+def print_results(results):
+    header = ("%-16s %11s %9s %10s %7s %9s %10s %9s" %
+              ("writer", "events", "MB/s", "file [MB]", "ratio", "dropped",
+               "blocked[s]", "max queue"))
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        if "error" in r:
+            print("%-16s  skipped: %s" % (r["name"], r["error"]))
+            continue
+        print("%-16s %11d %9.1f %10.1f %7.2f %9d %10.2f %9d" %
+              (r["name"], r["events"], r["raw_bytes"] / r["wall"] / 1e6,
+               r["file_bytes"] / 1e6,
+               r["raw_bytes"] / max(r["file_bytes"], 1), r["dropped"],
+               r["blocked_s"], r["max_queue"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rate", type=float, default=2e6,
+                        help="event rate of the simulation [1/s]")
+    parser.add_argument("--time-ms", type=int, default=3000)
+    parser.add_argument("--inifile", default=None,
+                        help="use the real hardware with this ini file; "
+                        "required for the scTDC_hdf5 comparison, which is "
+                        "skipped otherwise")
+    parser.add_argument("--outdir", default=None,
+                        help="directory for the test files (default: temp)")
+    args = parser.parse_args()
+    outdir = args.outdir or tempfile.mkdtemp(prefix="bench_h5_")
+    if args.inifile:
+        device = scTDC.Device(inifilepath=args.inifile)
+    else:
+        device = scTDC.Device(lib=scTDC_sim.scTDClib_sim(rate=args.rate,
+                                                         seed=0))
+    results = [bench_python_writer(device, c, l, args.time_ms, outdir)
+               for c, l in FILTERS]
+    if args.inifile:
+        results.append(bench_vendor_streamer(device, args.time_ms, outdir))
+    else:
+        results.append(dict(name="scTDC_hdf5",
+                            error="needs real hardware (--inifile)"))
+    device.deinitialize()
+    print_results(results)
+    if not args.inifile:
+        print("offline run: the scTDC_hdf5 column was skipped, only the "
+              "python writer was measured (use --inifile to compare)")
+    print("files in", outdir)
+
+
+if __name__ == "__main__":
+    main()
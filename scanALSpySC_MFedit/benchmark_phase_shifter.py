@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the phase shifter writes against the simulated mcculw backend
+(mcculw_sim.py).
+
+Compares, per delay, the legacy write sequence (BitArray state, 6 d_out
+calls for the high - low - high strobe) with PhaseShifter.set_delay from the
+lookup table, with and without d_out_array. Reports the USB calls and the
+time per delay and checks that the simulated phase shifter latched every
+code. With --scan, a short PhaseShifterScanEngine scan is run on the
+simulated TDC (scTDC_sim) and its per-step overhead is printed.
+
+Example:
+    python benchmark_phase_shifter.py --latency 0.001 --delays 200 --scan
+"""
+
+import argparse
+import time
+
+from bitstring import BitArray
+
+import mcculw_sim
+import write_ports
+
+
+def legacy_set_delay(ps, code):
+    """ The strobe sequence as it was written before DELAY_LUT """
+    state = BitArray(uint=code, length=11)
+    for strobe in (1, 0, 1):
+        state.set(strobe, 0)
+        ps.ul.d_out(ps.board_num, ps.pA.type, state[3:].uint)
+        ps.ul.d_out(ps.board_num, ps.pB.type, state[:3].uint)
+
+
+def run_case(name, sim, write, codes):
+    ps = write_ports.PhaseShifter(ul_backend=sim)
+    ps.connect()
+    sim.reset_counters()
+    t0 = time.perf_counter()
+    for code in codes:
+        write(ps, code)
+    elapsed = time.perf_counter() - t0
+    # the first strobe from the idle (low) state latches the code twice
+    latched = [c for i, (_, c) in enumerate(sim.latched)
+               if i == 0 or c != sim.latched[i-1][1]]
+    ok = "ok" if latched == list(codes) else "MISMATCH"
+    calls = sum(sim.calls.values())
+    print("%-22s %5.2f calls/delay  %7.3f ms/delay  latched %s"
+          % (name, calls / len(codes), elapsed / len(codes) * 1e3, ok))
+    sim.release_daq_device(ps.board_num)
+
+
+def run_scan(sim, delays, time_ms, min_settle):
+    import scTDC
+    import scTDC_sim
+    import scan_engine
+
+    class NullSink(object):
+        def begin(self, index, value):
+            return (True, "")
+        def finish(self, index, value, t_start, t_stop):
+            pass
+        def close(self):
+            pass
+
+    ps = write_ports.PhaseShifter(ul_backend=sim)
+    ps.connect()
+    device = scTDC.Device(lib=scTDC_sim.scTDClib_sim(rate=1e4, seed=0))
+    engine = scan_engine.PhaseShifterScanEngine(device, ps,
+                                                min_settle=min_settle)
+    completed = engine.run(delays, time_ms, NullSink())
+    print("scan %s: %s" % ("completed" if completed else "aborted",
+                           engine.summary()))
+    device.deinitialize()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--latency", type=float, default=0.001,
+                        help="seconds per USB transaction")
+    parser.add_argument("--delays", type=int, default=200)
+    parser.add_argument("--scan", action="store_true")
+    parser.add_argument("--time-ms", type=int, default=20)
+    parser.add_argument("--min-settle", type=float, default=0.0,
+                        help="minimum settle time per step in s for --scan "
+                        "(on top of the port read-back)")
+    args = parser.parse_args()
+
+    # a delay scan: consecutive codes share port A most of the time
+    codes = [i % write_ports.NUM_CODES for i in range(args.delays)]
+    print("%d delays, %.2f ms per USB transaction"
+          % (len(codes), args.latency * 1e3))
+    for name, supports_array, write in (
+            ("legacy (6 x d_out)", True, legacy_set_delay),
+            ("LUT, d_out", False, write_ports.PhaseShifter.set_delay),
+            ("LUT, d_out_array", True, write_ports.PhaseShifter.set_delay)):
+        sim = mcculw_sim.SimulatedUL(latency=args.latency,
+                                     inventory_latency=0,
+                                     supports_array=supports_array)
+        run_case(name, sim, write, codes)
+
+    if args.scan:
+        sim = mcculw_sim.SimulatedUL(latency=args.latency, inventory_latency=0)
+        run_scan(sim, [5 * c for c in codes[:20]], args.time_ms,
+                 args.min_settle)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Latency benchmark of prodigy_remote.ProdigyRemote against the local Prodigy
+simulator (prodigy_sim.py).
+
+Reads the values of all analyzer parameters once with one request at a time
+(sendAndReceive in a loop) and once pipelined (getParamValues), and applies
+the voltages of the GUI with setVoltagesDirectly. With --error-rate and
+--drop-after, the reconnection and error paths are exercised as well.
+
+Example:
+    python benchmark_prodigy.py --latency 0.002 --processing-time 0.0005
+"""
+
+import argparse
+import time
+
+import prodigy_remote
+import prodigy_sim
+
+
+def timed(func, repeat):
+    t = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        t.append(time.perf_counter() - t0)
+    return min(t), sum(t) / len(t)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--latency", type=float, default=0.002)
+    parser.add_argument("--processing-time", type=float, default=0.0005)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--drop-after", type=int, default=None)
+    args = parser.parse_args()
+
+    sim = prodigy_sim.ProdigySimulator(processing_time=args.processing_time,
+                                       latency=args.latency,
+                                       drop_after=args.drop_after)
+    host, port = sim.start()
+    pr = prodigy_remote.ProdigyRemote(debug=False, host=host, port=port)
+    pr.connect()
+    pr.allParams = pr.getParams()
+    n = len(pr.allParams)
+
+    def sequential():
+        for parm in pr.allParams:
+            pr.sendAndReceive(b'GetAnalyzerParameterValue ParameterName:'
+                              + parm)
+
+    print("%d parameters, latency %.1f ms, processing %.2f ms per request"
+          % (n, args.latency * 1e3, args.processing_time * 1e3))
+    for name, func in (("sequential", sequential),
+                       ("pipelined", pr.getParamValues),
+                       ("setVoltagesDirectly", pr.setVoltagesDirectly)):
+        best, mean = timed(func, args.repeat)
+        print("%-20s best %7.1f ms   mean %7.1f ms" % (name, best * 1e3,
+                                                       mean * 1e3))
+    print("requests served: %d" % sim.requests)
+    pr.disconnect()
+    sim.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark for the python event paths of scTDC.py.
+
+Synthetic DLD event streams from the simulated library (scTDC_sim) are pushed
+through
+  * usercallbacks_pipe,
+  * buffered_data_callbacks_pipe for several max_buffered_data_len values,
+  * ringbuffer_pipe (with a consumer thread reading from a cursor),
+  * the histogram Pipe path (xt and t pipes, binning done by the library),
+and, as a reference, through a device without any pipes ("null"), which
+measures the cost of the event generation alone.
+
+For each path, the sustained event rate, the latency percentiles of the
+callbacks into python, the peak resident memory and the number of events
+that did not reach the consumer are reported. The histogram and null paths
+have no python consumer that could count events, so their event rate is
+the generated one and their dropped count is N/A. Every case runs in a fresh
+process so that the peak memory is not inherited from earlier cases.
+
+Example:
+    python benchmark_scTDC.py --mode 2bunch multibunch --time-ms 2000
+"""
+
+import argparse
+import multiprocessing
+import threading
+import time
+
+import numpy as np
+
+import scTDC
+import scTDC_sim
+
+# bunch patterns of the ALS storage ring, in TDC time bins (one revolution =
+# 656 ns = 328 buckets of 16 bins)
+MODES = {
+    "2bunch"     : dict(bunch_offsets=(0, 2624), bunch_period=5248),
+    "multibunch" : dict(bunch_offsets=tuple(range(0, 276*16, 16)) + (4800,),
+                        bunch_weights=(1,)*276 + (4,), bunch_period=5248),
+}
+
+DEFAULT_BUFLENS = (1<<10, 1<<12, 1<<14, 1<<16, 1<<18)
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MiB (NaN if unknown) """
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    except ImportError: # Windows
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / float(1<<20)
+        except Exception:
+            return float("nan")
+
+
+def _timed(func, latencies):
+    def wrapper(*args):
+        t = time.perf_counter()
+        result = func(*args)
+        latencies.append(time.perf_counter() - t)
+        return result
+    return wrapper
+
+
+def run_case(case):
+    """ Runs one benchmark case, returns a dictionary with the results """
+    kind, buflen, mode, rate, time_ms = case
+    lib = scTDC_sim.scTDClib_sim(realtime=False, rate=rate, seed=0,
+                                 **MODES[mode])
+    dev = scTDC.Device(lib=lib)
+    latencies = []
+    received = [0]
+    consumer = None
+    ring = None
+
+    if kind == "user":
+        class _Pipe(scTDC.usercallbacks_pipe):
+            def on_dld_event(self, dld_events, nr_dld_events):
+                received[0] += nr_dld_events
+        pipe = _Pipe(dev.lib, dev.dev_desc)
+        pipe.on_dld_event = _timed(pipe.on_dld_event, latencies)
+    elif kind == "buffered":
+        class _Pipe(scTDC.buffered_data_callbacks_pipe):
+            def on_data(self, data):
+                # the library reuses its buffer, so consumers have to copy
+                self.last = data["time"].copy()
+                received[0] += data["data_len"]
+        pipe = _Pipe(dev.lib, dev.dev_desc,
+                     data_field_selection=(scTDC.SC_DATA_FIELD_TIME
+                                           | scTDC.SC_DATA_FIELD_DIF1),
+                     max_buffered_data_len=buflen)
+        pipe.on_data = _timed(pipe.on_data, latencies)
+    elif kind == "ring":
+        _, ring = dev.add_ringbuffer_pipe(
+            data_field_selection=(scTDC.SC_DATA_FIELD_TIME
+                                  | scTDC.SC_DATA_FIELD_DIF1),
+            max_buffered_data_len=buflen)
+        ring._data_cb = _timed(ring._data_cb, latencies)
+        cursor = ring.events.add_cursor()
+        stop = threading.Event()
+        def _consume():
+            while not stop.is_set():
+                received[0] += len(cursor.read()["time"])
+                time.sleep(0.01)
+            received[0] += len(cursor.read()["time"])
+        consumer = threading.Thread(target=_consume)
+        consumer.start()
+    elif kind == "histo":
+        dev.add_xt_pipe(scTDC.BS32, 0, (16, 16, 1),
+                        ((0, 256), (0, 256), (0, 8192)))
+        dev.add_t_pipe(scTDC.BS32, 0, (1, 1, 1),
+                       ((0, 4096), (0, 4096), (0, 8192)))
+
+    done = threading.Event()
+    dev.add_end_of_measurement_callback(lambda reason: done.set())
+    t0 = time.perf_counter()
+    retcode, errmsg = dev.do_measurement(time_ms)
+    if retcode < 0:
+        return dict(kind=kind, buflen=buflen, mode=mode, error=errmsg)
+    done.wait()
+    wall = time.perf_counter() - t0
+    if consumer is not None:
+        stop.set()
+        consumer.join()
+    counted = kind not in ("histo", "null") # events reach python
+    if not counted:
+        received[0] = lib.generated
+    lat = np.array(latencies) * 1e6
+    result = dict(kind=kind, buflen=buflen, mode=mode,
+                  events=lib.generated,
+                  events_per_s=received[0] / wall,
+                  callbacks=len(lat),
+                  dropped=lib.generated - received[0] if counted else None,
+                  peak_rss_mb=peak_rss_mb())
+    for q in (50, 99):
+        result["p%d_us" % q] = np.percentile(lat, q) if len(lat) else 0.0
+    result["max_us"] = lat.max() if len(lat) else 0.0
+    if ring is not None:
+        result["ring_capacity"] = ring.events.capacity
+    dev.deinitialize()
+    return result
+
+
+def make_cases(modes, buflens, rate, time_ms):
+    cases = []
+    for mode in modes:
+        cases.append(("null", 0, mode, rate, time_ms))
+        cases.append(("user", 0, mode, rate, time_ms))
+        for b in buflens:
+            cases.append(("buffered", b, mode, rate, time_ms))
+        for b in buflens:
+            cases.append(("ring", b, mode, rate, time_ms))
+        cases.append(("histo", 0, mode, rate, time_ms))
+    return cases
+
+
+def print_results(results):
+    header = ("%-10s %-9s %8s %12s %9s %10s %10s %10s %9s %9s" %
+              ("mode", "path", "buflen", "events/s", "callbacks", "p50 [us]",
+               "p99 [us]", "max [us]", "dropped", "RSS [MB]"))
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        if "error" in r:
+            print("%-10s %-9s %8s  error: %s" % (r["mode"], r["kind"],
+                                                 r["buflen"] or "-",
+                                                 r["error"]))
+            continue
+        dropped = "N/A" if r["dropped"] is None else "%d" % r["dropped"]
+        print("%-10s %-9s %8s %12.4g %9d %10.1f %10.1f %10.1f %9s %9.1f" %
+              (r["mode"], r["kind"], r["buflen"] or "-", r["events_per_s"],
+               r["callbacks"], r["p50_us"], r["p99_us"], r["max_us"],
+               dropped, r["peak_rss_mb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--mode", nargs="+", choices=sorted(MODES),
+                        default=sorted(MODES))
+    parser.add_argument("--rate", type=float, default=2e6,
+                        help="mean event rate of the simulation [1/s]")
+    parser.add_argument("--time-ms", type=int, default=2000,
+                        help="simulated exposure per case [ms]")
+    parser.add_argument("--buflen", type=int, nargs="+",
+                        default=list(DEFAULT_BUFLENS),
+                        help="max_buffered_data_len values to compare")
+    args = parser.parse_args()
+    cases = make_cases(args.mode, args.buflen, args.rate, args.time_ms)
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for case in cases:
+        with ctx.Pool(1) as pool: # fresh process, so that peak RSS is per case
+            results.append(pool.apply(run_case, (case,)))
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Alignment of the logged bunch charge with the measurement windows.
+
+The bunch charge is logged with EPICS timestamps (charge_logger.py,
+charges.h5), the measurements with the wall clock of the DAQ computer. With
+ClockOffset, the DAQ records its windows on the NTP time scale of the IOCs:
+the offset is queried from an NTP server once (per scan, in the scan
+thread, or in the background when it is older than max_age) and added to
+time.time(), so neither a measurement nor the GUI waits for a network round
+trip.
+
+integrate_windows() attaches the charge to any number of windows at once.
+The total charge of an update (sum over the buckets) is held until the next
+update, so the charge integrated over a window is an integral over a step
+function. The cumulative integral at the update times is computed once;
+every window then needs two np.searchsorted lookups, i.e. thousands of
+steps take milliseconds. Windows that are not covered by the log (before
+the first update, or more than a tolerance after the last one) get NaN.
+
+Windows come from the step records of a scan file (scan_writer, t_start and
+t_stop), from a scan timing table (scan_timing) or from the measurement log
+of static runs (MeasurementLog). From the command line:
+    python charge_alignment.py charges.h5 DAQ_measurements.csv -o out.csv
+"""
+
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+WINDOW_DTYPE = np.dtype([("t_start",    np.float64),
+                         ("t_stop",     np.float64),
+                         ("n_updates",  np.int64),
+                         ("mean_charge", np.float64),
+                         ("integrated_charge", np.float64)])
+
+
+class ClockOffset(object):
+    """ Offset of the local clock to NTP time, queried at most every
+    max_age seconds. client is an ntplib.NTPClient; if the server cannot be
+    reached, the last offset (initially 0) is kept. """
+    def __init__(self, client, server="pool.ntp.org", max_age=600.0,
+                 timeout=1.0):
+        self.client = client
+        self.server = server
+        self.max_age = max_age
+        self.timeout = timeout
+        self.offset = 0.0
+        self.t_query = None    # time.monotonic() of the last successful query
+        self._query = None     # thread of refresh_async
+
+    def refresh(self):
+        """ Queries the server now; returns the offset in seconds """
+        try:
+            response = self.client.request(self.server, version=3,
+                                           timeout=self.timeout)
+        except Exception as e: # ntplib.NTPException, socket errors
+            print('NTP query to %s failed (%s), keeping offset %.3f s'
+                  % (self.server, e, self.offset))
+        else:
+            self.offset = response.offset
+            self.t_query = time.monotonic()
+        return self.offset
+
+    def refresh_async(self):
+        """ Runs refresh() in a background thread (unless a query is still
+        running) and returns immediately; time() uses the previous offset
+        until the answer has arrived """
+        if self._query is None or not self._query.is_alive():
+            self._query = threading.Thread(target=self.refresh, daemon=True)
+            self._query.start()
+
+    def stale(self):
+        """ True if the offset has never been queried or is older than
+        max_age """
+        return (self.t_query is None
+                or time.monotonic() - self.t_query > self.max_age)
+
+    def get(self):
+        """ The offset, queried again only if it is older than max_age """
+        if self.stale():
+            self.refresh()
+        return self.offset
+
+    def time(self):
+        """ time.time() on the NTP time scale, without a network query """
+        return time.time() + self.offset
+
+
+class MeasurementLog(object):
+    """ Appends (name, t_start, t_stop) of measurements to a CSV file """
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, name, t_start, t_stop):
+        new = not os.path.exists(self.path)
+        with open(self.path, mode='a') as f:
+            if new:
+                f.write("name,t_start,t_stop\n")
+            f.write("%s,%.6f,%.6f\n" % (name, t_start, t_stop))
+
+
+def total_charge(values):
+    """ Sum over the buckets of every update (NaN-padded waveforms) """
+    return np.nansum(np.asarray(values, dtype=np.float64), axis=1)
+
+
+def load_charge(path, key="charge", t_min=None, t_max=None, margin=60.0):
+    """ Returns (times, totals) of the logged bunch charge, sorted by time.
+    With t_min/t_max, only updates from margin seconds before t_min to
+    t_max are read. """
+    where = []
+    if t_min is not None:
+        where.append("index >= %r" % (float(t_min) - margin))
+    if t_max is not None:
+        where.append("index <= %r" % float(t_max))
+    df = pd.read_hdf(path, key, where=" & ".join(where) or None)
+    times = df.index.to_numpy(dtype=np.float64)
+    totals = total_charge(df.to_numpy())
+    order = np.argsort(times, kind="stable")
+    return times[order], totals[order]
+
+
+def integrate_windows(times, totals, t_start, t_stop, tolerance=1.0):
+    """ Integrates the charge over every window [t_start, t_stop).
+
+    Parameters
+    ----------
+    times, totals : 1D arrays
+      update times (sorted) and total charge of every update.
+    t_start, t_stop : 1D arrays
+      the windows, on the same time scale.
+    tolerance : float, optional
+      seconds after the last update for which its charge is still held;
+      later times are not covered by the log. The default is 1.
+
+    Returns
+    -------
+    numpy record array (WINDOW_DTYPE)
+      n_updates within the window, integrated_charge (charge * s, with
+      the charge held between updates; NaN before the first update and
+      more than tolerance after the last one) and mean_charge
+      (integrated_charge / duration).
+    """
+    times = np.asarray(times, dtype=np.float64)
+    totals = np.asarray(totals, dtype=np.float64)
+    t_start = np.atleast_1d(np.asarray(t_start, dtype=np.float64))
+    t_stop = np.atleast_1d(np.asarray(t_stop, dtype=np.float64))
+    result = np.zeros(len(t_start), WINDOW_DTYPE)
+    result["t_start"] = t_start
+    result["t_stop"] = t_stop
+    if len(times) == 0:
+        result["mean_charge"] = np.nan
+        result["integrated_charge"] = np.nan
+        return result
+    # integral of the step function from times[0] up to every update
+    cumulative = np.concatenate(([0.0], np.cumsum(totals[:-1]
+                                                  * np.diff(times))))
+
+    def integral(t):
+        i = np.searchsorted(times, t, side="right") - 1
+        outside = (i < 0) | (t > times[-1] + tolerance)
+        i = np.maximum(i, 0)
+        value = cumulative[i] + totals[i] * (t - times[i])
+        value[outside] = np.nan
+        return value
+
+    integrated = integral(t_stop) - integral(t_start)
+    duration = t_stop - t_start
+    result["n_updates"] = (np.searchsorted(times, t_stop, side="left")
+                           - np.searchsorted(times, t_start, side="left"))
+    result["integrated_charge"] = integrated
+    with np.errstate(invalid="ignore", divide="ignore"):
+        result["mean_charge"] = integrated / duration
+    return result
+
+
+def read_windows(path):
+    """ Returns a DataFrame with at least t_start and t_stop from a scan
+    file (its step records) or from a CSV file (scan timing table or
+    MeasurementLog) """
+    if path.endswith(".h5"):
+        import h5py
+        with h5py.File(path, "r") as f:
+            return pd.DataFrame(f["steps"][:])
+    df = pd.read_csv(path)
+    df.columns = [c.lstrip("# ") for c in df.columns] # np.savetxt header
+    return df
+
+
+def align(charge_path, windows_path, key="charge"):
+    """ The windows of windows_path with the charge columns attached """
+    df = read_windows(windows_path)
+    times, totals = load_charge(charge_path, key, df["t_start"].min(),
+                                df["t_stop"].max())
+    charge = integrate_windows(times, totals, df["t_start"], df["t_stop"])
+    for name in ("n_updates", "mean_charge", "integrated_charge"):
+        df[name] = charge[name]
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("charges", help="bunch charge file (charges.h5)")
+    parser.add_argument("windows", help="scan file (.h5) or CSV with "
+                        "t_start and t_stop columns")
+    parser.add_argument("--key", default="charge")
+    parser.add_argument("-o", "--output", help="CSV file for the result")
+    args = parser.parse_args()
+    df = align(args.charges, args.windows, args.key)
+    if args.output:
+        df.to_csv(args.output, index=False)
+    else:
+        print(df.to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Buffered logger for the bunch charge waveform of the storage ring.
+
+A monitor on SR:BCM:BunchQ delivers one waveform (the charge of every
+bucket) per update. Appending every update to an HDFStore costs a full
+PyTables append with index update per row. BunchChargeLogger instead copies
+each waveform into a preallocated numpy block in the EPICS callback (one
+row copy, no allocation) and a background thread appends the filled rows as
+one chunk, when 'flush_rows' rows are waiting or the oldest waiting row is
+'flush_interval' seconds old. The table index is built once, in close(),
+which is also registered with atexit, so that the last rows are written
+and the file is closed when the session ends without calling it.
+
+The file layout is the one of the old per-update logger: a table 'charge'
+with the EPICS timestamp as index and one column per bucket.
+
+backlog() returns the number of rows that have not been written yet, and
+stats() the number of rows and chunks written, the write time of the last
+chunk and the flush latency (age of the oldest row of a chunk when it was
+written), so that a logger that cannot keep up is noticed. Updates that
+arrive after close() (from a monitor that is still subscribed) are dropped
+and counted separately.
+
+Usage:
+    logger = BunchChargeLogger("charges.h5")
+    PV('SR:BCM:BunchQ').add_callback(logger.callback)
+    ...
+    logger.close()
+"""
+
+import atexit
+import collections
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+class BunchChargeLogger(object):
+    """ Logs waveform updates of an EPICS PV to an HDFStore table in chunks
+
+    Parameters
+    ----------
+    path : str
+      the HDF5 file, opened with pandas.HDFStore (appended to if it exists).
+    key : str, optional
+      the table in the file. The default is 'charge'.
+    flush_rows : int, optional
+      rows per chunk; also the size of the preallocated blocks. The
+      default is 1024.
+    flush_interval : float, optional
+      maximum time in seconds that a row waits for its chunk. The default
+      is 5.
+    max_blocks : int, optional
+      blocks that may wait for the writer; further updates are dropped and
+      counted. The default is 64.
+    """
+    def __init__(self, path, key='charge', flush_rows=1024, flush_interval=5.0,
+                 max_blocks=64):
+        self.path = path
+        self.key = key
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.max_blocks = max_blocks
+        self.nelm = None       # waveform length, from the first update
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = False
+        self._block = None     # (times, values) being filled
+        self._fill = 0
+        self._t_first = None   # arrival of the first row of the block
+        self._full = collections.deque()  # (times, values, rows, t_first)
+        self._free = []
+        self.rows_written = 0
+        self.chunks_written = 0
+        self.dropped = 0
+        self.dropped_after_close = 0
+        self.last_write_time = 0.0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.store = pd.HDFStore(path)
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _new_block(self):
+        if self._free:
+            return self._free.pop()
+        return (np.empty(self.flush_rows, np.float64),
+                np.empty((self.flush_rows, self.nelm), np.float64))
+
+    def callback(self, value=None, timestamp=None, **kw):
+        """ pyepics monitor callback, e.g. PV.add_callback(logger.callback) """
+        if value is None:
+            return
+        value = np.atleast_1d(value)
+        with self._lock:
+            if self._stop: # closed, the writer takes no more blocks
+                self.dropped_after_close += 1
+                return
+            if self._block is None:
+                if self.nelm is None:
+                    self.nelm = len(value)
+                if len(self._full) >= self.max_blocks:
+                    self.dropped += 1
+                    return
+                self._block = self._new_block()
+                self._fill = 0
+                self._t_first = time.perf_counter()
+            times, values = self._block
+            n = min(len(value), self.nelm)
+            times[self._fill] = timestamp if timestamp is not None else time.time()
+            values[self._fill, :n] = value[:n]
+            values[self._fill, n:] = np.nan
+            self._fill += 1
+            if self._fill == self.flush_rows:
+                self._hand_over()
+                self._wake.set()
+
+    def _hand_over(self):
+        """ Queues the current block for the writer (with the lock held) """
+        if self._block is not None and self._fill:
+            self._full.append(self._block + (self._fill, self._t_first))
+            self._block = None
+            self._fill = 0
+
+    def backlog(self):
+        """ Number of rows that have not been written yet """
+        with self._lock:
+            return self._fill + sum(b[2] for b in self._full)
+
+    def stats(self):
+        """ Dict with the counters and latencies of the writer """
+        return {'rows_written' : self.rows_written,
+                'chunks_written' : self.chunks_written,
+                'backlog' : self.backlog(),
+                'dropped' : self.dropped,
+                'dropped_after_close' : self.dropped_after_close,
+                'last_write_time' : self.last_write_time,
+                'last_flush_latency' : self.last_flush_latency,
+                'max_flush_latency' : self.max_flush_latency}
+
+    def _write_loop(self):
+        while True:
+            # until the oldest waiting row is flush_interval old
+            timeout = self.flush_interval
+            with self._lock:
+                if self._block is not None:
+                    timeout -= time.perf_counter() - self._t_first
+            self._wake.wait(max(timeout, 0.0))
+            self._wake.clear()
+            with self._lock:
+                stop = self._stop
+                if (self._t_first is not None and self._block is not None
+                        and (stop or time.perf_counter() - self._t_first
+                             >= self.flush_interval)):
+                    self._hand_over()
+            while True:
+                with self._lock:
+                    if not self._full:
+                        break
+                    times, values, rows, t_first = self._full.popleft()
+                try:
+                    self._write(times[:rows], values[:rows])
+                except Exception as e: # keep logging, the rows are lost
+                    print('Could not write %i bunch charge rows: %s' % (rows, e))
+                    with self._lock: # also counted in callback
+                        self.dropped += rows
+                else:
+                    self.rows_written += rows
+                    self.chunks_written += 1
+                latency = time.perf_counter() - t_first
+                self.last_flush_latency = latency
+                self.max_flush_latency = max(self.max_flush_latency, latency)
+                with self._lock:
+                    self._free.append((times, values))
+            if stop:
+                return
+
+    def _write(self, times, values):
+        t0 = time.perf_counter()
+        df = pd.DataFrame(values, index=times)
+        # the index is built once in close(), not for every chunk
+        self.store.append(self.key, df, index=False,
+                          expectedrows=self.flush_rows * 1024)
+        self.last_write_time = time.perf_counter() - t0
+
+    def flush(self):
+        """ Hands the rows received so far to the writer """
+        with self._lock:
+            self._hand_over()
+        self._wake.set()
+
+    def close(self):
+        """ Writes the remaining rows, indexes the table and closes the file.
+        Does nothing if the logger is already closed. """
+        with self._lock:
+            if self._stop:
+                return
+            self._stop = True
+        atexit.unregister(self.close)
+        self._wake.set()
+        self._thread.join()
+        if self.key in self.store:
+            self.store.create_table_index(self.key, optlevel=6, kind='medium')
+        self.store.close()
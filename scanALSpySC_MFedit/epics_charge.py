@@ -1,9 +1,16 @@
-import pandas
-import pandas as pd
-from epics import PV
+import sys
 
+from charge_logger import BunchChargeLogger
 
+if '--simulate' in sys.argv: # no control network, see epics_sim.py
+    from epics_sim import PV
+else:
+    from epics import PV
+
+
+# waveforms are collected in memory and appended in chunks by a background
+# thread; bunchq.close() (also run at exit) writes the rest and closes the
+# file (see bunchq.stats() for the backlog)
+bunchq = BunchChargeLogger("charges.h5")
 pv = PV('SR:BCM:BunchQ')
-def cb(**kw): bunchq.append('charge', pd.Series(kw['value'], name=kw['timestamp']).to_frame().T)
-bunchq = pd.HDFStore("charges.h5")
-pv.add_callback(cb)
+pv.add_callback(bunchq.callback)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated EPICS PVs for running the PV-dependent code without the ALS
+control network.
+
+SimulatedPV has the subset of the pyepics PV interface that this project
+uses (value, timestamp, get, put, add_callback, clear_callbacks, disconnect,
+callback= and auto_monitor= in the constructor). Its updates come from a
+PVProvider: one thread that, like the channel access thread of pyepics,
+calls the monitor callbacks of every PV at its update rate, with the
+keyword arguments pvname, value, timestamp, count, status, severity and
+cb_info.
+
+The update rate, jitter and waveform length of each PV are configurable;
+DEFAULT_PVS models the bunch charge waveform (SR:BCM:BunchQ, 328 buckets
+with a gap) at 10 Hz and the master oscillator frequency
+(MOCounter:FREQUENCY) at 1 Hz. Late updates are counted in 'late' and
+their delay in 'max_lateness', so that a benchmark notices when the
+callbacks cannot keep up.
+
+Usage:
+    import epics_sim
+    provider = epics_sim.PVProvider(rates={'SR:BCM:BunchQ' : 100})
+    pv = provider.PV('SR:BCM:BunchQ', callback=logger.callback)
+or, with the default provider, epics_sim.PV in place of epics.PV.
+"""
+
+import heapq
+import threading
+import time
+
+import numpy as np
+
+
+def bunch_charge(nelm=328, gap=40, charge=1.5, noise=0.02, rng=None):
+    """ Generator of bunch charge waveforms in nC: a fill pattern with an
+    empty gap (at most nelm // 8 buckets), decaying slowly, with relative
+    noise """
+    rng = np.random.default_rng() if rng is None else rng
+    pattern = np.full(nelm, charge)
+    gap = min(gap, nelm // 8) # short waveforms keep filled buckets
+    pattern[nelm - gap:] = 0.0
+    lifetime = 8 * 3600.0
+    t0 = time.time()
+    def value():
+        decay = np.exp(-(time.time() - t0) / lifetime)
+        return pattern * decay * (1 + noise * rng.standard_normal(nelm))
+    return value
+
+
+def frequency(f0=499.64, noise=1e-5, rng=None):
+    """ Generator of a scalar around f0 (MHz) """
+    rng = np.random.default_rng() if rng is None else rng
+    return lambda: f0 + noise * rng.standard_normal()
+
+# name -> (rate in Hz, factory of the value generator)
+DEFAULT_PVS = {'SR:BCM:BunchQ' : (10.0, bunch_charge),
+               'MOCounter:FREQUENCY' : (1.0, frequency)}
+
+
+class SimulatedPV(object):
+    """ A monitored PV of a PVProvider, see epics.PV """
+    def __init__(self, provider, pvname, callback=None, auto_monitor=True):
+        self.provider = provider
+        self.pvname = pvname
+        self.auto_monitor = auto_monitor
+        self.connected = True
+        self.value = None
+        self.timestamp = None
+        self.count = 0
+        self.callbacks = {}
+        self._next_index = 0
+        if callback is not None:
+            for cb in (callback if isinstance(callback, (list, tuple))
+                       else [callback]):
+                self.add_callback(cb)
+
+    def add_callback(self, callback, index=None, run_now=False, **kw):
+        if index is None:
+            index = self._next_index
+            self._next_index += 1
+        self.callbacks[index] = callback
+        if run_now and self.value is not None:
+            self._run(index, callback)
+        return index
+
+    def remove_callback(self, index=None):
+        self.callbacks.pop(index, None)
+
+    def clear_callbacks(self):
+        self.callbacks = {}
+
+    def get(self, **kw):
+        return self.value
+
+    def put(self, value, **kw):
+        self.provider.update(self.pvname, value)
+        return 1
+
+    def wait_for_connection(self, timeout=None):
+        return True
+
+    def disconnect(self):
+        self.connected = False
+        self.clear_callbacks()
+        self.provider.detach(self)
+
+    def _update(self, value, timestamp):
+        self.value = value
+        self.timestamp = timestamp
+        self.count = int(np.size(value))
+        for index, cb in list(self.callbacks.items()):
+            self._run(index, cb)
+
+    def _run(self, index, cb):
+        try:
+            cb(pvname=self.pvname, value=self.value,
+               timestamp=self.timestamp, count=self.count, status=0,
+               severity=0, cb_info=(index, self))
+        except Exception as e: # like pyepics, a failing callback is reported
+            print('Error in callback of %s: %s' % (self.pvname, e))
+
+
+class PVProvider(object):
+    """ Updates simulated PVs at their rates from one background thread
+
+    Parameters
+    ----------
+    pvs : dict, optional
+      name -> (rate in Hz, factory of a generator function); the generator
+      returns the next value. The default is DEFAULT_PVS.
+    rates : dict, optional
+      name -> rate in Hz, overrides the rates of 'pvs'.
+    nelm : int, optional
+      waveform length of SR:BCM:BunchQ. The default is 328.
+    jitter : float, optional
+      relative random jitter of the update intervals. The default is 0.
+    seed : int, optional
+      seed of the random values. The default is None.
+    """
+    def __init__(self, pvs=None, rates=None, nelm=328, jitter=0.0, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.jitter = jitter
+        self.rates = {}
+        self.generators = {}
+        for name, (rate, factory) in (pvs or DEFAULT_PVS).items():
+            if factory is bunch_charge:
+                self.generators[name] = factory(nelm=nelm, rng=self.rng)
+            else:
+                self.generators[name] = factory(rng=self.rng)
+            self.rates[name] = rate
+        self.rates.update(rates or {})
+        self.subscribers = {}   # name -> list of SimulatedPV
+        self.updates = 0
+        self.late = 0           # updates more than one interval late
+        self.max_lateness = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def PV(self, pvname, callback=None, auto_monitor=True, **kw):
+        """ Creates a SimulatedPV, like epics.PV """
+        if pvname not in self.generators:
+            raise KeyError("unknown simulated PV " + pvname)
+        pv = SimulatedPV(self, pvname, callback, auto_monitor)
+        with self._lock:
+            self.subscribers.setdefault(pvname, []).append(pv)
+        pv._update(self.generators[pvname](), time.time())
+        self.start()
+        return pv
+
+    def detach(self, pv):
+        with self._lock:
+            subs = self.subscribers.get(pv.pvname, [])
+            if pv in subs:
+                subs.remove(pv)
+
+    def update(self, pvname, value):
+        """ Sends value to all subscribers of pvname now """
+        with self._lock:
+            subs = list(self.subscribers.get(pvname, []))
+        t = time.time()
+        for pv in subs:
+            pv._update(value, t)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _interval(self, name):
+        interval = 1.0 / self.rates[name]
+        if self.jitter:
+            interval *= max(0.0, 1 + self.jitter * self.rng.standard_normal())
+        return interval
+
+    def _run(self):
+        now = time.perf_counter()
+        queue = [(now + self._interval(name), name)
+                 for name in self.generators if self.rates.get(name)]
+        heapq.heapify(queue)
+        while queue and not self._stop.is_set():
+            due, name = queue[0]
+            wait = due - time.perf_counter()
+            if wait > 0:
+                if self._stop.wait(wait):
+                    break
+                continue
+            heapq.heapreplace(queue, (due + self._interval(name), name))
+            lateness = -wait
+            if lateness > 1.0 / self.rates[name]:
+                self.late += 1
+            self.max_lateness = max(self.max_lateness, lateness)
+            self.update(name, self.generators[name]())
+            self.updates += 1
+
+
+_default = None
+
+def PV(pvname, callback=None, auto_monitor=True, **kw):
+    """ epics.PV replacement backed by a shared default PVProvider """
+    global _default
+    if _default is None:
+        _default = PVProvider()
+    return _default.PV(pvname, callback, auto_monitor, **kw)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Python-side HDF5 event writer, an alternative to the scTDC_hdf5 streamer.
+
+EventStreamWriter is a buffered_data_callbacks_pipe. Its on_data callback
+only copies the selected event data fields into a block and puts the block
+into a bounded queue. A background thread takes the blocks from the queue
+and appends them to chunked datasets (scan_writer.ScanFileWriter layout,
+i.e. /events/<field>) with a configurable compression filter.
+
+If the writer thread falls behind and the queue is full, the callback either
+waits for free space (block=True, the library then keeps buffering events)
+or drops the block (block=False). Both are accounted for in the 'stats'
+dictionary: time spent waiting, dropped events, maximum queue depth, written
+events and bytes.
+
+Filters (argument 'compression'):
+  None, "gzip" (level 0..9), "lzf"   - built into h5py
+  "lz4", "blosc" (level 0..9)        - require the hdf5plugin package
+"""
+
+import queue
+import threading
+import time
+
+import numpy as np
+
+import scTDC
+import scan_writer
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+def filter_args(compression=None, level=None):
+    """ Returns the compression keyword arguments for h5py's
+    create_dataset for the given filter name and level """
+    if compression is None:
+        return {}
+    if compression == "gzip":
+        return dict(compression="gzip",
+                    compression_opts=4 if level is None else level)
+    if compression == "lzf":
+        return dict(compression="lzf")
+    if hdf5plugin is None:
+        raise ImportError("filter '%s' requires the hdf5plugin package"
+                          % compression)
+    if compression == "lz4":
+        return dict(hdf5plugin.LZ4())
+    if compression == "blosc":
+        return dict(hdf5plugin.Blosc(cname="lz4",
+                                     clevel=5 if level is None else level,
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError("unknown compression filter '%s'" % compression)
+
+
+class EventStreamWriter(scTDC.buffered_data_callbacks_pipe):
+    """ Streams the selected event data fields of all measurements into an
+    HDF5 file that is opened with open() and closed with close_file(). While
+    no file is open, incoming events are discarded. """
+    def __init__(self,
+                 lib,
+                 dev_desc,
+                 data_field_selection=(scTDC.SC_DATA_FIELD_DIF1
+                                       | scTDC.SC_DATA_FIELD_TIME),
+                 max_buffered_data_len=(1<<16),
+                 compression="gzip",
+                 level=None,
+                 chunk_len=(1<<16),
+                 max_pending_blocks=64,
+                 block=True):
+        """
+        Parameters
+        ----------
+        lib, dev_desc, data_field_selection, max_buffered_data_len :
+          see buffered_data_callbacks_pipe. The default field selection
+          matches HDF5DataSelection(X | TIME) of the scTDC_hdf5 streamer.
+        compression, level : str, int, optional
+          compression filter and level, see filter_args.
+        chunk_len : int, optional
+          number of events per HDF5 chunk. The default is (1<<16).
+        max_pending_blocks : int, optional
+          the number of blocks (of up to max_buffered_data_len events) that
+          may wait for the writer thread. The default is 64.
+        block : bool, optional
+          if True, the library callback waits for the writer thread when the
+          queue is full; if False, the block is dropped. The default is True.
+        """
+        self.fields = [(name, t) for bit, name, t in scTDC._BUFDATA_FIELDS
+                       if data_field_selection & bit]
+        self.filter = filter_args(compression, level)
+        self.chunk_len = chunk_len
+        self.block = block
+        self._queue = queue.Queue(maxsize=max_pending_blocks)
+        self._file = None
+        self.reset_stats()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+        super().__init__(lib, dev_desc, data_field_selection,
+                         max_buffered_data_len)
+
+    def reset_stats(self):
+        self.stats = {"events_written" : 0,
+                      "bytes_written"  : 0,
+                      "dropped"        : 0,
+                      "blocked_s"      : 0.0,
+                      "max_queue"      : 0,
+                      "write_s"        : 0.0}
+
+    def open(self, filepath, comment=""):
+        """ Opens a new output file. Returns (True, "") if successful or
+        (False, error_message), like Device.hdf5_open. """
+        if self._file is not None:
+            return (False, "an HDF5 file is already open")
+        try:
+            self._file = scan_writer.ScanFileWriter(
+                filepath, self.fields, comment, self.chunk_len,
+                self.filter.get("compression"),
+                self.filter.get("compression_opts"))
+        except (OSError, ValueError) as e:
+            return (False, str(e))
+        return (True, "")
+
+    def close_file(self):
+        """ Waits until all queued events are written and closes the file.
+        Returns (True, "") if successful or (False, error_message). """
+        if self._file is None:
+            return (False, "no HDF5 file is open")
+        self._queue.join()
+        f, self._file = self._file, None
+        f.close()
+        return (True, "")
+
+    def queue_depth(self):
+        """ Number of blocks waiting for the writer thread """
+        return self._queue.qsize()
+
+    def on_data(self, data):
+        if self._file is None or data["data_len"] == 0:
+            return
+        # the library reuses its buffer after returning from this callback
+        blk = {name: np.array(data[name], copy=True)
+               for name, _ in self.fields}
+        try:
+            self._queue.put_nowait(blk)
+        except queue.Full:
+            if not self.block:
+                self.stats["dropped"] += data["data_len"]
+                return
+            t0 = time.perf_counter()
+            self._queue.put(blk)
+            self.stats["blocked_s"] += time.perf_counter() - t0
+        self.stats["max_queue"] = max(self.stats["max_queue"],
+                                      self._queue.qsize())
+
+    def _write_loop(self):
+        while True:
+            blk = self._queue.get()
+            try:
+                if blk is None:
+                    return
+                f = self._file
+                if f is not None:
+                    t0 = time.perf_counter()
+                    f.append(blk)
+                    self.stats["write_s"] += time.perf_counter() - t0
+                    self.stats["events_written"] += len(blk[self.fields[0][0]])
+                    self.stats["bytes_written"] += sum(a.nbytes
+                                                       for a in blk.values())
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        """ Closes the pipe, the output file and stops the writer thread """
+        super().close()
+        if self._file is not None:
+            self.close_file()
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Live histograms of the event data during an acquisition.
+
+HistogramAccumulator bins dif1 (x) and time arrays into a 1D time-of-flight
+histogram and a 2D x-t histogram. Both axes have a region of interest
+(offset, size) in detector units and a bin width; events outside of the ROI
+are ignored. Batches are binned with np.bincount when they are large
+compared to the histogram and with np.add.at otherwise, so that neither a
+small batch on a large image nor a large batch on a small image costs more
+than necessary.
+
+Snapshots are double-buffered. The acquisition thread bins into a pending
+histogram and, at most every 'publish_interval' seconds, adds it to the back
+buffer and swaps back and front buffer. snapshot() only returns references to the front arrays and
+never copies or locks, so a GUI can poll it at 10 Hz. A snapshot stays
+unchanged until the next-but-one publish, i.e. for at least one
+publish_interval, which is enough time to hand it to a plot widget.
+
+LiveHistogramPipe feeds an accumulator from a buffered_data_callbacks_pipe
+and clears it at the start of every measurement. The GUI uses it as the
+preview when the native histogram pipes (preview.NativePreview) cannot be
+opened; poll() makes it a drop-in replacement there.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+import scTDC
+
+
+class HistogramAccumulator(object):
+    """ Accumulates 1D time and 2D x-t histograms of event data """
+    def __init__(self, x_roi=(0, 4096), x_bin=16, t_roi=(0, 8192), t_bin=1,
+                 dtype=np.uint32, publish_interval=0.1):
+        """
+        Parameters
+        ----------
+        x_roi, t_roi : (int, int), optional
+          offset and size of the region of interest in detector units (dif1
+          and time). The defaults are (0, 4096) and (0, 8192).
+        x_bin, t_bin : int, optional
+          bin width in detector units. The defaults are 16 and 1.
+        dtype : numpy dtype, optional
+          the data type of the histograms. The default is np.uint32.
+        publish_interval : float, optional
+          minimum time in seconds between two swaps of the snapshot
+          buffers. The default is 0.1.
+        """
+        self.x_offset, x_size = x_roi
+        self.t_offset, t_size = t_roi
+        self.x_bin = x_bin
+        self.t_bin = t_bin
+        self.nx = x_size // x_bin
+        self.nt = t_size // t_bin
+        self.dtype = np.dtype(dtype)
+        self.publish_interval = publish_interval
+        # [0] front (published), [1] back (updated at the next publish)
+        self._t = [np.zeros(self.nt, self.dtype) for _ in range(2)]
+        self._xt = [np.zeros((self.nx, self.nt), self.dtype) for _ in range(2)]
+        # increments of the back buffer that the front buffer does not have
+        self._pending_t = np.zeros(self.nt, self.dtype)
+        self._pending_xt = np.zeros((self.nx, self.nt), self.dtype)
+        self._lag_t = np.zeros(self.nt, self.dtype)
+        self._lag_xt = np.zeros((self.nx, self.nt), self.dtype)
+        self._lock = threading.Lock() # serializes producers, not readers
+        self._snapshot = (self._t[0], self._xt[0], 0, 0)
+        self._events = 0
+        self._generation = 0
+        self._t_publish = time.perf_counter()
+
+    def _indices(self, x, t):
+        """ Returns the flat t and x-t bin indices of the events in the ROI """
+        t = (np.asarray(t).astype(np.int64) - self.t_offset) // self.t_bin
+        x = (np.asarray(x).astype(np.int64) - self.x_offset) // self.x_bin
+        inside = (t >= 0) & (t < self.nt) & (x >= 0) & (x < self.nx)
+        t = t[inside]
+        return t, x[inside] * self.nt + t
+
+    @staticmethod
+    def _add(hist, idx):
+        flat = hist.reshape(-1)
+        if len(idx) * 8 >= flat.size:
+            flat += np.bincount(idx, minlength=flat.size).astype(
+                flat.dtype, copy=False)
+        else:
+            np.add.at(flat, idx, 1)
+
+    def add(self, x, t):
+        """ Bins one batch of events. x and t are equally long 1D arrays of
+        dif1 and time values. Called from the acquisition thread. """
+        t_idx, xt_idx = self._indices(x, t)
+        with self._lock:
+            self._add(self._pending_t, t_idx)
+            self._add(self._pending_xt, xt_idx)
+            self._events += len(t_idx)
+            if time.perf_counter() - self._t_publish >= self.publish_interval:
+                self._publish()
+
+    def publish(self):
+        """ Makes all binned events visible to snapshot(), e.g. at the end of
+        a measurement """
+        with self._lock:
+            self._publish()
+
+    def _publish(self):
+        back_t, back_xt = self._t[1], self._xt[1]
+        # the back buffer is the front buffer of the previous publish; it is
+        # behind by the increments of that publish (lag) and of this one
+        back_t += self._lag_t
+        back_t += self._pending_t
+        back_xt += self._lag_xt
+        back_xt += self._pending_xt
+        self._t.reverse()
+        self._xt.reverse()
+        self._lag_t, self._pending_t = self._pending_t, self._lag_t
+        self._lag_xt, self._pending_xt = self._pending_xt, self._lag_xt
+        self._pending_t.fill(0)
+        self._pending_xt.fill(0)
+        self._generation += 1
+        # one tuple, so that readers never see arrays of different publishes
+        self._snapshot = (back_t, back_xt, self._events, self._generation)
+        self._t_publish = time.perf_counter()
+
+    def snapshot(self):
+        """ Returns (t_hist, xt_hist, events, generation) of the last
+        publish, without copying. The arrays must be treated as read-only;
+        generation increases with every publish. """
+        return self._snapshot
+
+    def clear(self):
+        """ Sets all histograms to zero """
+        with self._lock:
+            for a in self._t + self._xt + [self._pending_t, self._pending_xt,
+                                           self._lag_t, self._lag_xt]:
+                a.fill(0)
+            self._events = 0
+            self._generation += 1
+            self._snapshot = (self._t[0], self._xt[0], 0, self._generation)
+
+    def t_axis(self):
+        """ Lower edges of the time bins in detector units """
+        return self.t_offset + np.arange(self.nt) * self.t_bin
+
+    def x_axis(self):
+        """ Lower edges of the x bins in detector units """
+        return self.x_offset + np.arange(self.nx) * self.x_bin
+
+
+class LiveHistogramPipe(scTDC.buffered_data_callbacks_pipe):
+    """ Bins the dif1 and time data of all measurements into the
+    HistogramAccumulator 'hist'. The histograms are cleared at the start of
+    every measurement unless 'accumulate' is True. """
+    def __init__(self, lib, dev_desc, max_buffered_data_len=(1<<16),
+                 accumulate=False, **hist_args):
+        self.hist = HistogramAccumulator(**hist_args)
+        self.accumulate = accumulate
+        self._flushing = False
+        super().__init__(lib, dev_desc,
+                         data_field_selection=(scTDC.SC_DATA_FIELD_DIF1
+                                               | scTDC.SC_DATA_FIELD_TIME),
+                         max_buffered_data_len=max_buffered_data_len)
+
+    def on_data(self, data):
+        if ('som_indices' in data and len(data['som_indices'])
+                and not self.accumulate):
+            # only the events after the last start of measurement
+            first = int(data['som_indices'][-1]) - data['event_index']
+            self.hist.clear()
+            self.hist.add(data['dif1'][first:], data['time'][first:])
+        else:
+            self.hist.add(data['dif1'], data['time'])
+        if self._flushing:
+            self._flushing = False
+            self.hist.publish()
+
+    def on_end_of_meas(self):
+        # the remaining events arrive in one more on_data call (if any)
+        self.hist.publish()
+        self._flushing = True
+        return True
+
+    def poll(self):
+        """ Returns hist.snapshot(), as NativePreview.poll (the window is
+        the current measurement) """
+        return self.hist.snapshot()
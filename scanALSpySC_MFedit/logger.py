@@ -1,9 +1,13 @@
 import logging
 import sys
+import threading
 
 from PyQt5.QtCore import QObject,\
+                         QTimer,\
                          pyqtSignal
 
+from PyQt5.QtGui import QTextCursor
+
 from PyQt5.QtWidgets import QDialog, \
                         QVBoxLayout, \
                         QPushButton, \
@@ -13,10 +17,27 @@ from PyQt5.QtWidgets import QDialog, \
 logger = logging.getLogger(__name__)
 
 class XStream(QObject):
+    """ Replacement of sys.stdout / sys.stderr for a Qt log widget. write()
+    may be called from any thread and only appends to a buffer; the text
+    written within interval_ms is emitted as one messageWritten in the GUI
+    thread, so a print per event or per step costs one repaint per batch
+    instead of one per fragment. A batch keeps at most max_lines lines. """
     _stdout = None
     _stderr = None
 
+    interval_ms = 100
+    max_lines = 1000
+
     messageWritten = pyqtSignal(str)
+    _wakeup = pyqtSignal()
+
+    def __init__( self ):
+        super(XStream, self).__init__()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._scheduled = False
+        # direct from the GUI thread, queued from all other threads
+        self._wakeup.connect( self._schedule )
 
     def flush( self ):
         pass
@@ -25,8 +46,29 @@ class XStream(QObject):
         return -1
 
     def write( self, msg ):
-        if ( not self.signalsBlocked() ):
-            self.messageWritten.emit(msg)
+        if ( self.signalsBlocked() ):
+            return
+        with self._lock:
+            self._pending.append(msg)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._wakeup.emit()
+
+    def _schedule( self ):
+        QTimer.singleShot(self.interval_ms, self._emitPending)
+
+    def _emitPending( self ):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._scheduled = False
+        text = ''.join(pending)
+        lines = text.splitlines(True)
+        if len(lines) > self.max_lines:
+            text = ('[... %i lines skipped ...]\n' % (len(lines) - self.max_lines)
+                    + ''.join(lines[-self.max_lines:]))
+        if text:
+            self.messageWritten.emit(text)
 
     @staticmethod
     def stdout():
@@ -42,6 +84,25 @@ class XStream(QObject):
             sys.stderr = XStream._stderr
         return XStream._stderr
 
+def connectLogWidget( widget, max_lines = 5000 ):
+    """ Shows stdout and stderr in the QTextBrowser (or QTextEdit) widget.
+    The document keeps the last max_lines lines, so that it does not grow
+    during long scans; the view follows the end unless scrolled back. """
+    widget.document().setMaximumBlockCount(max_lines)
+    scrollbar = widget.verticalScrollBar()
+
+    def append( text ):
+        at_end = scrollbar.value() >= scrollbar.maximum()
+        cursor = widget.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
+        if at_end:
+            scrollbar.setValue(scrollbar.maximum())
+
+    XStream.stdout().messageWritten.connect( append )
+    XStream.stderr().messageWritten.connect( append )
+    return append
+
 class MyDialog(QDialog):
     def __init__( self, parent = None ):
         super(MyDialog, self).__init__(parent)
@@ -58,8 +119,7 @@ class MyDialog(QDialog):
         self.setLayout(layout)
 
         # create connections
-        XStream.stdout().messageWritten.connect( self._console.insertPlainText )
-        XStream.stderr().messageWritten.connect( self._console.insertPlainText )
+        connectLogWidget( self._console )
 
         self._button.clicked.connect(self.test)
 
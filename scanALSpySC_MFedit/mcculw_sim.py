@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated mcculw backend for write_ports.PhaseShifter.
+
+SimulatedUL provides the subset of mcculw.ul that write_ports uses (device
+inventory, create/release of a device, get_config, digital port
+configuration, d_out, d_in, d_out_array, get_status) for one USB board with
+digital ports A and B. It also provides the enums of mcculw.enums that
+write_ports imports, so that write_ports can be imported on machines without
+the MCC driver.
+
+Every call that would be a USB transaction sleeps for 'latency' seconds
+(get_daq_device_inventory for 'inventory_latency') and is counted in
+'calls'. The phase shifter itself is modelled by latching the 10-bit delay
+code from the port outputs on each rising edge of bit 10 (bit 2 of port B);
+the latched codes are logged in 'latched'.
+
+Usage:
+    ps = write_ports.PhaseShifter(ul_backend=mcculw_sim.SimulatedUL())
+    ps.connect()
+"""
+
+import collections
+import enum
+import time
+
+
+# names as in mcculw.enums; only the members used by write_ports
+class InfoType(enum.IntEnum):
+    BOARDINFO = 1
+    DIGITALINFO = 2
+
+class BoardInfo(enum.IntEnum):
+    DINUMDEVS = 9
+
+class DigitalInfo(enum.IntEnum):
+    DEVTYPE = 2
+    NUMBITS = 6
+    INMASK = 8
+    OUTMASK = 9
+
+class DigitalPortType(enum.IntEnum):
+    AUXPORT = 1
+    FIRSTPORTA = 10
+    FIRSTPORTB = 11
+    FIRSTPORTCL = 12
+    FIRSTPORTCH = 13
+
+class DigitalIODirection(enum.IntEnum):
+    OUT = 1
+    IN = 2
+
+class InterfaceType(enum.IntEnum):
+    USB = 1
+    BLUETOOTH = 2
+    ETHERNET = 4
+    ANY = 7
+
+class FunctionType(enum.IntEnum):
+    AIFUNCTION = 1
+    AOFUNCTION = 2
+    DIFUNCTION = 3
+    DOFUNCTION = 4
+
+
+class ULError(Exception):
+    """ Like mcculw.ul.ULError, with an error code and a message """
+    def __init__(self, errorcode, message=""):
+        super().__init__(errorcode, message)
+        self.errorcode = errorcode
+        self.message = message
+
+    def __str__(self):
+        return "Error %d: %s" % (self.errorcode, self.message)
+
+# error codes of the simulation
+BADBOARD = 1
+BADPORTNUM = 2
+BOARDINUSE = 3
+NOTOUTPUT = 4
+BADFUNCTION = 5
+
+
+class DaqDeviceDescriptor(object):
+    """ Device descriptor as returned by get_daq_device_inventory """
+    def __init__(self, product_name, unique_id, product_id):
+        self.product_name = product_name
+        self.unique_id = unique_id
+        self.product_id = product_id
+
+
+class _Port(object):
+    def __init__(self, port_type, num_bits=8):
+        self.type = port_type
+        self.num_bits = num_bits
+        self.direction = DigitalIODirection.IN
+        self.value = 0
+
+
+class SimulatedUL(object):
+    """ Stand-in for the mcculw.ul module with one digital I/O board """
+    ULError = ULError
+
+    def __init__(self, latency=0.001, inventory_latency=0.5,
+                 present=True, supports_array=True,
+                 product_name="USB-1208LS", unique_id="SIM0001",
+                 product_id=0x7A):
+        """
+        Parameters
+        ----------
+        latency : float, optional
+          seconds per USB transaction. The default is 0.001.
+        inventory_latency : float, optional
+          seconds per device inventory. The default is 0.5.
+        present : bool, optional
+          if False, the inventory is empty. The default is True.
+        supports_array : bool, optional
+          if False, d_out_array fails like on boards without multi-port
+          output. The default is True.
+        """
+        self.latency = latency
+        self.inventory_latency = inventory_latency
+        self.supports_array = supports_array
+        self.descriptor = DaqDeviceDescriptor(product_name, unique_id,
+                                              product_id)
+        self.present = present
+        self.boards = {}      # board number -> descriptor
+        self.ports = [_Port(DigitalPortType.FIRSTPORTA),
+                      _Port(DigitalPortType.FIRSTPORTB)]
+        self.calls = collections.Counter()
+        self.latched = []     # (time, delay code) of every strobe
+        self._strobe = 0
+
+    def _usb(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _board(self, board_num):
+        if board_num not in self.boards:
+            raise ULError(BADBOARD, "Invalid board number")
+
+    def _port(self, port_type):
+        for p in self.ports:
+            if p.type == port_type:
+                return p
+        raise ULError(BADPORTNUM, "Invalid port number")
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.latched = []
+
+    #%% device management
+
+    def ignore_instacal(self):
+        self.calls["ignore_instacal"] += 1
+
+    def get_daq_device_inventory(self, interface_type, number_of_devices=100):
+        self.calls["get_daq_device_inventory"] += 1
+        time.sleep(self.inventory_latency)
+        return [self.descriptor] if self.present else []
+
+    def create_daq_device(self, board_num, descriptor):
+        self._usb("create_daq_device")
+        if board_num in self.boards:
+            raise ULError(BOARDINUSE, "Board number already in use")
+        if not self.present or descriptor.unique_id != \
+                self.descriptor.unique_id:
+            raise ULError(BADBOARD, "Device not found")
+        self.boards[board_num] = descriptor
+
+    def release_daq_device(self, board_num):
+        self.calls["release_daq_device"] += 1
+        self.boards.pop(board_num, None)
+
+    def get_config(self, info_type, board_num, dev_num, config_item):
+        self._usb("get_config")
+        self._board(board_num)
+        if info_type == InfoType.BOARDINFO:
+            if config_item == BoardInfo.DINUMDEVS:
+                return len(self.ports)
+        elif info_type == InfoType.DIGITALINFO:
+            if not 0 <= dev_num < len(self.ports):
+                raise ULError(BADPORTNUM, "Invalid port number")
+            p = self.ports[dev_num]
+            if config_item == DigitalInfo.DEVTYPE:
+                return int(p.type)
+            if config_item == DigitalInfo.NUMBITS:
+                return p.num_bits
+            if config_item in (DigitalInfo.INMASK, DigitalInfo.OUTMASK):
+                return 0 # ports are configurable, not fixed
+        raise ULError(BADFUNCTION, "Unsupported config item")
+
+    def get_status(self, board_num, function_type):
+        self._usb("get_status")
+        raise ULError(BADFUNCTION, "Scans are not supported")
+
+    #%% digital I/O
+
+    def d_config_port(self, board_num, port_type, direction):
+        self._usb("d_config_port")
+        self._board(board_num)
+        self._port(port_type).direction = direction
+
+    def d_config_bit(self, board_num, port_type, bit_num, direction):
+        self._usb("d_config_bit")
+        raise ULError(BADFUNCTION, "Bits are not configurable")
+
+    def _set(self, port_type, data):
+        p = self._port(port_type)
+        if p.direction != DigitalIODirection.OUT:
+            raise ULError(NOTOUTPUT, "Port is not configured for output")
+        p.value = int(data) & ((1 << p.num_bits) - 1)
+        # phase shifter: latch the delay on the rising edge of bit 10
+        a, b = self.ports[0].value, self.ports[1].value
+        strobe = (b >> 2) & 1
+        if strobe and not self._strobe:
+            self.latched.append((time.perf_counter(), ((b & 0x3) << 8) | a))
+        self._strobe = strobe
+
+    def d_out(self, board_num, port_type, data):
+        self._usb("d_out")
+        self._board(board_num)
+        self._set(port_type, data)
+
+    def d_out_array(self, board_num, low_port, high_port, data_array):
+        self._usb("d_out_array")
+        self._board(board_num)
+        if not self.supports_array:
+            raise ULError(BADFUNCTION, "Multi-port output not supported")
+        for i, port_type in enumerate(range(low_port, high_port + 1)):
+            self._set(port_type, data_array[i])
+
+    def d_in(self, board_num, port_type):
+        self._usb("d_in")
+        self._board(board_num)
+        return self._port(port_type).value
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Per-step machine metadata from EPICS monitors.
+
+MetadataSampler subscribes to a list of PVs with monitors, so that the
+values arrive in the background and a scan never waits for a caget. Each
+monitor callback stores (value, timestamp) into the slot of its PV; a single
+list item assignment is atomic, so neither the callbacks nor the scan thread
+take a lock. sample() copies the slots once per step into preallocated
+arrays (a few microseconds for a handful of PVs) together with the age of
+every value at the start of the step.
+
+Scalar PVs are stored as float; waveforms (e.g. SR:BCM:BunchQ, see
+charge_logger.py) are stored as their sum. The step times come from the
+clock of the scan engine (charge_alignment.ClockOffset), whose NTP offset is
+queried once per scan, so the ages compare NTP time with the EPICS
+timestamps.
+"""
+
+import numpy as np
+
+try:
+    from epics import PV
+except ImportError:
+    PV = None
+
+DEFAULT_PVS = ('MOCounter:FREQUENCY',)
+
+
+class MetadataSampler(object):
+    """ Latest values of the PVs 'pvnames', sampled once per scan step.
+    pv_factory(name, callback) creates a monitored PV; the default is
+    epics.PV with auto_monitor. """
+    def __init__(self, pvnames=DEFAULT_PVS, pv_factory=None, capacity=1024):
+        self.pvnames = list(pvnames)
+        if pv_factory is None:
+            if PV is None:
+                raise ImportError("MetadataSampler requires pyepics")
+            pv_factory = lambda name, callback: PV(name, callback=callback,
+                                                   auto_monitor=True)
+        n = len(self.pvnames)
+        self._slots = [(np.nan, np.nan)] * n
+        self._capacity = capacity
+        self.begin()
+        self.pvs = [pv_factory(name, self._callback(i))
+                    for i, name in enumerate(self.pvnames)]
+
+    def _callback(self, i):
+        slots = self._slots
+        def callback(value=None, timestamp=None, **kw):
+            slots[i] = (value, timestamp) # atomic, no lock needed
+        return callback
+
+    def snapshot(self):
+        """ (value, timestamp) of every PV, as of now """
+        return tuple(self._slots)
+
+    def begin(self):
+        """ Clears the step table for a new scan """
+        n = len(self.pvnames)
+        self.index = np.zeros(self._capacity, np.int32)
+        self.t_step = np.zeros(self._capacity, np.float64)
+        self.values = np.full((self._capacity, n), np.nan)
+        self.ages = np.full((self._capacity, n), np.nan)
+        self.nsteps = 0
+
+    def sample(self, index, t_step):
+        """ Stores the current values for step 'index' starting at t_step """
+        snap = tuple(self._slots)
+        k = self.nsteps
+        if k == len(self.index):
+            self.index = np.resize(self.index, 2 * k)
+            self.t_step = np.resize(self.t_step, 2 * k)
+            self.values = np.resize(self.values, (2 * k, len(snap)))
+            self.ages = np.resize(self.ages, (2 * k, len(snap)))
+        self.index[k] = index
+        self.t_step[k] = t_step
+        for j, (value, timestamp) in enumerate(snap):
+            if value is None:
+                value = np.nan
+            elif np.ndim(value):
+                value = np.sum(value)
+            self.values[k, j] = value
+            self.ages[k, j] = t_step - (np.nan if timestamp is None
+                                        else timestamp)
+        self.nsteps = k + 1
+
+    def save(self, path):
+        """ Writes the step table as CSV: index, t_step, then value and age
+        of every PV """
+        k = self.nsteps
+        header = ["index", "t_step"]
+        for name in self.pvnames:
+            header += [name, name + ".age"]
+        table = np.empty((k, 2 + 2 * len(self.pvnames)))
+        table[:, 0] = self.index[:k]
+        table[:, 1] = self.t_step[:k]
+        table[:, 2::2] = self.values[:k]
+        table[:, 3::2] = self.ages[:k]
+        np.savetxt(path, table, delimiter=",", header=",".join(header),
+                   fmt=["%d", "%.6f"] + ["%.9g"] * (2 * len(self.pvnames)))
+
+    def close(self):
+        for pv in self.pvs:
+            pv.clear_callbacks()
+            pv.disconnect()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Live preview from the native histogram pipes of the scTDC library.
+
+NativePreview opens an xt pipe and a t pipe (Device.add_xt_pipe /
+add_t_pipe) next to the HDF5 streaming, so that the binning happens in the
+C library and costs no python CPU time during high-rate runs. The histograms
+are read through Pipe.get_buffer_view, i.e. without copying, typically from a
+GUI timer. With a rolling window, poll() copies the accumulated histograms
+into a ring of 'slices' + 1 snapshots every window_s / slices seconds and
+returns the difference to the oldest one, so that the preview shows the
+last window_s (up to window_s + window_s / slices) seconds instead of
+everything since the device was initialized. The pipes themselves are not
+cleared; the unsigned difference stays correct when a bin wraps around, as
+long as the window holds fewer counts than the depth allows.
+
+snapshot() has the same signature as in
+live_histogram.HistogramAccumulator, so both can feed the same display.
+The ROIs are given in detector units like there; the native pipes need bin
+widths that are powers of 2.
+"""
+
+import time
+
+import numpy as np
+
+import scTDC
+
+
+def binned_roi(roi, binning, name):
+    """ (start, stop) of a ROI in detector units as bin indices of a native
+    pipe; 'name' of the axis is used in the error message if binning is
+    not a power of 2 """
+    if binning < 1 or binning & (binning - 1):
+        raise ValueError("%s binning must be a power of 2" % name)
+    return (roi[0] // binning, roi[1] // binning)
+
+
+class NativePreview(object):
+    """ 1D time and 2D x-t preview histograms binned by the scTDC library """
+    def __init__(self, device, x_roi=(0, 4096), x_bin=16, t_roi=(0, 8192),
+                 t_bin=1, y_roi=(0, 1<<16), depth=scTDC.BS32, window_s=None,
+                 slices=4):
+        """
+        Parameters
+        ----------
+        device : scTDC.Device
+          an initialized device.
+        x_roi, t_roi : (int, int), optional
+          offset and size of the region of interest in detector units.
+          The defaults are (0, 4096) and (0, 8192).
+        x_bin, t_bin : int, optional
+          bin widths, powers of 2. The defaults are 16 and 1.
+        y_roi : (int, int), optional
+          integration range in y. The default accepts all events.
+        depth : int, optional
+          BS8, BS16, BS32 or BS64. The default is BS32.
+        window_s : float, optional
+          if given, poll() returns the histograms of the last window_s
+          seconds. The default is None (accumulate until clear() is called).
+        slices : int, optional
+          number of intervals the rolling window is divided into; the
+          window advances by window_s / slices. Every slice keeps a copy of
+          both histograms. The default is 4.
+        """
+        self.device = device
+        self.window_s = window_s
+        binning = (x_bin, 1, t_bin)
+        roi = (binned_roi(x_roi, x_bin, "x"), y_roi,
+               binned_roi(t_roi, t_bin, "time"))
+        self.x_offset, self.x_bin = x_roi[0], x_bin
+        self.t_offset, self.t_bin = t_roi[0], t_bin
+        self.pipe_ids = []
+        self._xt_pipe = self._add(device.add_xt_pipe(depth, 0, binning, roi))
+        self._t_pipe = self._add(device.add_t_pipe(depth, 0, binning, roi))
+        # zero-copy views, the library updates them during measurements
+        self._xt = self._xt_pipe.get_buffer_view()
+        self._t = self._t_pipe.get_buffer_view()
+        self._generation = 0
+        if window_s is not None:
+            # accumulated histograms at the last slices + 1 slice boundaries,
+            # in the memory layout of the pipe buffers (xt is x-major)
+            self._ring_t = [np.zeros_like(self._t) for _ in range(slices + 1)]
+            self._ring_xt = [np.zeros_like(self._xt)
+                             for _ in range(slices + 1)]
+            self._window_t = np.empty_like(self._t)
+            self._window_xt = np.empty_like(self._xt)
+            self._oldest = 0
+            self._interval = window_s / slices
+        self._t_slice = time.perf_counter()
+
+    def _add(self, result):
+        pipeid, pipe = result
+        if pipeid < 0:
+            self.close()
+            raise RuntimeError("could not open preview pipe: ({}) {}".format(
+                pipe, pipeid))
+        self.pipe_ids.append(pipeid)
+        return pipe
+
+    def snapshot(self):
+        """ Returns (t_hist, xt_hist, events, generation). The arrays must be
+        treated as read-only: without a window, they are views of the pipe
+        buffers, with a window they are reused by the next snapshot(). events
+        is the number of events in the time histogram and generation
+        increases with every clear() and every advance of the window. """
+        if self.window_s is None:
+            return (self._t, self._xt, int(self._t.sum()), self._generation)
+        oldest = self._oldest
+        np.subtract(self._t, self._ring_t[oldest], out=self._window_t)
+        np.subtract(self._xt, self._ring_xt[oldest], out=self._window_xt)
+        return (self._window_t, self._window_xt, int(self._window_t.sum()),
+                self._generation)
+
+    def poll(self):
+        """ Advances the rolling window if a slice has elapsed and returns
+        snapshot(). Intended to be called from a GUI timer. """
+        if (self.window_s is not None
+                and time.perf_counter() - self._t_slice >= self._interval):
+            # the oldest slot becomes the newest, the next one the base
+            np.copyto(self._ring_t[self._oldest], self._t)
+            np.copyto(self._ring_xt[self._oldest], self._xt)
+            self._oldest = (self._oldest + 1) % len(self._ring_t)
+            self._generation += 1
+            self._t_slice = time.perf_counter()
+        return self.snapshot()
+
+    def clear(self):
+        """ Sets the preview histograms to zero """
+        self._xt_pipe.clear()
+        self._t_pipe.clear()
+        if self.window_s is not None:
+            for a in self._ring_t + self._ring_xt:
+                a.fill(0)
+        self._generation += 1
+        self._t_slice = time.perf_counter()
+
+    def t_axis(self):
+        """ Lower edges of the time bins in detector units """
+        return self.t_offset + self.t_bin * np.arange(len(self._t))
+
+    def x_axis(self):
+        """ Lower edges of the x bins in detector units """
+        return self.x_offset + self.x_bin * np.arange(
+            self._xt.shape[0])
+
+    def close(self):
+        """ Removes the preview pipes from the device """
+        for pipeid in self.pipe_ids:
+            self.device.remove_pipe(pipeid)
+        self.pipe_ids = []
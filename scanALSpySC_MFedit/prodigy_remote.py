@@ -1,22 +1,172 @@
+"""
+Client for the remote control protocol of SpecsLab Prodigy (TCP port 7010).
+
+Requests are lines '?XXXX Command Arguments' with a 4-digit hex tag, and the
+server answers each of them with one line '!XXXX OK...' or '!XXXX Error...'
+carrying the same tag. The client therefore does not have to wait for a
+response before sending the next request: a reader thread splits the
+incoming byte stream into lines and resolves the future of the request with
+the matching tag. Several requests can be outstanding at once (see
+request() and pipeline()), so that loops over many parameters cost about one
+round trip instead of one per parameter.
+
+Prodigy accepts only one client connection, so the client keeps a single
+persistent socket. It is opened on the first request; if the connection
+breaks, outstanding requests fail with ConnectionError, and the next request
+reconnects (and repeats 'Connect' if the session had been connected).
+
+The ParameterCache keeps the analyzer parameter names, their info (type,
+unit, limits) and the last known values, and is pickled to disk so that it
+survives restarts. setVoltagesDirectly only sends the parameters that differ
+from the cached values (numbers by more than the cache tolerance), because
+every setting starts a ramp of the analyzer high voltages. Since Prodigy
+itself may change values, the cached values are read back on connect and
+dropped whenever the connection is reopened or Prodigy answers with an
+error.
+"""
+
+import concurrent.futures
+import itertools
+import os
+import pickle
+import re
 import socket
+import threading
+import time
 from timeit import default_timer as timer
 
+# Key:value pairs of a response, values may be "quoted" or [lists]
+_FIELD = re.compile(r'(\w+):("[^"]*"|\[[^\]]*\]|\S+)')
+
+
+def parse_fields(resp):
+    """ Returns the Key:value pairs after 'OK:' of a response line as a
+    dictionary of strings (quotes are kept) """
+    if isinstance(resp, bytes):
+        resp = resp.decode('ascii', 'replace')
+    return dict(_FIELD.findall(resp.partition('OK:')[2]))
+
+
+# ControllerState values of GetAcquisitionStatus in which the controller is
+# not working; any other state (running, paused, validating, ...) is busy
+_READY_STATES = ('idle', 'finished', 'aborted', 'error')
+
+
+def _normalize(value):
+    """ Parameter values as comparable python objects: numbers as float,
+    everything else as string without quotes """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value).strip('"')
+
+
+def _reached(value, target, tolerance):
+    """ True if the read-back value is a number within tolerance of target.
+    A missing or non-numeric value (e.g. during a reconnect) counts as not
+    reached yet. """
+    value = _normalize(value)
+    if not isinstance(value, float):
+        return False
+    return abs(value - float(target)) <= tolerance
+
+
+class ParameterCache(object):
+    """ Analyzer parameter names, info and last known values, persisted in a
+    pickle file. Parameter names are stored without quotes. Numbers that
+    differ by at most tolerance (absolute, in the unit of the parameter)
+    count as unchanged. """
+    def __init__(self, path=None, tolerance=1e-6):
+        self.path = path
+        self.tolerance = tolerance
+        self.server = None  # Connect response fields, identifies the server
+        self.names = []
+        self.info = {}      # name -> dict of GetAnalyzerParameterInfo fields
+        self.values = {}    # name -> last value set or read back
+        self.load()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, mode='rb') as f:
+                d = pickle.load(f)
+            self.server, self.names = d['server'], d['names']
+            self.info, self.values = d['info'], d['values']
+        except (OSError, EOFError, KeyError, pickle.UnpicklingError) as e:
+            print('Ignoring the parameter cache %s: %s' % (self.path, e))
+
+    def save(self):
+        if self.path is None:
+            return
+        with open(self.path, mode='wb') as f:
+            pickle.dump({'server' : self.server, 'names'  : self.names,
+                         'info'   : self.info,   'values' : self.values}, f)
+
+    def update_server(self, server, names):
+        """ Drops all cached data if the server or its parameter list has
+        changed. Returns True if the cache was invalidated. """
+        if server == self.server and names == self.names:
+            return False
+        self.server, self.names = server, list(names)
+        self.info, self.values = {}, {}
+        return True
+
+    def limits(self, name):
+        """ (minimum, maximum) of a numeric parameter, or None """
+        r = self.info.get(name, {}).get('ValueRange')
+        if r is None:
+            return None
+        lo, _, hi = r.strip('[]').partition(',')
+        return (float(lo), float(hi))
+
+    def _same(self, cached, value):
+        if isinstance(cached, float) and isinstance(value, float):
+            return abs(cached - value) <= self.tolerance
+        return cached == value
+
+    def changed(self, settings):
+        """ Returns the items of settings (quoted names like in
+        analyzr_volts) whose values differ from the cached values """
+        return {k: v for k, v in settings.items()
+                if k.strip('"') not in self.values
+                or not self._same(self.values[k.strip('"')], _normalize(v))}
+
+    def set_values(self, settings):
+        for k, v in settings.items():
+            self.values[k.strip('"')] = _normalize(v)
+
+    def invalidate(self, settings=None):
+        """ Forgets the values of the given (or all) parameters """
+        if settings is None:
+            self.values = {}
+        for k in settings or ():
+            self.values.pop(k.strip('"'), None)
 
 
 class ProdigyRemote(object):
 
-    def __init__(self, debug=True):
+    def __init__(self, debug=True, host=None, port=7010, timeout=30,
+                 max_outstanding=32, cache_path=None):
 
         self.DEBUG = debug
 
         self.connected = False
         
-        self.TCP_IP   = socket.gethostname()
-        self.TCP_PORT = 7010
+        self.TCP_IP   = socket.gethostname() if host is None else host
+        self.TCP_PORT = port
+        self.timeout  = timeout
+        self.max_outstanding = max_outstanding
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((self.TCP_IP, self.TCP_PORT))
-        self.sock.settimeout(30) # fifteen seconds timeout
+        self.sock = None
+        self._reader = None
+        self._lock = threading.Lock()     # socket and tag bookkeeping
+        self._pending = {}                # tag -> (future, send time)
+        self._slots = threading.Semaphore(max_outstanding)
+        self._tags = itertools.cycle(range(0x0001, 0xFFFF))
+        self.cache = ParameterCache(cache_path)
+        # cleared by waitForRamp if Prodigy rejects GetAcquisitionStatus
+        self.hasAcquisitionStatus = True
 
         self.analyzr_volts = {'"LensMode"'                : '"LargeArea"',
                               '"ScanRange"'               : '"3.5kV"',
@@ -91,83 +241,328 @@ class ProdigyRemote(object):
 # <><>        self.allParams = self.getParams()
 
 
-    def sendAndReceive(self, comd, tag=0x0100):
-        cmdStr = b'?%04X '%tag + comd + b'\n'
-#       cmdStr = cmdStr.encode('ascii')
-        print(cmdStr)
-        self.sock.sendall( cmdStr ) 
-        resp = None
-        beg = timer()
-        while not resp:
-            resp = self.sock.recv(2048)
-        end = timer()
-#       resp = resp.decode('ascii')
+    #%% Transport
+
+    def _open(self):
+        """ Opens the socket and starts the reader thread (lock held) """
+        sock = socket.create_connection((self.TCP_IP, self.TCP_PORT),
+                                        timeout=self.timeout)
+        sock.settimeout(None) # the reader thread blocks in recv
+        # requests are small; do not let Nagle hold them back for an ACK
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self._reader = threading.Thread(target=self._read_loop, args=(sock,),
+                                        daemon=True)
+        self._reader.start()
 
+    def _close(self, exc=None):
+        """ Closes the socket and fails all outstanding requests """
+        with self._lock:
+            sock, self.sock = self.sock, None
+            pending, self._pending = self._pending, {}
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        for fut, _ in pending.values():
+            self._slots.release()
+            if not fut.done():
+                fut.set_exception(exc or ConnectionError('connection closed'))
+
+    def _read_loop(self, sock):
+        buf = b''
+        try:
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                buf += chunk
+                *lines, buf = buf.split(b'\n')
+                for line in lines:
+                    self._dispatch(line.rstrip(b'\r'))
+        except OSError:
+            pass
+        if sock is self.sock:
+            self._close(ConnectionError('connection to Prodigy lost'))
+
+    def _dispatch(self, line):
+        if len(line) < 5 or line[:1] != b'!':
+            if self.DEBUG:
+                print('Unexpected response:', line)
+            return
+        try:
+            tag = int(line[1:5], 16)
+        except ValueError:
+            return
+        with self._lock:
+            entry = self._pending.pop(tag, None)
+        if entry is None:
+            if self.DEBUG:
+                print('Response with unknown tag:', line)
+            return
+        fut, beg = entry
+        self._slots.release()
         if self.DEBUG:
-            print('Response took %4.2f millisecs' % ((end-beg)*1e3) )
+            print('Response took %4.2f millisecs' % ((timer()-beg)*1e3) )
+        fut.set_result(line)
 
+    def request(self, comd, tag=None):
+        """ Sends a command without waiting for the response. Returns a
+        concurrent.futures.Future with the response line (bytes, without
+        the line break). Blocks while max_outstanding requests are
+        pending. tag is chosen automatically unless given. """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError('too many outstanding requests')
+        fut = concurrent.futures.Future()
+        try:
+            with self._lock:
+                if self.sock is None:
+                    self._open()
+                if tag is None or tag in self._pending:
+                    tag = next(t for t in self._tags if t not in self._pending)
+                cmdStr = b'?%04X '%tag + comd + b'\n'
+                if self.DEBUG:
+                    print(cmdStr)
+                self._pending[tag] = (fut, timer())
+                self.sock.sendall( cmdStr )
+        except OSError as e:
+            # _close fails (and releases) the request if it was registered
+            with self._lock:
+                registered = self._pending.get(tag, (None,))[0] is fut
+            if not registered:
+                self._slots.release()
+            self._close(ConnectionError(str(e)))
+            raise ConnectionError(str(e))
+        return fut
+
+    def _check(self, resp):
         if resp.find(b'OK') < 0:
-#           return cmdStr
+            # the state of the analyzer is uncertain after any error
+            self.cache.invalidate()
             raise RuntimeError( resp.decode('ascii') ) 
-
         return resp
 
+    def _reconnect(self):
+        """ Reopens the connection and restores the Prodigy session. The
+        cached values are dropped, since Prodigy may have changed them. """
+        self._close()
+        self.cache.invalidate()
+        if self.connected:
+            self._check(self.request(b'Connect').result(self.timeout))
+
+    def sendAndReceive(self, comd, tag=None):
+        """ Sends a command and waits for its response. Raises RuntimeError
+        if Prodigy reports an error. If the connection breaks, it is
+        reopened once and the command is repeated. """
+        for attempt in (0, 1):
+            try:
+                resp = self.request(comd, tag).result(self.timeout)
+                break
+            except ConnectionError:
+                if attempt:
+                    raise
+                self._reconnect()
+            except concurrent.futures.TimeoutError:
+                self._close(ConnectionError('Prodigy did not respond'))
+                raise TimeoutError('no response to ' + comd.decode('ascii'))
+        return self._check(resp)
+
+    def pipeline(self, comds):
+        """ Sends all commands before waiting for the first response and
+        returns the responses in the same order. Raises RuntimeError for
+        the first command that failed. Commands that were lost with a
+        broken connection are sent again once after reconnecting. """
+        comds = list(comds)
+        resps = [None] * len(comds)
+        todo = list(range(len(comds)))
+        for attempt in (0, 1):
+            futs = []
+            try:
+                for i in todo:
+                    futs.append((i, self.request(comds[i])))
+            except ConnectionError:
+                if attempt:
+                    raise
+            lost = []
+            for i, f in futs:
+                try:
+                    resps[i] = f.result(self.timeout)
+                except ConnectionError:
+                    if attempt:
+                        raise
+                    lost.append(i)
+            sent = set(i for i, _ in futs)
+            todo = lost + [i for i in todo if i not in sent]
+            if not todo:
+                break
+            self._reconnect()
+        return [self._check(r) for r in resps]
+
+    #%% Commands
 
     def connect(self, ):
         try:
-            _ = self.sendAndReceive(b'Connect', tag=0x0100)
+            resp = self.sendAndReceive(b'Connect', tag=0x0100)
             self.connected = True
             print('Connected to Prodigy.')
-        except:
-            pass
+        except (RuntimeError, OSError) as e:
+            print('Could not connect to Prodigy:', e)
+            return
+        try:
+            self.syncCache(parse_fields(resp))
+        except (RuntimeError, OSError) as e:
+            print('Could not read the analyzer parameters:', e)
+
+    def syncCache(self, server=None):
+        """ Brings the parameter cache up to date: the parameter info is only
+        requested if the server or its parameter names changed, the values
+        are always read back (in one pipeline), since they may have been
+        changed in Prodigy itself. """
+        names = self.getParams()
+        quoted = [n.decode('ascii') for n in names]
+        if self.cache.update_server(server or self.cache.server,
+                                    [n.strip('"') for n in quoted]):
+            print('Parameter cache invalidated, reading parameter info.')
+        missing = [n for n in names
+                   if n.decode('ascii').strip('"') not in self.cache.info]
+        if missing:
+            infos = self.pipeline(
+                [b'GetAnalyzerParameterInfo ParameterName:' + parm
+                 for parm in missing])
+            for parm, resp in zip(missing, infos):
+                self.cache.info[parm.decode('ascii').strip('"')] = \
+                    parse_fields(resp)
+        values = {}
+        for resp in self.getParamValues(names):
+            f = parse_fields(resp)
+            if 'Name' in f and 'Value' in f:
+                values[f['Name']] = f['Value']
+        self.cache.values = {}
+        self.cache.set_values(values)
+        self.cache.save()
 
     def disconnect(self, ):
         try:
             _ = self.sendAndReceive(b'Disconnect', tag=0xFFFF)
             print('Disconnected.')
-            self.connected = False
-        except: 
+        except (RuntimeError, OSError):
             pass
+        self.connected = False
+        self._close()
 
     def getParams(self, ):
         resp = self.sendAndReceive(b'GetAllAnalyzerParameterNames', tag=0x0110)
-        allParams = resp.split(b'[')[-1][:-1].rstrip(b']').split(b',')
+        allParams = resp.split(b'[')[-1].rstrip(b']').split(b',')
+        self.allParams = allParams
         return allParams
     
     def printAllParams(self):
-        for parm in self.allParams:
-            resp = self.sendAndReceive(b'GetAnalyzerParameterInfo ParameterName:' + parm)
+        for resp in self.pipeline(
+                [b'GetAnalyzerParameterInfo ParameterName:' + parm
+                 for parm in self.allParams]):
             print(resp)
 
+    def getParamValues(self, params=None):
+        """ Returns a list with the GetAnalyzerParameterValue responses of
+        all (or the given) parameter names, requested in one pipeline """
+        params = self.allParams if params is None else params
+        return self.pipeline(
+            [b'GetAnalyzerParameterValue ParameterName:' + parm
+             for parm in params])
+
     def printAllParamValues(self):
-        for parm in self.allParams:
-            resp = self.sendAndReceive(b'GetAnalyzerParameterValue ParameterName:' + parm)
+        for resp in self.getParamValues():
             print(resp)
         
     def setSafeState(self, ):
+        self.cache.invalidate() # all voltages ramp down
         _ = self.sendAndReceive(b'SetSafeState', tag=0x0FFF)
+        self.cache.save()
 
     def setVoltagesDirectly(self, 
-                            kinEng=615, passEng=50,  ):
+                            kinEng=615, passEng=50, force=False):
+        """ Sends the entries of analyzr_volts that differ from the last
+        known values (all of them if force is True). Returns the dictionary
+        of the parameters that were sent. """
         self.analyzr_volts['"Kinetic Energy"'] = kinEng
         self.analyzr_volts['"Pass Energy"'] = passEng
 
+        changed = (dict(self.analyzr_volts) if force
+                   else self.cache.changed(self.analyzr_volts))
+        if not changed:
+            if self.DEBUG:
+                print('Voltages unchanged, nothing sent.')
+            return changed
 
-        s  = [ ':'.join([ str(k), str(self.analyzr_volts[k]) ])
-              for k in self.analyzr_volts]
-#       s += [ ':'.join([ str(k), str(self.prelens_volts[k]) ])
-#             for k in self.prelens_volts]
+        s  = [ ':'.join([ str(k), str(changed[k]) ])
+              for k in changed]
         s = ' '.join(s)
-#       return ' '.join(s)
-#       print(b'test' + bytes(s))
-        pass
-#       print(s)
-        self.sendAndReceive(b'SetAnalyzerParameterValueDirectly ' + s.encode('ascii') , tag=0x010A)
+        try:
+            self.sendAndReceive(b'SetAnalyzerParameterValueDirectly ' + s.encode('ascii') , tag=0x010A)
+        except (RuntimeError, OSError):
+            self.cache.invalidate(changed) # state of these is unknown now
+            self.cache.save()
+            raise
+        self.cache.set_values(changed)
+        self.cache.save()
+        return changed
         
+    def waitForRamp(self, targets, tolerance=0.01, timeout=60.0,
+                    interval=0.05, min_time=1.0):
+        """ Polls Prodigy until the given parameters (quoted names like in
+        analyzr_volts) read back their target values within tolerance, the
+        controller state is one of _READY_STATES and at least min_time
+        seconds have passed. Status and values are requested in one pipeline
+        per poll. GetAnalyzerParameterValue may return the set value before
+        the voltages have ramped, and the controller state need not reflect
+        a ramp, so min_time is the lower bound of the wait (the fixed sleep
+        of the old scans). Returns True when done, False after timeout
+        seconds. """
+        names = [k.encode('ascii') for k in targets]
+        comds = [b'GetAcquisitionStatus'] + [
+            b'GetAnalyzerParameterValue ParameterName:' + n for n in names]
+        beg = timer()
+        while True:
+            use_status = self.hasAcquisitionStatus
+            try:
+                resps = self.pipeline(comds if use_status else comds[1:])
+            except RuntimeError:
+                if not use_status:
+                    raise
+                try: # the status or one of the values failed?
+                    self.sendAndReceive(comds[0])
+                except RuntimeError:
+                    # no status; rely on the read-back and min_time only
+                    self.hasAcquisitionStatus = False
+                    continue
+                raise
+            if use_status:
+                state = parse_fields(resps[0]).get('ControllerState')
+                busy = (state is not None
+                        and state.strip('"').lower() not in _READY_STATES)
+                resps = resps[1:]
+            else:
+                busy = False
+            reached = all(
+                _reached(parse_fields(r).get('Value'), v, tolerance)
+                for r, v in zip(resps, targets.values()))
+            elapsed = timer() - beg
+            if reached and not busy and elapsed >= min_time:
+                self.cache.set_values(targets)
+                return True
+            if elapsed > timeout:
+                return False
+            time.sleep(interval if elapsed >= min_time
+                       else min(interval, min_time - elapsed))
+
     def startFEscan(self):
         self.sendAndReceive(b'DefineSpectrumFE')
 
 
 if __name__ == '__main__':
     pr = ProdigyRemote()
+    pr.connect()
+    pr.allParams = pr.getParams()
     pr.printAllParams()
+    pr.disconnect()
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the remote control server of SpecsLab Prodigy.
+
+ProdigySimulator is a TCP server that speaks the line protocol of Prodigy
+('?XXXX Command Arguments' -> '!XXXX OK...' / '!XXXX Error: code "text"')
+for the commands used by prodigy_remote.py and the GUI:
+
+    Connect, Disconnect, GetAllAnalyzerParameterNames,
+    GetAnalyzerParameterInfo, GetAnalyzerParameterValue,
+    SetAnalyzerParameterValueDirectly, SetSafeState, DefineSpectrumFE,
+    GetAcquisitionStatus
+
+Analyzer voltages do not change at once: numeric parameters ramp linearly
+towards a new value at 'ramp_rate' units per second (or within
+'ramp_time' seconds), GetAnalyzerParameterValue returns the momentary value
+and GetAcquisitionStatus reports ControllerState:busy while any parameter
+is ramping.
+
+Timing and faults are configurable:
+  processing_time  seconds per request, requests of one connection are
+                   processed one after the other like in Prodigy,
+  latency          additional delay of every response (plus a uniform
+                   random 'jitter'); it does not block the next request,
+                   so pipelined clients only pay it once,
+  error_rate       probability that a request fails with an error response,
+  fail_commands    command names that always fail,
+  drop_after       close the connection after this many requests, to test
+                   reconnection.
+
+Run stand-alone on the default port, e.g. for 190709_check_conn2Prodigy.py
+or the GUI:
+    python prodigy_sim.py --latency 0.005 --ramp-rate 500
+"""
+
+import argparse
+import heapq
+import random
+import re
+import socket
+import threading
+import time
+
+# name -> (type, unit, minimum, maximum, initial value); strings have the
+# allowed values instead of minimum/maximum
+DEFAULT_PARAMETERS = {
+    "LensMode"               : ("string", "", ("SmallArea", "LargeArea",
+                                               "Accelerating"), None,
+                                "SmallArea"),
+    "ScanRange"              : ("string", "", ("1.5kV", "3.5kV"), None,
+                                "1.5kV"),
+    "Polarity"               : ("string", "", ("negative", "positive"), None,
+                                "negative"),
+    "Kinetic Energy"         : ("double", "eV", 0.0, 3500.0, 0.0),
+    "Pass Energy"            : ("double", "eV", 1.0, 200.0, 50.0),
+    "Detector Voltage"       : ("double", "V", 0.0, 3000.0, 0.0),
+    "DLD Voltage"            : ("double", "V", 0.0, 3000.0, 0.0),
+    "Bias Voltage Electrons" : ("double", "V", 0.0, 500.0, 0.0),
+    "Bias Voltage Ions"      : ("double", "V", -3000.0, 3000.0, 0.0),
+    "Focus Displacement 1"   : ("double", "", -1.0, 1.0, 0.0),
+    "Focus Displacement 2"   : ("double", "", -1.0, 1.0, 0.0),
+    "Coil Current"           : ("double", "mA", -100.0, 100.0, 0.0),
+    "Aux Voltage"            : ("double", "V", -100.0, 100.0, 0.0),
+    "Deflection X"           : ("double", "", -1.0, 1.0, 0.0),
+    "Deflection Y"           : ("double", "", -1.0, 1.0, 0.0),
+    "Pre Defl X"             : ("double", "", -1.0, 1.0, 0.0),
+    "Pre Defl Y"             : ("double", "", -1.0, 1.0, 0.0),
+    "L1"                     : ("double", "", -1.0, 1.0, 0.0),
+    "L2"                     : ("double", "", -1.0, 1.0, 0.0),
+    "Stigmator"              : ("double", "", -1.0, 1.0, 0.0),
+}
+
+# error codes of the responses
+ERR_UNKNOWN_COMMAND = 1
+ERR_NOT_CONNECTED = 2
+ERR_BAD_PARAMETER = 3
+ERR_BAD_VALUE = 4
+ERR_INJECTED = 100
+
+# "Name":value, ParameterName:"Name" and Key:value pairs of the arguments
+_PAIR = re.compile(r'("[^"]*"|[A-Za-z]+):("[^"]*"|\[[^\]]*\]|\S+)')
+
+
+class _Ramp(object):
+    """ Linear ramp of one numeric parameter """
+    def __init__(self, value):
+        self.start = self.target = float(value)
+        self.t0 = self.t1 = 0.0
+
+    def value(self, now):
+        if now >= self.t1 or self.t1 <= self.t0:
+            return self.target
+        f = (now - self.t0) / (self.t1 - self.t0)
+        return self.start + f * (self.target - self.start)
+
+    def set(self, target, now, rate, ramp_time):
+        self.start = self.value(now)
+        self.target = float(target)
+        if ramp_time is not None:
+            duration = ramp_time
+        elif rate:
+            duration = abs(self.target - self.start) / rate
+        else:
+            duration = 0.0
+        self.t0, self.t1 = now, now + duration
+
+
+class ProdigySimulator(object):
+    """ TCP server emulating the Prodigy remote control protocol """
+    def __init__(self, host="127.0.0.1", port=0, processing_time=0.0,
+                 latency=0.0, jitter=0.0, ramp_rate=None, ramp_time=None,
+                 error_rate=0.0, fail_commands=(), drop_after=None,
+                 parameters=None, seed=None, verbose=False):
+        self.address = (host, port)
+        self.processing_time = processing_time
+        self.latency = latency
+        self.jitter = jitter
+        self.ramp_rate = ramp_rate
+        self.ramp_time = ramp_time
+        self.error_rate = error_rate
+        self.fail_commands = set(fail_commands)
+        self.drop_after = drop_after
+        self.verbose = verbose
+        self.params = dict(DEFAULT_PARAMETERS if parameters is None
+                           else parameters)
+        self.values = {}
+        for name, (typ, _, _, _, initial) in self.params.items():
+            self.values[name] = _Ramp(initial) if typ == "double" else initial
+        self.spectrum = None
+        self.requests = 0           # all requests, for tests and benchmarks
+        self.log = []               # (name, value) of every applied setting
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._conns = []
+
+    #%% Server
+
+    def start(self):
+        """ Starts listening in a background thread. Returns (host, port). """
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(self.address)
+        self._server.listen(1)
+        self.address = self._server.getsockname()
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self.address
+
+    def stop(self):
+        """ Closes the server and all client connections """
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for conn in self._conns:
+            self._shutdown(conn)
+        self._conns = []
+
+    def _accept_loop(self):
+        while self._server is not None:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._conns.append(conn)
+            threading.Thread(target=self._serve, args=(conn,),
+                             daemon=True).start()
+
+    @staticmethod
+    def _shutdown(conn):
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+            conn.close()
+        except OSError:
+            pass
+
+    def _serve(self, conn):
+        outbox = []  # heap of (due time, sequence number, response)
+        cond = threading.Condition()
+        closed = [False]
+        sender = threading.Thread(target=self._send_loop,
+                                  args=(conn, outbox, cond, closed),
+                                  daemon=True)
+        sender.start()
+        session = {"connected" : False, "requests" : 0}
+        buf = b""
+        seq = 0
+        try:
+            while True:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                buf += chunk
+                *lines, buf = buf.split(b"\n")
+                for line in lines:
+                    line = line.rstrip(b"\r").decode("ascii", "replace")
+                    if not line:
+                        continue
+                    if self.processing_time:
+                        time.sleep(self.processing_time)
+                    resp = self.handle(line, session)
+                    due = time.perf_counter() + self.latency
+                    if self.jitter:
+                        due += self._rng.uniform(0, self.jitter)
+                    with cond:
+                        heapq.heappush(outbox, (due, seq, resp))
+                        seq += 1
+                        cond.notify()
+                    session["requests"] += 1
+                    if (self.drop_after is not None
+                            and session["requests"] >= self.drop_after):
+                        raise ConnectionAbortedError("drop_after reached")
+        except OSError:
+            pass
+        with cond:
+            closed[0] = True
+            cond.notify()
+        sender.join()
+        self._shutdown(conn)
+
+    def _send_loop(self, conn, outbox, cond, closed):
+        while True:
+            with cond:
+                while not outbox and not closed[0]:
+                    cond.wait()
+                if not outbox:
+                    return
+                due, _, resp = outbox[0]
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    cond.wait(delay)
+                    continue
+                heapq.heappop(outbox)
+            if closed[0] and self.drop_after is not None:
+                return # the connection is dropped, responses are lost
+            try:
+                conn.sendall(resp.encode("ascii") + b"\n")
+            except OSError:
+                return
+
+    #%% Protocol
+
+    def handle(self, line, session):
+        """ Returns the response line for one request line """
+        with self._lock:
+            self.requests += 1
+        if self.verbose:
+            print(line)
+        if len(line) < 6 or line[0] != "?":
+            return '!0000 Error: %d "Malformed request"' % ERR_UNKNOWN_COMMAND
+        tag, _, rest = line[1:].partition(" ")
+        command, _, args = rest.strip().partition(" ")
+        if command in self.fail_commands or (
+                self.error_rate and self._rng.random() < self.error_rate):
+            return self._error(tag, ERR_INJECTED, "Injected error")
+        handler = getattr(self, "_cmd_" + command, None)
+        if handler is None:
+            return self._error(tag, ERR_UNKNOWN_COMMAND,
+                               "Unknown command " + command)
+        if command != "Connect" and not session["connected"]:
+            return self._error(tag, ERR_NOT_CONNECTED, "Not connected")
+        with self._lock:
+            result = handler(args, session)
+        if isinstance(result, tuple):
+            return self._error(tag, *result)
+        return "!%s OK%s" % (tag, ": " + result if result else "")
+
+    @staticmethod
+    def _error(tag, code, text):
+        return '!%s Error: %d "%s"' % (tag, code, text)
+
+    @staticmethod
+    def _pairs(args):
+        return [(k.strip('"'), v.strip('"')) for k, v in _PAIR.findall(args)]
+
+    def _value(self, name, now=None):
+        v = self.values[name]
+        if isinstance(v, _Ramp):
+            return v.value(time.perf_counter() if now is None else now)
+        return v
+
+    def _format(self, name, value):
+        if self.params[name][0] == "double":
+            return "%g" % value
+        return '"%s"' % value
+
+    def _cmd_Connect(self, args, session):
+        session["connected"] = True
+        return 'ServerName:"SpecsLab Prodigy (simulated)" ProtocolVersion:1.2'
+
+    def _cmd_Disconnect(self, args, session):
+        session["connected"] = False
+        return ""
+
+    def _cmd_GetAllAnalyzerParameterNames(self, args, session):
+        return "ParameterNames:[%s]" % ",".join('"%s"' % n
+                                                for n in self.params)
+
+    def _parameter_name(self, args):
+        pairs = dict(self._pairs(args))
+        name = pairs.get("ParameterName")
+        if name not in self.params:
+            return None
+        return name
+
+    def _cmd_GetAnalyzerParameterInfo(self, args, session):
+        name = self._parameter_name(args)
+        if name is None:
+            return (ERR_BAD_PARAMETER, "Unknown parameter")
+        typ, unit, lo, hi, _ = self.params[name]
+        if typ == "double":
+            limits = "ValueRange:[%g,%g]" % (lo, hi)
+        else:
+            limits = "Values:[%s]" % ",".join('"%s"' % v for v in lo)
+        return 'Name:"%s" ValueType:%s Unit:"%s" %s' % (name, typ, unit,
+                                                       limits)
+
+    def _cmd_GetAnalyzerParameterValue(self, args, session):
+        name = self._parameter_name(args)
+        if name is None:
+            return (ERR_BAD_PARAMETER, "Unknown parameter")
+        return 'Name:"%s" Value:%s' % (name, self._format(name,
+                                                          self._value(name)))
+
+    def _check_value(self, name, value):
+        """ Returns the converted value or an error tuple """
+        if name not in self.params:
+            return (ERR_BAD_PARAMETER, "Unknown parameter " + name)
+        typ, _, lo, hi, _ = self.params[name]
+        if typ != "double":
+            if value not in lo:
+                return (ERR_BAD_VALUE, "Invalid value for " + name)
+            return value
+        try:
+            value = float(value)
+        except ValueError:
+            return (ERR_BAD_VALUE, "Invalid value for " + name)
+        if not lo <= value <= hi:
+            return (ERR_BAD_VALUE, "%s out of range" % name)
+        return value
+
+    def _cmd_SetAnalyzerParameterValueDirectly(self, args, session):
+        pairs = self._pairs(args)
+        d = dict(pairs)
+        if "ParameterName" in d: # protocol form ParameterName:"X" Value:v
+            pairs = [(d["ParameterName"], d.get("Value", ""))]
+        if not pairs:
+            return (ERR_BAD_PARAMETER, "No parameters given")
+        checked = []
+        for name, value in pairs:
+            value = self._check_value(name, value)
+            if isinstance(value, tuple):
+                return value # nothing is applied if one value is invalid
+            checked.append((name, value))
+        now = time.perf_counter()
+        for name, value in checked:
+            v = self.values[name]
+            if isinstance(v, _Ramp):
+                v.set(value, now, self.ramp_rate, self.ramp_time)
+            else:
+                self.values[name] = value
+            self.log.append((name, value))
+        return ""
+
+    def _cmd_SetSafeState(self, args, session):
+        now = time.perf_counter()
+        for name, v in self.values.items():
+            if isinstance(v, _Ramp):
+                # zero, or the nearest allowed value (Pass Energy >= 1 eV)
+                _, _, vmin, vmax, _ = self.params[name]
+                v.set(min(max(0.0, vmin), vmax), now, self.ramp_rate,
+                      self.ramp_time)
+        self.log.append(("SafeState", None))
+        return ""
+
+    def _cmd_DefineSpectrumFE(self, args, session):
+        self.spectrum = dict(self._pairs(args))
+        return ""
+
+    def _cmd_GetAcquisitionStatus(self, args, session):
+        return "ControllerState:%s" % ("busy" if self.is_ramping() else "idle")
+
+    def is_ramping(self):
+        """ True while any parameter is ramping """
+        now = time.perf_counter()
+        return any(isinstance(v, _Ramp) and now < v.t1
+                   for v in self.values.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="")
+    parser.add_argument("--port", type=int, default=7010)
+    parser.add_argument("--processing-time", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--ramp-rate", type=float, default=None,
+                        help="ramp speed of all voltages [units/s]")
+    parser.add_argument("--ramp-time", type=float, default=None,
+                        help="fixed duration of every ramp [s]")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--fail", nargs="*", default=[],
+                        help="commands that always fail")
+    parser.add_argument("--drop-after", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    sim = ProdigySimulator(args.host, args.port, args.processing_time,
+                           args.latency, args.jitter, args.ramp_rate,
+                           args.ramp_time, args.error_rate, args.fail,
+                           args.drop_after, verbose=args.verbose)
+    print("Prodigy simulator listening on %s:%d" % sim.start())
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
+
+
+if __name__ == "__main__":
+    main()
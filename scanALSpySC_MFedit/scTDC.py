@@ -37,6 +37,8 @@ for backwards compatibility.
 The buffered_data_callbacks_pipe improves the performance by buffering a
 user-defined number of events and invoking callbacks into python code after
 filling this buffer and optionally at the end of each measurement.
+The ringbuffer_pipe builds on it and copies each batch of events once into
+preallocated, growable ring buffers that other threads read via cursors.
 The buffer size can be tuned large enough to reduce the number of callbacks
 into python code. The data offered in the callbacks are in the form of 1D
 numpy arrays --- one array for one selected event data field --- ready to be
@@ -70,12 +72,22 @@ Additions 2020-05-14 : added wrapper for a separate library to save DLD
                        events to HDF5
 Additions 2021-06-15 : added support for BUFFERED_DATA_CALLBACKS pipe
                        (requires scTDC1 library version >= 1.3010.0)
+Additions 2026-10-18 : added EventRingBuffer and ringbuffer_pipe as a fast
+                       path for event data (Device.add_ringbuffer_pipe)
+Additions 2026-10-18 : added futures for measurements (Device.measure_future,
+                       Device.measure_async, MeasurementEngine); synchronous
+                       measurements wait for the end-of-measurement callback
+                       instead of sleeping and polling
 """
 
 __version__ = "1.2.0"
 
+import asyncio
+import concurrent.futures
 import ctypes
 import os
+import queue
+import threading
 import time
 import traceback
 try: # most stuff works without numpy
@@ -279,6 +291,20 @@ class sc_pipe_buf_callbacks_params_t(ctypes.Structure):
               ("version",               ctypes.c_int),
               ("reserved",              ctypes.c_ubyte * 24)]
 
+def _wait_until_idle(lib, dev_desc, done, time_ms):
+    """ Blocks until the measurement on dev_desc has finished. done is a
+    threading.Event that is set by an end-of-measurement callback; it wakes
+    the caller as soon as the library reports the end of the measurement.
+    The status is only polled (at 1 ms intervals) to cover the remaining data
+    processing and as a fallback if the callback never arrives. """
+    done.wait(time_ms/1000.0 + _EOM_GRACE_S)
+    while lib.sc_tdc_get_status2(dev_desc) == 1:
+        time.sleep(0.001)
+
+# how long to wait for an end-of-measurement callback beyond the exposure time
+# before falling back to status polling
+_EOM_GRACE_S = 1.0
+
 def copy_statistics(s):
     assert(type(s)==statistics_t)
     r = statistics_t()
@@ -554,6 +580,7 @@ class buffered_data_callbacks_pipe(object):
         self.dev_desc = dev_desc
         self.lib = lib
         self._pipe_desc = None
+        self._meas_done = threading.Event()
         self._open_pipe(data_field_selection, max_buffered_data_len,
                         dld_events)
 
@@ -562,7 +589,7 @@ class buffered_data_callbacks_pipe(object):
         p = sc_pipe_buf_callbacks_params_t()
         p.priv = None
         self._cb_data = CB_BUFDATA_DATA(lambda x, y : self._data_cb(y))
-        self._cb_eom = CB_BUFDATA_END_OF_MEAS(lambda x : self.on_end_of_meas())
+        self._cb_eom = CB_BUFDATA_END_OF_MEAS(lambda x : self._eom_cb())
         p.data = self._cb_data
         p.end_of_measurement = self._cb_eom
         p.data_field_selection = data_field_selection
@@ -575,6 +602,11 @@ class buffered_data_callbacks_pipe(object):
         self._pipe_desc = self.lib.sc_pipe_open2(
             self.dev_desc, BUFFERED_DATA_CALLBACKS, p)
 
+    def _eom_cb(self):
+        result = self.on_end_of_meas()
+        self._meas_done.set()
+        return result
+
     def _data_cb(self, dptr):
         d = dptr.contents
         x = {"event_index" : d.event_index, "data_len" : d.data_len}
@@ -675,12 +707,11 @@ class buffered_data_callbacks_pipe(object):
             0 on success or a negative error code.
 
         """
+        self._meas_done.clear()
         retcode = self.lib.sc_tdc_start_measure2(self.dev_desc, time_ms)
         if retcode < 0:
             return retcode
-        time.sleep(time_ms/1000.0) # sleep expects floating point seconds
-        while self.lib.sc_tdc_get_status2(self.dev_desc) == 1:
-            time.sleep(0.01)
+        _wait_until_idle(self.lib, self.dev_desc, self._meas_done, time_ms)
         return 0
 
     def start_measurement(self, time_ms, retries=3):
@@ -716,6 +747,285 @@ class buffered_data_callbacks_pipe(object):
                 return -11
             time.sleep(0.001)
 
+# (field selection bit, field name, element type) for every event data field
+# of the BUFFERED_DATA_CALLBACKS pipe, in the order of sc_pipe_buf_callback_args
+_BUFDATA_FIELDS = [
+    (SC_DATA_FIELD_SUBDEVICE,          "subdevice",          ctypes.c_uint),
+    (SC_DATA_FIELD_CHANNEL,            "channel",            ctypes.c_uint),
+    (SC_DATA_FIELD_START_COUNTER,      "start_counter",      ctypes.c_ulonglong),
+    (SC_DATA_FIELD_TIME_TAG,           "time_tag",           ctypes.c_uint),
+    (SC_DATA_FIELD_DIF1,               "dif1",               ctypes.c_uint),
+    (SC_DATA_FIELD_DIF2,               "dif2",               ctypes.c_uint),
+    (SC_DATA_FIELD_TIME,               "time",               ctypes.c_ulonglong),
+    (SC_DATA_FIELD_MASTER_RST_COUNTER, "master_rst_counter", ctypes.c_uint),
+    (SC_DATA_FIELD_ADC,                "adc",                ctypes.c_int),
+    (SC_DATA_FIELD_SIGNAL1BIT,         "signal1bit",         ctypes.c_ushort)]
+
+class EventRingBuffer(object):
+    """ Growable ring buffer for event data, written by exactly one producer
+    (usually the callback thread of the scTDC library) and read by any number
+    of consumers through RingBufferCursor objects.
+    Positions are absolute, monotonically increasing event counts. The
+    producer only publishes its write position after the data has been
+    copied, and it never overwrites data that has not been read by the
+    slowest cursor. Instead, the buffer is enlarged (up to max_capacity) or,
+    if that is not possible, the incoming batch is dropped and counted in
+    the 'dropped' attribute. Therefore, readers do not need any locks.
+    """
+    def __init__(self, fields, capacity=(1<<20), max_capacity=(1<<26),
+                 layout="columnar"):
+        """
+        Parameters
+        ----------
+        fields : list
+          list of (name, type) pairs, where type is a ctypes type or anything
+          else that numpy accepts as dtype.
+        capacity : int, optional
+          the initial number of events that fit into the buffer.
+          The default is (1<<20).
+        max_capacity : int, optional
+          the buffer is never enlarged beyond this number of events.
+          The default is (1<<26).
+        layout : str, optional
+          "columnar" allocates one contiguous array per field, "structured"
+          allocates one numpy record array with one record per event.
+          The default is "columnar".
+
+        Returns
+        -------
+        None.
+        """
+        assert layout in ("columnar", "structured")
+        self.names = [name for name, _ in fields]
+        self.dtypes = [np.dtype(t) for _, t in fields]
+        self.layout = layout
+        self.max_capacity = max(capacity, max_capacity)
+        self.write_position = 0
+        self.dropped = 0
+        self._cursors = []
+        self._store = self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        if self.layout == "structured":
+            records = np.empty(capacity, dtype=list(zip(self.names,
+                                                        self.dtypes)))
+            columns = [records[name] for name in self.names]
+        else:
+            records = None
+            columns = [np.empty(capacity, dtype=t) for t in self.dtypes]
+        # the store is replaced as a whole, such that readers always see a
+        # consistent (capacity, columns, records, addresses) tuple; the column
+        # addresses are cached because numpy's .ctypes attribute is slow
+        addresses = [c.ctypes.data for c in columns]
+        return (capacity, columns, records, addresses)
+
+    @property
+    def capacity(self):
+        return self._store[0]
+
+    @property
+    def records(self):
+        """ The underlying record array for the "structured" layout (None for
+        the "columnar" layout). Only the range of positions that has not been
+        read by all cursors is guaranteed to hold valid data. """
+        return self._store[2]
+
+    def add_cursor(self, from_start=False):
+        """ Returns a new RingBufferCursor. If from_start is False, the cursor
+        starts at the current write position, i.e. it only sees events that
+        are appended afterwards. """
+        cursor = RingBufferCursor(self, self.write_position if not from_start
+                                  else self._oldest_position())
+        self._cursors = self._cursors + [cursor] # atomic replacement
+        return cursor
+
+    def remove_cursor(self, cursor):
+        self._cursors = [c for c in self._cursors if c is not cursor]
+
+    def _oldest_position(self):
+        cursors = self._cursors
+        if not cursors:
+            return self.write_position
+        return min(c.position for c in cursors)
+
+    def _ensure_free(self, n):
+        capacity = self._store[0]
+        oldest = self._oldest_position()
+        if self.write_position + n - oldest <= capacity:
+            return True
+        newcap = capacity
+        while self.write_position + n - oldest > newcap:
+            newcap *= 2
+        if newcap > self.max_capacity:
+            return False
+        capacity, columns = self._store[:2]
+        store = self._allocate(newcap)
+        for src, dst in zip(columns, store[1]):
+            live = self._gather(src, capacity, oldest, self.write_position)
+            self._scatter(dst, newcap, oldest, live)
+        self._store = store
+        return True
+
+    @staticmethod
+    def _gather(col, capacity, start, stop):
+        i0 = start % capacity
+        n = stop - start
+        if i0 + n <= capacity:
+            return col[i0:i0+n]
+        return np.concatenate((col[i0:], col[:n-(capacity-i0)]))
+
+    @staticmethod
+    def _scatter(col, capacity, start, src):
+        i0 = start % capacity
+        n = len(src)
+        first = min(n, capacity - i0)
+        col[i0:i0+first] = src[:first]
+        if first < n:
+            col[:n-first] = src[first:]
+
+    @staticmethod
+    def _memmove_in(dst, size, capacity, start, addr, n):
+        i0 = start % capacity
+        first = min(n, capacity - i0)
+        ctypes.memmove(dst + i0*size, addr, first*size)
+        if first < n:
+            ctypes.memmove(dst, addr + first*size, (n-first)*size)
+
+    def append(self, n, sources):
+        """ Copies n events into the buffer. sources is a sequence with one
+        entry per field (in the order of the fields given to the constructor),
+        each entry being either a numpy array or a ctypes pointer to the first
+        element. Entries that are None or NULL pointers leave the
+        corresponding field untouched. Returns False if the events had to be
+        dropped. Must only be called from a single (producer) thread. """
+        if n <= 0:
+            return True
+        if not self._ensure_free(n):
+            self.dropped += n
+            return False
+        capacity, columns, records, addresses = self._store
+        pos = self.write_position
+        for col, dst, src in zip(columns, addresses, sources):
+            if src is None:
+                continue
+            if isinstance(src, np.ndarray):
+                self._scatter(col, capacity, pos, src[:n])
+            elif not src: # NULL pointer
+                continue
+            elif records is None:
+                self._memmove_in(dst, col.itemsize, capacity, pos,
+                                 ctypes.addressof(src.contents), n)
+            else:
+                self._scatter(col, capacity, pos,
+                              np.ctypeslib.as_array(src, shape=(n,)))
+        self.write_position = pos + n # publish only after copying
+        return True
+
+    def clear(self):
+        """ Discards all unread data. Producer thread only. """
+        for c in self._cursors:
+            c.position = self.write_position
+
+
+class RingBufferCursor(object):
+    """ Read cursor of an EventRingBuffer. Each consumer thread should use
+    its own cursor. Obtain cursors via EventRingBuffer.add_cursor. """
+    def __init__(self, ring, position):
+        self.ring = ring
+        self.position = position
+
+    def available(self):
+        """ Returns the number of events that can be read """
+        return self.ring.write_position - self.position
+
+    def read(self, max_len=None):
+        """ Returns a dictionary of numpy arrays (copies) with the events
+        between the cursor position and the current write position (or at
+        most max_len events) and advances the cursor. """
+        stop = self.ring.write_position # read before the store!
+        capacity, columns = self.ring._store[:2]
+        if max_len is not None:
+            stop = min(stop, self.position + max_len)
+        start = self.position
+        result = {}
+        for name, col in zip(self.ring.names, columns):
+            result[name] = np.array(EventRingBuffer._gather(
+                col, capacity, start, stop), copy=True)
+        self.position = stop
+        return result
+
+    def skip(self, n=None):
+        """ Advances the cursor by n events without reading them (by default,
+        up to the current write position). """
+        stop = self.ring.write_position
+        if n is not None:
+            stop = min(stop, self.position + n)
+        self.position = stop
+
+    def close(self):
+        """ Detaches the cursor, so that it no longer holds back the
+        producer. """
+        self.ring.remove_cursor(self)
+
+
+class ringbuffer_pipe(buffered_data_callbacks_pipe):
+    """ BUFFERED_DATA_CALLBACKS pipe that copies every batch of events once
+    into EventRingBuffer objects, without building dictionaries of numpy
+    arrays in the library callback. Other threads consume the data through
+    cursors, for example
+      cursor = pipe.events.add_cursor()
+      ...
+      data = cursor.read()   # dict of numpy arrays, one per selected field
+    The attribute 'events' holds the selected event data fields, the
+    attributes 'ms_indices' and 'som_indices' hold the event indices of
+    millisecond count ups and of starts of measurements (single field named
+    like the attribute).
+    Subclasses may override on_end_of_meas as in the base class; on_data is
+    not called.
+    """
+    def __init__(self,
+                 lib,
+                 dev_desc,
+                 data_field_selection=SC_DATA_FIELD_TIME,
+                 max_buffered_data_len=(1<<16),
+                 dld_events=True,
+                 capacity=(1<<22),
+                 max_capacity=(1<<26),
+                 layout="columnar"):
+        """
+        Parameters are the same as for buffered_data_callbacks_pipe, plus
+        capacity, max_capacity and layout which are passed on to the
+        EventRingBuffer for the event data (see there). The buffers for the
+        indexing arrays are sized to 1/16 of the event buffer.
+        """
+        fields = [(name, t) for bit, name, t in _BUFDATA_FIELDS
+                  if data_field_selection & bit]
+        self._field_names = [name for name, _ in fields]
+        self.events = EventRingBuffer(fields, capacity, max_capacity, layout)
+        idxcap = max(capacity >> 4, 1024)
+        self.ms_indices = EventRingBuffer(
+            [("ms_indices", ctypes.c_ulonglong)], idxcap, max_capacity >> 4)
+        self.som_indices = EventRingBuffer(
+            [("som_indices", ctypes.c_ulonglong)], idxcap, max_capacity >> 4)
+        super().__init__(lib, dev_desc, data_field_selection,
+                         max_buffered_data_len, dld_events)
+
+    def _data_cb(self, dptr):
+        d = dptr.contents
+        if d.data_len:
+            self.events.append(d.data_len,
+                               [getattr(d, name) for name in self._field_names])
+        if d.ms_indices_len:
+            self.ms_indices.append(d.ms_indices_len, (d.ms_indices,))
+        if d.som_indices_len:
+            self.som_indices.append(d.som_indices_len, (d.som_indices,))
+
+    @property
+    def dropped(self):
+        """ Number of events that were dropped, because the slowest reader
+        fell behind by more than max_capacity events """
+        return self.events.dropped
+
 class usercallbacks_pipe(object):
     """ Base class for user implementations of the "USER_CALLBACKS" interface.
     Derive from this class and override some or all of the methods
@@ -732,13 +1042,14 @@ class usercallbacks_pipe(object):
         self.dev_desc = dev_desc
         self.lib = lib
         self._pipe_desc = None
+        self._meas_done = threading.Event()
         self._open_pipe()
 
     def _open_pipe(self):
         p = sc_pipe_callbacks()
         p.priv = None
         p.start_of_measure = CB_STARTMEAS(lambda x : self.on_start_of_meas())
-        p.end_of_measure = CB_ENDMEAS(lambda x : self.on_end_of_meas())
+        p.end_of_measure = CB_ENDMEAS(lambda x : self._eom_cb())
         p.millisecond_countup = CB_MILLISEC(lambda x : self.on_millisecond())
         p.tdc_event = CB_TDCEVENT(lambda x, y, z : self.on_tdc_event(y, z))
         p.dld_event = CB_DLDEVENT(lambda x, y, z : self.on_dld_event(y, z))
@@ -751,11 +1062,15 @@ class usercallbacks_pipe(object):
         self._pipe_desc = self.lib.sc_pipe_open2(self.dev_desc, USER_CALLBACKS,
                                                  p2)
 
+    def _eom_cb(self):
+        self.on_end_of_meas()
+        self._meas_done.set()
+
     def do_measurement(self, time_ms):
-        self.lib.sc_tdc_start_measure2(self.dev_desc, time_ms)
-        time.sleep(time_ms/1000.0) # sleep expects floating point seconds
-        while self.lib.sc_tdc_get_status2(self.dev_desc) == 1:
-            time.sleep(0.01)
+        self._meas_done.clear()
+        if self.lib.sc_tdc_start_measure2(self.dev_desc, time_ms) < 0:
+            return
+        _wait_until_idle(self.lib, self.dev_desc, self._meas_done, time_ms)
 
     def on_start_of_meas(self):
         pass
@@ -816,15 +1131,29 @@ class HDF5DataSelection:
         self.value = self.value & (~value)
 
 class Device(object):
-    def __init__(self, inifilepath="tdc_gpx3.ini", autoinit=True, lib=None):
+    def __init__(self, inifilepath="tdc_gpx3.ini", autoinit=True, lib=None,
+                 libh5=None):
         """ Creates a Device object that will use the specified inifilepath
         during initialization. If autoinit==True, initialize the hardware
-        immediately. lib can be specified to reuse an existing scTDClib object.
+        immediately. lib can be specified to reuse an existing scTDClib object,
+        libh5 to use an existing scTDC_hdf5lib object in hdf5_enable.
         """
         self.inifilepath = inifilepath
+        if libh5 is not None:
+            self.libh5 = libh5
         self.dev_desc = None
         self.pipes = {}
         self.eomcb = {} # end of measurement callbacks
+        self._meas_done = threading.Event()
+        # futures of running measurements as (measurement number, future);
+        # a measurement with number n ends with the n-th end-of-measurement
+        # callback, so a late callback of the previous measurement never
+        # completes the future of the next one
+        self._lock = threading.Lock()
+        self._pending = []
+        self._started = 0      # measurements started through this Device
+        self._completed = 0    # end-of-measurement callbacks (not early)
+        self._last_reason = 0
         if lib is None:
             self.lib = scTDClib()
         else:
@@ -844,8 +1173,19 @@ class Device(object):
             # register end of measurement callback
             if not hasattr(self, "_eomcbfobj"):
                 def _eomcb(privptr, reason):
-                    for i in self.eomcb.keys():
+                    for i in list(self.eomcb.keys()):
                         self.eomcb[i](reason)
+                    if reason != CBR_EARLY_NOTIF:
+                        self._meas_done.set()
+                        with self._lock:
+                            self._completed += 1
+                            self._last_reason = reason
+                            done = [f for n, f in self._pending
+                                    if n <= self._completed]
+                            self._pending = [(n, f) for n, f in self._pending
+                                             if n > self._completed]
+                        if done:
+                            self._resolve_when_idle(done, reason)
                 self._eomcbfobj = CB_COMPLETE(_eomcb) # extend lifetime!
             ret2 = self.lib.sc_tdc_set_complete_callback2(self.dev_desc, None,
                                                    self._eomcbfobj)
@@ -854,6 +1194,22 @@ class Device(object):
                 print(" message:", self.lib.sc_get_err_msg(ret2))
             return (0, "")
 
+    def _resolve_when_idle(self, pending, reason):
+        """ Completes the futures of measure_future with reason once the
+        device is idle. The library may still process the last data after
+        the complete callback (see _wait_until_idle), so the status is polled
+        first; from a helper thread, because the library thread that runs
+        the callback may be the one that still has to finish. """
+        def resolve():
+            while self.lib.sc_tdc_get_status2(self.dev_desc) == 1:
+                time.sleep(0.001)
+            for f in pending:
+                f.set_result(reason)
+        if self.lib.sc_tdc_get_status2(self.dev_desc) != 1:
+            resolve()
+        else:
+            threading.Thread(target=resolve, daemon=True).start()
+
     def deinitialize(self):
         """ Deinitialize the hardware. Returns a tuple, containing an error
         code and a human-readable error message (zero and empty string in case
@@ -878,21 +1234,68 @@ class Device(object):
         """ Returns True, if the device is initialized """
         return self.dev_desc is not None
 
+    def _register_start(self, fut=None):
+        """ Counts a successfully started measurement and ties fut (if
+        given) to its end-of-measurement callback. If that callback has
+        already arrived, fut is completed right away. """
+        with self._lock:
+            self._started += 1
+            if fut is None:
+                return
+            if self._started > self._completed:
+                self._pending.append((self._started, fut))
+                return
+            reason = self._last_reason
+        self._resolve_when_idle([fut], reason)
+
     def do_measurement(self, time_ms=100, synchronous=False):
         """ Perform a measurement. If synchronous is True, block until the
         measurement has finished. Returns a tuple (0, "") in case of success,
         or a negative error code and a string with the error message.
         """
+        self._meas_done.clear()
         retcode = self.lib.sc_tdc_start_measure2(self.dev_desc, time_ms)
         if retcode < 0:
             return (retcode, self.lib.sc_get_err_msg(retcode))
         else:
+            self._register_start()
             if synchronous:
-                time.sleep(time_ms/1000.0)
-                while self.lib.sc_tdc_get_status2(self.dev_desc) == 1:
-                    time.sleep(0.01)
+                _wait_until_idle(self.lib, self.dev_desc, self._meas_done,
+                                 time_ms)
             return (0, "")
 
+    def measure_future(self, time_ms=100, retries=3):
+        """ Starts a measurement without blocking and returns a
+        concurrent.futures.Future. The future completes after the
+        end-of-measurement callback, once the device status is idle (i.e.
+        the library has finished processing the data of the measurement);
+        its result is the callback reason
+        (CBR_COMPLETE, CBR_USER_ABORT, CBR_BUFFER_FULL). If the measurement
+        cannot be started, the future is already done and its result is the
+        negative error code. A "not ready" error (-11) directly after the end
+        of the previous measurement is retried up to retries times with 1 ms
+        sleeps in between. """
+        fut = concurrent.futures.Future()
+        fut.set_running_or_notify_cancel()
+        self._meas_done.clear()
+        while True:
+            retcode = self.lib.sc_tdc_start_measure2(self.dev_desc, time_ms)
+            if retcode != -11 or retries <= 0:
+                break
+            retries -= 1
+            time.sleep(0.001)
+        if retcode < 0:
+            fut.set_result(retcode)
+        else:
+            self._register_start(fut)
+        return fut
+
+    async def measure_async(self, time_ms=100, retries=3):
+        """ Coroutine version of measure_future, for use with asyncio.
+        Returns the callback reason or a negative error code. """
+        return await asyncio.wrap_future(self.measure_future(time_ms,
+                                                             retries))
+
     def interrupt_measurement(self):
         """ Interrupt a measurement that was started with synchronous=False.
         Returns a tuple (0, "") in case of success, or a negative error code
@@ -1098,6 +1501,29 @@ class Device(object):
         else:
             return pipe # return id and object
 
+    def add_ringbuffer_pipe(self, data_field_selection=SC_DATA_FIELD_TIME,
+                            max_buffered_data_len=(1<<16), dld_events=True,
+                            capacity=(1<<22), max_capacity=(1<<26),
+                            layout="columnar"):
+        """ Adds a BUFFERED_DATA_CALLBACKS pipe that copies the selected event
+        data fields into growable ring buffers (see ringbuffer_pipe and
+        EventRingBuffer). This is the recommended way to process event data
+        in python at high count rates. Returns a tuple containing a
+        non-negative pipe ID on success and the ringbuffer_pipe object --- or
+        negative error code and a string containing the error message."""
+        for i in range(1000):
+            if i not in self.pipes:
+                pipe = ringbuffer_pipe(self.lib, self.dev_desc,
+                                       data_field_selection,
+                                       max_buffered_data_len, dld_events,
+                                       capacity, max_capacity, layout)
+                if pipe._pipe_desc < 0:
+                    return (pipe._pipe_desc,
+                            self.lib.sc_get_err_msg(pipe._pipe_desc))
+                self.pipes[i] = pipe
+                return (i, pipe)
+        return (-1, "Too many pipes open")
+
     def remove_pipe(self, pipeid):
         """ Remove a pipe specified by the pipe ID as returned in the first
         entry of a tuple by all add_XXX_pipe functions. Note that deinitialize
@@ -1192,6 +1618,66 @@ class Device(object):
             return self.libh5.version()
 
 
+class MeasurementEngine(object):
+    """ Runs measurements of a Device back to back from a worker thread,
+    such that the calling thread (e.g. a GUI event loop) never blocks.
+    Each call to submit returns a concurrent.futures.Future; submit_async is
+    the asyncio counterpart. The next queued measurement is started as soon
+    as the end-of-measurement callback of the previous one has arrived, so
+    the dead time between exposures is limited to the optional 'before'
+    action of the next item. The dead times are recorded (in seconds) in the
+    dead_times list.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.dead_times = []
+        self._last_end = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, time_ms, before=None):
+        """ Queues a measurement of time_ms milliseconds. before is an
+        optional callable that is executed in the worker thread directly
+        before the measurement is started (for example, moving a delay
+        stage). The returned future's result is the callback reason, or a
+        negative error code if the measurement could not be started; if
+        'before' raises, the future carries that exception. """
+        fut = concurrent.futures.Future()
+        self._queue.put((fut, time_ms, before))
+        return fut
+
+    async def submit_async(self, time_ms, before=None):
+        """ Coroutine version of submit, for use with asyncio. """
+        return await asyncio.wrap_future(self.submit(time_ms, before))
+
+    def shutdown(self, wait=True):
+        """ Stops the worker thread after the queued measurements. """
+        self._queue.put(None)
+        if wait:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fut, time_ms, before = item
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                if before is not None:
+                    before()
+            except Exception as e:
+                fut.set_exception(e)
+                continue
+            if self._last_end is not None:
+                self.dead_times.append(time.perf_counter() - self._last_end)
+            reason = self.device.measure_future(time_ms).result()
+            self._last_end = time.perf_counter() if reason >= 0 else None
+            fut.set_result(reason)
+
+
 class Pipe(object):
     """ Pipe objects are used to let the scTDC library construct 1D, 2D, 3D
     histograms from DLD events occuring during measurements, or to collect
@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated stand-in for the scTDC1 library.
+
+The class scTDClib_sim offers the same methods as scTDC.scTDClib
+(sc_tdc_init_inifile, sc_pipe_open2, sc_tdc_start_measure2, ...) but does not
+load any shared library. Instead, a measurement thread generates Poisson
+distributed DLD events with a configurable count rate, x/y and time-of-flight
+distribution and bunch structure, and feeds them into the opened pipes:
+  * USER_CALLBACKS (per-millisecond and per-event-batch callbacks),
+  * BUFFERED_DATA_CALLBACKS (including ms_indices and som_indices),
+  * 1D/2D/3D histogram pipes and the statistics pipe, via their allocator
+    callbacks, like the real library.
+The end-of-measurement callback (sc_tdc_set_complete_callback2) is invoked
+from the measurement thread as well.
+
+Usage:
+    import scTDC, scTDC_sim
+    lib = scTDC_sim.scTDClib_sim(rate=2e6, bunch_offsets=(0, 2624))
+    device = scTDC.Device(inifilepath="tdc_gpx3.ini", lib=lib)
+
+With realtime=False, measurements run as fast as the event generation and
+the python consumers allow, which is what throughput benchmarks need. The
+number of events that have been generated is counted in the 'generated'
+attribute.
+
+scTDC_hdf5lib_sim stands in for scTDC.scTDC_hdf5lib, so that
+Device.hdf5_enable/hdf5_open/hdf5_close succeed without the vendor library:
+    device = scTDC.Device(lib=lib, libh5=scTDC_sim.scTDC_hdf5lib_sim())
+It only keeps the streamer state; no HDF5 files are written (the python-side
+writers, scan_writer and event_writer, do write files).
+"""
+
+import ctypes
+import threading
+import time
+
+import numpy as np
+
+import scTDC
+
+# error codes returned by the simulated library
+ERR_NOT_INIT   = -1
+ERR_BAD_PARAM  = -2
+ERR_NO_PIPE    = -3
+ERR_NOT_READY  = -11 # same code as the "not ready" error of scTDC1
+
+_ERR_MSGS = {ERR_NOT_INIT  : "simulated device is not initialized",
+             ERR_BAD_PARAM : "invalid parameter",
+             ERR_NO_PIPE   : "unknown pipe handle",
+             ERR_NOT_READY : "not ready, measurement in progress"}
+
+_DLD_EVENT_DTYPE = np.dtype(scTDC.dld_event_t)
+
+_HISTO_TYPES = (scTDC.DLD_IMAGE_XY, scTDC.DLD_IMAGE_XT, scTDC.DLD_IMAGE_YT,
+                scTDC.DLD_IMAGE_3D, scTDC.DLD_SUM_HISTO, scTDC.TDC_HISTO)
+
+
+class EventGenerator(object):
+    """ Generates DLD events for one millisecond at a time. The number of
+    events per millisecond is Poisson distributed with mean rate/1000. Each
+    event belongs to one of the bunches in bunch_offsets (chosen at random,
+    weighted by bunch_weights) and gets a time-of-flight drawn from a normal
+    distribution (tof_center, tof_width) on top of the bunch offset. A
+    fraction 'background' of the events is distributed uniformly in time
+    over one bunch_period. x and y are drawn from normal distributions and
+    clipped to the detector size. start_rate is the number of start pulses
+    per second (by default, the ALS ring revolution frequency). All times
+    are in TDC time bins. """
+    def __init__(self, rate=1e5, x_center=2048, x_width=400, y_center=2048,
+                 y_width=400, detector_size=4096, tof_center=1000,
+                 tof_width=50, bunch_offsets=(0,), bunch_weights=None,
+                 bunch_period=5248, start_rate=1.524e6, background=0.05,
+                 seed=None):
+        self.rate = rate
+        self.x_center = x_center
+        self.x_width = x_width
+        self.y_center = y_center
+        self.y_width = y_width
+        self.detector_size = detector_size
+        self.tof_center = tof_center
+        self.tof_width = tof_width
+        self.bunch_offsets = np.asarray(bunch_offsets, dtype=np.float64)
+        if bunch_weights is None:
+            self.bunch_weights = None
+        else:
+            w = np.asarray(bunch_weights, dtype=np.float64)
+            self.bunch_weights = w / w.sum()
+        self.bunch_period = bunch_period
+        self.start_rate = start_rate
+        self.background = background
+        self.rng = np.random.default_rng(seed)
+        self.start_counter = 0
+
+    def millisecond(self):
+        """ Returns a dictionary with one array per event data field (named
+        like the fields of the BUFFERED_DATA_CALLBACKS pipe) for the events
+        of one millisecond. """
+        rng = self.rng
+        n = rng.poisson(self.rate * 1e-3)
+        bunch = rng.choice(len(self.bunch_offsets), size=n,
+                           p=self.bunch_weights)
+        t = self.bunch_offsets[bunch] + rng.normal(self.tof_center,
+                                                   self.tof_width, n)
+        bg = rng.random(n) < self.background
+        t[bg] = rng.random(np.count_nonzero(bg)) * self.bunch_period
+        size = self.detector_size - 1
+        x = np.clip(rng.normal(self.x_center, self.x_width, n), 0, size)
+        y = np.clip(rng.normal(self.y_center, self.y_width, n), 0, size)
+        nstarts = max(int(self.start_rate * 1e-3), 1)
+        sc = self.start_counter + np.sort(rng.integers(0, nstarts, n))
+        self.start_counter += nstarts
+        zeros32 = np.zeros(n, dtype=np.uint32)
+        return {"subdevice"          : zeros32,
+                "channel"            : zeros32,
+                "start_counter"      : sc.astype(np.uint64),
+                "time_tag"           : (sc & 0xFFFFFFFF).astype(np.uint32),
+                "dif1"               : x.astype(np.uint32),
+                "dif2"               : y.astype(np.uint32),
+                "time"               : np.maximum(t, 0).astype(np.uint64),
+                "master_rst_counter" : zeros32,
+                "adc"                : np.zeros(n, dtype=np.int32),
+                "signal1bit"         : np.zeros(n, dtype=np.uint16)}
+
+
+class _UserCallbacksPipe(object):
+    def __init__(self, params):
+        self.cbs = params.callbacks.contents
+
+    def start(self):
+        if self.cbs.start_of_measure:
+            self.cbs.start_of_measure(self.cbs.priv)
+
+    def millisecond(self):
+        if self.cbs.millisecond_countup:
+            self.cbs.millisecond_countup(self.cbs.priv)
+
+    def events(self, ev):
+        n = len(ev["time"])
+        if n == 0 or not self.cbs.dld_event:
+            return
+        arr = (scTDC.dld_event_t * n)()
+        view = np.frombuffer(arr, dtype=_DLD_EVENT_DTYPE)
+        view["start_counter"] = ev["start_counter"]
+        view["time_tag"] = ev["time_tag"]
+        view["subdevice"] = ev["subdevice"]
+        view["channel"] = ev["channel"]
+        view["sum"] = ev["time"]
+        view["dif1"] = ev["dif1"]
+        view["dif2"] = ev["dif2"]
+        self.cbs.dld_event(self.cbs.priv, arr, n)
+
+    def end(self, stats):
+        if self.cbs.statistics:
+            self.cbs.statistics(self.cbs.priv, ctypes.pointer(stats))
+        if self.cbs.end_of_measure:
+            self.cbs.end_of_measure(self.cbs.priv)
+
+
+class _BufferedDataPipe(object):
+    def __init__(self, params):
+        self.p = params
+        self.fields = [(name, t) for bit, name, t in scTDC._BUFDATA_FIELDS
+                       if params.data_field_selection & bit]
+        self.maxlen = max(int(params.max_buffered_data_len), 1)
+        self.buf = {name: np.empty(self.maxlen, dtype=np.dtype(t))
+                    for name, t in self.fields}
+        self.fill = 0
+        self.event_index = 0 # index of the first event in self.buf
+        self.ms = []
+        self.som = []
+
+    def start(self):
+        self.som.append(self.event_index + self.fill)
+
+    def millisecond(self):
+        self.ms.append(self.event_index + self.fill)
+
+    def events(self, ev):
+        n = len(ev["time"])
+        off = 0
+        while off < n:
+            k = min(n - off, self.maxlen - self.fill)
+            for name, _ in self.fields:
+                self.buf[name][self.fill:self.fill+k] = ev[name][off:off+k]
+            self.fill += k
+            off += k
+            if self.fill == self.maxlen:
+                self._emit(flush_all=False)
+
+    def _emit(self, flush_all):
+        end = self.event_index + self.fill
+        if flush_all:
+            ms, self.ms = self.ms, []
+            som, self.som = self.som, []
+        else:
+            ms = [i for i in self.ms if i < end]
+            self.ms = self.ms[len(ms):]
+            som = [i for i in self.som if i < end]
+            self.som = self.som[len(som):]
+        args = scTDC.sc_pipe_buf_callback_args()
+        args.event_index = self.event_index
+        args.data_len = self.fill
+        for name, t in self.fields:
+            setattr(args, name, self.buf[name].ctypes.data_as(
+                ctypes.POINTER(t)))
+        # keep the index arrays alive until the callback returns
+        ms_arr = np.array(ms, dtype=np.uint64)
+        som_arr = np.array(som, dtype=np.uint64)
+        if len(ms_arr):
+            args.ms_indices = ms_arr.ctypes.data_as(
+                ctypes.POINTER(ctypes.c_ulonglong))
+            args.ms_indices_len = len(ms_arr)
+        if len(som_arr):
+            args.som_indices = som_arr.ctypes.data_as(
+                ctypes.POINTER(ctypes.c_ulonglong))
+            args.som_indices_len = len(som_arr)
+        self.p.data(self.p.priv, ctypes.pointer(args))
+        self.event_index = end
+        self.fill = 0
+
+    def end(self, stats):
+        if self.p.end_of_measurement(self.p.priv):
+            if self.fill or self.ms or self.som:
+                self._emit(flush_all=True)
+
+
+class _HistoPipe(object):
+    def __init__(self, pipe_type, params):
+        self.type = pipe_type
+        self.par = params
+        if pipe_type == scTDC.TDC_HISTO:
+            shape = (params.size,)
+        else:
+            r = params.roi.size
+            shape = {scTDC.DLD_IMAGE_XY  : (r.x, r.y),
+                     scTDC.DLD_IMAGE_XT  : (r.x, r.time),
+                     scTDC.DLD_IMAGE_YT  : (r.y, r.time),
+                     scTDC.DLD_IMAGE_3D  : (r.x, r.y, r.time),
+                     scTDC.DLD_SUM_HISTO : (r.time,)}[pipe_type]
+        self.shape = shape
+        self.nrvoxels = int(np.prod(shape))
+        self.view = None
+
+    def allocate(self):
+        """ Asks the owner of the pipe for the data buffer """
+        ptr = ctypes.c_void_p()
+        self.par.allocator_cb(None, ctypes.byref(ptr))
+        voxeltype = scTDC._get_voxel_type(self.par.depth)
+        self.view = np.ctypeslib.as_array(
+            (voxeltype * self.nrvoxels).from_address(ptr.value))
+
+    def start(self):
+        self.allocate()
+
+    def millisecond(self):
+        pass
+
+    def _binned(self, values, binning, offset, size):
+        v = (values // max(int(binning), 1)).astype(np.int64) - offset
+        return v, (v >= 0) & (v < size)
+
+    def events(self, ev):
+        if self.view is None or len(ev["time"]) == 0:
+            return
+        p = self.par
+        t = ev["time"]
+        if p.modulo:
+            t = t % p.modulo
+        if self.type == scTDC.TDC_HISTO:
+            idx, ok = self._binned(t, p.binning, p.offset, p.size)
+            if p.channel != 0xFFFFFFFF: # channel -1 accepts all channels
+                ok &= ev["channel"] == p.channel
+        else:
+            x, okx = self._binned(ev["dif1"], p.binning.x, p.roi.offset.x,
+                                  p.roi.size.x)
+            y, oky = self._binned(ev["dif2"], p.binning.y, p.roi.offset.y,
+                                  p.roi.size.y)
+            t, okt = self._binned(t, p.binning.time, p.roi.offset.time,
+                                  p.roi.size.time)
+            ok = okx & oky & okt
+            sx, sy = p.roi.size.x, p.roi.size.y
+            idx = {scTDC.DLD_IMAGE_XY  : lambda: x + y * sx,
+                   scTDC.DLD_IMAGE_XT  : lambda: x + t * sx,
+                   scTDC.DLD_IMAGE_YT  : lambda: y + t * sy,
+                   scTDC.DLD_IMAGE_3D  : lambda: x + y * sx + t * sx * sy,
+                   scTDC.DLD_SUM_HISTO : lambda: t}[self.type]()
+        u, c = np.unique(idx[ok], return_counts=True)
+        self.view[u] += c.astype(self.view.dtype)
+
+    def end(self, stats):
+        pass
+
+
+class _StatisticsPipe(object):
+    def __init__(self, params):
+        self.par = params
+        self.stat = None
+
+    def start(self):
+        ptr = ctypes.c_void_p()
+        self.par.allocator_cb(None, ctypes.byref(ptr))
+        self.stat = scTDC.statistics_t.from_address(ptr.value)
+
+    def millisecond(self):
+        pass
+
+    def events(self, ev):
+        pass
+
+    def end(self, stats):
+        if self.stat is not None:
+            ctypes.memmove(ctypes.byref(self.stat), ctypes.byref(stats),
+                           ctypes.sizeof(stats))
+
+
+class scTDC_hdf5lib_sim(object):
+    """ No-op stand-in for scTDC.scTDC_hdf5lib: keeps the configuration and
+    the active state of the streamer instances, but writes no files """
+    def __init__(self):
+        self.instances = {} # handle -> dict of the configuration
+        self._next_handle = 0
+
+    def sc_tdc_hdf5_create(self):
+        handle = self._next_handle
+        self._next_handle += 1
+        self.instances[handle] = {'dev_desc' : None, 'active' : 0}
+        return handle
+
+    def sc_tdc_hdf5_destroy(self, obj):
+        return 0 if self.instances.pop(obj, None) is not None else ERR_BAD_PARAM
+
+    def sc_tdc_hdf5_connect(self, obj, dev_desc):
+        if obj not in self.instances:
+            return ERR_BAD_PARAM
+        self.instances[obj]['dev_desc'] = dev_desc
+        return 0
+
+    def sc_tdc_hdf5_disconnect(self, obj):
+        if obj not in self.instances:
+            return ERR_BAD_PARAM
+        self.instances[obj].update(dev_desc=None, active=0)
+        return 0
+
+    def sc_tdc_hdf5_isactive(self, obj):
+        return self.instances.get(obj, {}).get('active', ERR_BAD_PARAM)
+
+    def cfg_outfile(self, obj, filepath):
+        self.instances[obj]['outfile'] = filepath
+        return 0
+
+    def cfg_comment(self, obj, comment):
+        self.instances[obj]['comment'] = comment
+        return 0
+
+    def sc_tdc_hdf5_cfg_datasel(self, obj, datasel):
+        self.instances[obj]['datasel'] = datasel
+        return 0
+
+    def sc_tdc_hdf5_setactive(self, obj, active):
+        """ Returns the new state (1 active, 0 inactive) like the library """
+        inst = self.instances.get(obj)
+        if inst is None or inst['dev_desc'] is None:
+            return ERR_BAD_PARAM
+        inst['active'] = 1 if active else 0
+        return inst['active']
+
+    def version(self):
+        return "simulated (no files written)"
+
+
+class scTDClib_sim(object):
+    """ Drop-in replacement for scTDC.scTDClib that simulates a delay-line
+    detector. Keyword arguments are passed on to EventGenerator (rate,
+    x_center, x_width, tof_center, tof_width, bunch_offsets, bunch_period,
+    ...). If realtime is True, one simulated millisecond takes at least one
+    millisecond of wall-clock time; otherwise measurements run as fast as
+    possible. """
+    def __init__(self, realtime=True, **generator_args):
+        self.realtime = realtime
+        self.generator = EventGenerator(**generator_args)
+        self.generated = 0
+        self._dev_desc = None
+        self._pipes = {}
+        self._next_handle = 0
+        self._complete_cb = None
+        self._complete_priv = None
+        self._thread = None
+        self._abort = threading.Event()
+        self._lock = threading.Lock()
+
+    def _check_dev(self, dev_desc):
+        return self._dev_desc is not None and dev_desc == self._dev_desc
+
+    def sc_tdc_init_inifile(self, inifile_path="tdc_gpx3.ini"):
+        if self._dev_desc is None:
+            self._dev_desc = 0
+        return self._dev_desc
+
+    def sc_get_err_msg(self, errcode):
+        if errcode >= 0:
+            return ""
+        return _ERR_MSGS.get(errcode, "simulated error %d" % errcode)
+
+    def sc_tdc_deinit2(self, dev_desc):
+        if not self._check_dev(dev_desc):
+            return ERR_NOT_INIT
+        self.sc_tdc_interrupt2(dev_desc)
+        t = self._thread
+        if t is not None:
+            t.join()
+        self._pipes = {}
+        self._complete_cb = None
+        self._dev_desc = None
+        return 0
+
+    def sc_tdc_start_measure2(self, dev_desc, exposure_ms):
+        if not self._check_dev(dev_desc):
+            return ERR_NOT_INIT
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return ERR_NOT_READY
+            self._abort.clear()
+            self._thread = threading.Thread(target=self._measure,
+                                            args=(int(exposure_ms),),
+                                            daemon=True)
+            self._thread.start()
+        return 0
+
+    def sc_tdc_interrupt2(self, dev_desc):
+        if not self._check_dev(dev_desc):
+            return ERR_NOT_INIT
+        self._abort.set()
+        return 0
+
+    def sc_pipe_open2(self, dev_desc, pipe_type, pipe_params):
+        if not self._check_dev(dev_desc):
+            return ERR_NOT_INIT
+        if pipe_type == scTDC.USER_CALLBACKS:
+            pipe = _UserCallbacksPipe(pipe_params)
+        elif pipe_type == scTDC.BUFFERED_DATA_CALLBACKS:
+            pipe = _BufferedDataPipe(pipe_params)
+        elif pipe_type == scTDC.STATISTICS:
+            pipe = _StatisticsPipe(pipe_params)
+            pipe.start()
+        elif pipe_type in _HISTO_TYPES:
+            pipe = _HistoPipe(pipe_type, pipe_params)
+            pipe.allocate()
+        else:
+            return ERR_BAD_PARAM
+        handle = self._next_handle
+        self._next_handle += 1
+        pipes = dict(self._pipes)
+        pipes[handle] = pipe
+        self._pipes = pipes # the measurement thread iterates over a snapshot
+        return handle
+
+    def sc_pipe_close2(self, dev_desc, pipe_handle):
+        if not self._check_dev(dev_desc):
+            return ERR_NOT_INIT
+        if pipe_handle not in self._pipes:
+            return ERR_NO_PIPE
+        pipes = dict(self._pipes)
+        del pipes[pipe_handle]
+        self._pipes = pipes
+        return 0
+
+    def sc_pipe_read2(self, dev_desc, pipe_handle, timeout):
+        pipe = self._pipes.get(pipe_handle)
+        if pipe is None or not isinstance(pipe, _HistoPipe):
+            return (ERR_NO_PIPE, ctypes.POINTER(None))
+        return (0, ctypes.c_void_p(pipe.view.ctypes.data))
+
+    def sc_tdc_get_status2(self, dev_desc):
+        if not self._check_dev(dev_desc):
+            return ERR_NOT_INIT
+        t = self._thread
+        return 1 if (t is not None and t.is_alive()) else 0
+
+    def sc_tdc_get_statistics2(self, dev_desc):
+        if not self._check_dev(dev_desc):
+            return ERR_NOT_INIT
+        return scTDC.copy_statistics(self._stats) \
+            if hasattr(self, "_stats") else scTDC.statistics_t()
+
+    def sc_tdc_set_complete_callback2(self, dev_desc, privptr, callback):
+        if not self._check_dev(dev_desc):
+            return ERR_NOT_INIT
+        self._complete_priv = privptr
+        self._complete_cb = callback
+        return 0
+
+    def _measure(self, exposure_ms):
+        pipes = list(self._pipes.values())
+        stats = scTDC.statistics_t()
+        for p in pipes:
+            p.start()
+        t0 = time.perf_counter()
+        for ms in range(exposure_ms):
+            if self._abort.is_set():
+                break
+            ev = self.generator.millisecond()
+            n = len(ev["time"])
+            for p in pipes:
+                p.events(ev)
+            for p in pipes:
+                p.millisecond()
+            self.generated += n
+            stats.events_found[0] += n
+            stats.events_received[0] += n
+            stats.events_in_roi[0] += n
+            if self.realtime:
+                delay = t0 + (ms + 1) * 1e-3 - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        for p in pipes:
+            p.end(stats)
+        self._stats = stats
+        reason = scTDC.CBR_USER_ABORT if self._abort.is_set() \
+            else scTDC.CBR_COMPLETE
+        cb = self._complete_cb
+        self._thread = None # idle, before notifying
+        if cb:
+            cb(self._complete_priv, reason)
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Pipelined scan engines.
+
+A scan runs in a worker thread. For every step, the output of the step is
+prepared, the TDC measures, and then finalizing the output of the step
+overlaps with moving to the value of the next step and waiting for it to
+settle. ScanEngine implements this loop; the subclasses only implement the
+move:
+  * PhaseShifterScanEngine writes a delay to the phase shifter and
+    confirms the written code by reading the ports back (hidden behind
+    finishing the previous step),
+  * KineticEnergyScanEngine sets the kinetic energy through ProdigyRemote
+    and waits until Prodigy reports that the ramp is complete, but at least
+    a minimum settle time.
+
+The output is handled by a sink object with the methods begin(index,
+value) -> (success, errmsg), finish(index, value, t_start, t_stop) and
+close():
+  * VendorFileSink writes one HDF5 file per step through the scTDC_hdf5
+    streamer (Device.hdf5_open / hdf5_close),
+  * SingleFileSink appends all steps to one file (scan_writer.ScanFileWriter)
+    from the cursor of a ringbuffer_pipe.
+
+With an adaptive_dwell.AdaptiveDwell, the exposure of every step lasts
+until the step has enough counts (within minimum and maximum bounds)
+instead of the fixed time_ms.
+
+Per-step overhead (wall time of a step minus its exposure time) is recorded
+for every step, and the time of every phase of a step (move, settle, open,
+acquire, close, wait) goes into the ScanTimer 'timer' (see scan_timing.py),
+so that the dead time of a scan can be quantified.
+"""
+
+import abc
+import concurrent.futures
+import threading
+import time
+
+from scan_timing import ScanTimer
+
+MAX_DELAY_PS = 5000
+PS_PER_CODE = 5
+# minimum time between writing a delay and the next exposure, on top of
+# the port read-back (settle_reads). No fixed wait by default, the old scan
+# loop slept 1 s per step without a measurement behind it; pass min_settle
+# to the engine if a delay line turns out to need longer.
+PS_MIN_SETTLE_S = 0.0
+# the same for the analyzer: Prodigy may report the set value and an idle
+# controller before the voltages have ramped
+KE_MIN_SETTLE_S = 1.0
+
+
+def delay_code(delay_ps):
+    """ Converts a delay in ps (clipped to 0..5000) to the phase shifter
+    code that PhaseShifter.set_delay expects """
+    return min(max(int(delay_ps), 0), MAX_DELAY_PS) // PS_PER_CODE
+
+
+class VendorFileSink(object):
+    """ One HDF5 file per step, written by the scTDC_hdf5 library.
+    path_for_step(index, value) returns the file path of a step. """
+    def __init__(self, device, datasel, path_for_step,
+                 comment="phase shifter scan"):
+        self.device = device
+        self.datasel = datasel
+        self.path_for_step = path_for_step
+        self.comment = comment
+
+    def begin(self, index, value):
+        return self.device.hdf5_open(self.path_for_step(index, value),
+                                     self.comment, self.datasel)
+
+    def finish(self, index, value, t_start, t_stop):
+        success, errmsg = self.device.hdf5_close()
+        if not success:
+            print("Error while closing the HDF5 file")
+
+    def close(self):
+        pass
+
+
+class SingleFileSink(object):
+    """ Appends the events of all steps to one scan_writer.ScanFileWriter.
+    cursor is a RingBufferCursor of a ringbuffer_pipe that provides (at
+    least) the fields of the writer; the sink owns it and closes it at the
+    end of the scan. The step record is only added at the next begin() (or
+    close()), so that events which the library delivers after the end of a
+    measurement still go into the step they belong to. """
+    def __init__(self, writer, cursor):
+        self.writer = writer
+        self.cursor = cursor
+        self._step = None      # (value, t_start, t_stop) of the open step
+
+    def _close_step(self):
+        self.writer.append(self.cursor.read())
+        self.writer.add_step(*self._step)
+        self._step = None
+
+    def begin(self, index, value):
+        if self._step is not None:
+            self._close_step() # late events of the previous step
+        else:
+            self.cursor.skip() # discard events from before the scan
+        return (True, "")
+
+    def finish(self, index, value, t_start, t_stop):
+        self.writer.append(self.cursor.read())
+        self._step = (value, t_start, t_stop)
+
+    def close(self):
+        try:
+            if self._step is not None:
+                self._close_step()
+        finally:
+            try:
+                self.writer.close()
+            finally:
+                # a cursor left on the ring would hold back the producer
+                self.cursor.close()
+
+
+class ScanEngine(abc.ABC):
+    """ Runs a scan with the TDC in a worker thread. Subclasses implement
+    _move(value), which moves to the value of a step and returns the
+    settle time in seconds.
+
+    device is an initialized scTDC.Device. The callables on_step(index,
+    value, overhead_s) and on_finished(completed) are invoked from the worker
+    thread; GUIs should forward them through queued signals. dwell is an
+    optional adaptive_dwell.AdaptiveDwell, which then replaces the fixed
+    exposure of run().
+    """
+    def __init__(self, device, on_step=None, on_finished=None, dwell=None):
+        self.device = device
+        self.on_step = on_step
+        self.on_finished = on_finished
+        self.dwell = dwell
+        # wall clock of the step records, e.g. a charge_alignment.ClockOffset
+        # for NTP time; its refresh(), if any, is called once at the start of
+        # run(), i.e. in the scan thread
+        self.clock = time
+        # optional metadata_sampler.MetadataSampler, sampled once per step
+        self.metadata = None
+        self.overheads = []
+        self.timer = ScanTimer()
+        self._abort = threading.Event()
+        self._thread = None
+
+    def start(self, values, time_ms, sink):
+        """ Starts the scan in a worker thread and returns immediately.
+        values is a sequence of step values (e.g. delays in ps), time_ms the
+        exposure per step and sink the output handler (VendorFileSink or
+        SingleFileSink), which is closed at the end of the scan. """
+        self._abort.clear()
+        self._thread = threading.Thread(
+            target=self.run, args=(values, time_ms, sink),
+            daemon=True)
+        self._thread.start()
+
+    def abort(self):
+        """ Stops the scan after interrupting the running measurement """
+        self._abort.set()
+        self.device.interrupt_measurement()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def join(self, timeout=None):
+        """ Waits until the scan thread has finished (e.g. after abort) """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @abc.abstractmethod
+    def _move(self, value):
+        """ Moves the hardware to the value of a step and waits until it has
+        settled. Returns the settle time in seconds (the part of the call
+        spent waiting after the move was issued). """
+
+    def _timed_move(self, value):
+        """ Returns the (move, settle) times of _move in seconds """
+        t0 = time.perf_counter()
+        settle = self._move(value)
+        return time.perf_counter() - t0 - settle, settle
+
+    def run(self, values, time_ms, sink):
+        """ Runs the scan in the calling thread. Returns True if all steps
+        have been completed. time_ms is not used with a dwell. """
+        values = list(values)
+        self.overheads = []
+        if hasattr(self.clock, 'refresh'):
+            self.clock.refresh() # e.g. an NTP query, before the timing starts
+        self.timer.begin()
+        if self.metadata is not None:
+            self.metadata.begin()
+        completed = False
+        mover = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            if values:
+                move_s, settle_s = self._timed_move(values[0])
+            for i, value in enumerate(values):
+                if self._abort.is_set():
+                    break
+                t_step = time.perf_counter()
+                success, errmsg = sink.begin(i, value)
+                if not success:
+                    print("Error while opening HDF5 file : " + errmsg)
+                    break
+                t_start = self.clock.time()
+                if self.metadata is not None:
+                    self.metadata.sample(i, t_start)
+                t_acquire = time.perf_counter()
+                if self.dwell is not None:
+                    reason = self.dwell.measure(self.device)
+                    counts = self.dwell.last_counts
+                else:
+                    reason = self.device.measure_future(time_ms).result()
+                    counts = -1
+                t_stop = self.clock.time()
+                t_finish = time.perf_counter()
+                if self.dwell is not None:
+                    exposure = t_finish - t_acquire
+                else:
+                    exposure = time_ms / 1000.0
+                if reason < 0:
+                    print("Error while starting measurement : ({}) {}".format(
+                        self.device.lib.sc_get_err_msg(reason), reason))
+                # overlap the next hardware move with finishing this step
+                move = None
+                if i + 1 < len(values) and not self._abort.is_set():
+                    move = mover.submit(self._timed_move, values[i+1])
+                sink.finish(i, value, t_start, t_stop)
+                t_wait = time.perf_counter()
+                if move is not None:
+                    next_move = move.result()
+                t_end = time.perf_counter()
+                overhead = t_end - t_step - exposure
+                self.overheads.append(overhead)
+                self.timer.record(i, value, t_start, t_stop, exposure, counts,
+                                  move=move_s, settle=settle_s,
+                                  begin=t_acquire - t_step,
+                                  acquire=t_finish - t_acquire,
+                                  finish=t_wait - t_finish,
+                                  wait=t_end - t_wait, step=t_end - t_step)
+                if move is not None:
+                    move_s, settle_s = next_move
+                if self.on_step is not None:
+                    self.on_step(i, value, overhead)
+                if reason < 0:
+                    break
+            else:
+                completed = True
+        finally:
+            mover.shutdown(wait=True)
+            self.timer.end()
+            sink.close()
+            if self.on_finished is not None:
+                self.on_finished(completed)
+        return completed
+
+    def summary(self):
+        """ Returns a one-line summary of the per-step overheads """
+        n = len(self.overheads)
+        if n == 0:
+            return "no steps recorded"
+        total = sum(self.overheads)
+        return ("%d steps, overhead per step: mean %.1f ms, max %.1f ms, "
+                "total %.1f s" % (n, total / n * 1e3,
+                                  max(self.overheads) * 1e3, total))
+
+
+class PhaseShifterScanEngine(ScanEngine):
+    """ Phase-shifter delay scan. phase_shifter is a connected
+    write_ports.PhaseShifter, the step values are delays in ps. """
+    def __init__(self, device, phase_shifter, settle_timeout=0.5,
+                 settle_reads=2, min_settle=PS_MIN_SETTLE_S,
+                 on_step=None, on_finished=None, dwell=None):
+        super().__init__(device, on_step, on_finished, dwell)
+        self.ps = phase_shifter
+        self.settle_timeout = settle_timeout
+        self.settle_reads = settle_reads
+        self.min_settle = min_settle
+
+    def _move(self, delay_ps):
+        """ Writes the delay, waits until the read-back matches and then
+        until min_settle has passed since the write. Returns the settle time
+        in seconds. """
+        code = delay_code(delay_ps)
+        self.ps.set_delay(code)
+        t0 = time.perf_counter()
+        stable = 0
+        while stable < self.settle_reads:
+            self.ps.read()
+            if (self.ps.state.uint & 0x3FF) == code:
+                stable += 1
+                continue
+            stable = 0
+            if time.perf_counter() - t0 > self.settle_timeout:
+                print("Phase shifter did not settle at %i ps" % delay_ps)
+                break
+            time.sleep(0.001)
+        remaining = self.min_settle - (time.perf_counter() - t0)
+        if remaining > 0:
+            time.sleep(remaining)
+        return time.perf_counter() - t0
+
+
+class KineticEnergyScanEngine(ScanEngine):
+    """ Kinetic-energy scan at fixed pass energy. remote is a connected
+    prodigy_remote.ProdigyRemote, the step values are kinetic energies in
+    eV. Only the kinetic energy is sent for each step (the other voltages
+    are unchanged, see ProdigyRemote.setVoltagesDirectly). """
+    def __init__(self, device, remote, pass_energy=None, tolerance=0.01,
+                 ramp_timeout=60.0, poll_interval=0.01,
+                 min_settle=KE_MIN_SETTLE_S,
+                 on_step=None, on_finished=None, dwell=None):
+        super().__init__(device, on_step, on_finished, dwell)
+        self.remote = remote
+        self.pass_energy = pass_energy
+        self.tolerance = tolerance
+        self.ramp_timeout = ramp_timeout
+        self.poll_interval = poll_interval
+        self.min_settle = min_settle
+
+    def _move(self, energy):
+        """ Sets the kinetic energy and waits for the end of the ramp.
+        Returns the ramp time in seconds. """
+        pass_energy = self.pass_energy
+        if pass_energy is None:
+            pass_energy = self.remote.analyzr_volts['"Pass Energy"']
+        self.remote.setVoltagesDirectly(energy, pass_energy)
+        t0 = time.perf_counter()
+        done = self.remote.waitForRamp({'"Kinetic Energy"' : energy},
+                                       self.tolerance, self.ramp_timeout,
+                                       self.poll_interval, self.min_settle)
+        if not done:
+            print("Analyzer did not reach %g eV" % energy)
+        return time.perf_counter() - t0
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Scan plans compiled from a table of ranges.
+
+A ScanPlan turns rows of (start, stop, step) into one numpy array of set
+points. The rows are expanded without a python loop over the steps, every
+range includes its stop value if it lies on the step grid, and set points
+that occur in more than one row (overlapping or adjacent ranges) are
+measured only once. Different step sizes per row give non-uniform plans.
+
+The order of the steps is one of
+  'table'        as in the table, duplicates at their first occurrence,
+  'ascending'    sorted,
+  'descending'   sorted in reverse,
+  'random'       a random permutation (reproducible with 'seed'),
+  'interleaved'  coarse to fine: the first steps span the whole range and
+                 later steps fill in between, so that an aborted scan still
+                 covers the range.
+
+The same plan object gives the number of steps and the time estimate shown
+in the GUI and the values the scan engine runs, so the two cannot disagree.
+"""
+
+import numpy as np
+
+ORDERS = ("table", "ascending", "descending", "random", "interleaved")
+
+
+def expand_ranges(rows):
+    """ Expands rows of (start, stop, step) into one array of set points.
+    Rows with a step of 0 or a step pointing away from stop are empty. """
+    rows = np.asarray(rows, dtype=np.int64).reshape(-1, 3)
+    start, stop, step = rows.T
+    valid = (step != 0) & ((stop - start) * np.sign(step) >= 0)
+    safe_step = np.where(valid, step, 1)
+    counts = np.where(valid, (stop - start) // safe_step + 1, 0)
+    # index of every step within its row
+    first = np.cumsum(counts) - counts
+    total = int(counts.sum())
+    within = np.arange(total) - np.repeat(first, counts)
+    return np.repeat(start, counts) + np.repeat(safe_step, counts) * within
+
+
+def _interleaved(n):
+    """ Permutation of range(n) in bit-reversed (coarse to fine) order """
+    bits = max(int(n - 1).bit_length(), 1)
+    idx = np.arange(1 << bits)
+    rev = np.zeros_like(idx)
+    for b in range(bits):
+        rev |= ((idx >> b) & 1) << (bits - 1 - b)
+    return rev[rev < n]
+
+
+class ScanPlan(object):
+    """ Set points of a scan compiled from rows of (start, stop, step).
+
+    Parameters
+    ----------
+    rows : sequence of (int, int, int)
+      the ranges, e.g. the rows of the table of delay ranges.
+    order : str, optional
+      one of ORDERS. The default is 'table'.
+    limits : (int, int), optional
+      set points are clipped to [min, max]. The default is None.
+    resolution : int, optional
+      set points are rounded down to multiples of it before removing
+      duplicates (e.g. 5 ps per phase shifter code). The default is 1.
+    seed : int, optional
+      seed of the 'random' order. The default is None.
+    """
+    def __init__(self, rows, order="table", limits=None, resolution=1,
+                 seed=None):
+        if order not in ORDERS:
+            raise ValueError("order must be one of " + ", ".join(ORDERS))
+        self.rows = [tuple(int(v) for v in row) for row in rows]
+        self.order = order
+        self.seed = seed
+        values = expand_ranges(self.rows)
+        if limits is not None:
+            values = np.clip(values, limits[0], limits[1])
+        if resolution > 1:
+            values = values - values % resolution
+        self.requested = len(values)
+        # unique values, in the order of their first occurrence
+        unique, first = np.unique(values, return_index=True)
+        if order == "table":
+            values = values[np.sort(first)]
+        elif order == "ascending":
+            values = unique
+        elif order == "descending":
+            values = unique[::-1]
+        elif order == "random":
+            values = np.random.default_rng(seed).permutation(unique)
+        else:
+            values = unique[_interleaved(len(unique))]
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values.tolist())
+
+    @property
+    def duplicates(self):
+        """ Number of set points removed because they were already planned """
+        return self.requested - len(self.values)
+
+    def estimated_time(self, time_per_step, overhead_per_step=0.0):
+        """ Estimated duration of the scan in seconds """
+        return len(self) * (time_per_step + overhead_per_step)
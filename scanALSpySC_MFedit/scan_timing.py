@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Per-step timing of scans.
+
+ScanTimer records one row per scan step in a preallocated numpy record
+array (TIMING_DTYPE), with the wall time of every phase of the step:
+  move      writing the value of the step to the hardware (e.g.
+            PhaseShifter.set_delay), before the settle wait,
+  settle    waiting until the read-back or Prodigy confirms the value,
+  begin     opening the output of the step (hdf5_open),
+  acquire   the measurement itself (exposure plus start/stop latency),
+  finish    closing the output of the step (hdf5_close or the append to
+            the scan file),
+  wait      time the step was blocked on the move to the next value after
+            finishing (the part of move + settle not hidden by the overlap),
+  step      the whole step.
+move and settle belong to the move *to* the value of the row, which ran in
+parallel to the previous step (before the first step for row 0).
+With an adaptive dwell, the exposure differs per step and 'counts' holds
+the counts that ended the step (-1 otherwise).
+
+The duty cycle is the exposure time divided by the wall time since the
+start of the scan. summary() gives a one-line live summary; save() writes
+the table as CSV next to the scan data, and append_scan_log() adds one row
+per scan to a log file, so that the duty cycle of a whole beamtime can be
+evaluated.
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+
+PHASES = ("move", "settle", "begin", "acquire", "finish", "wait", "step")
+
+TIMING_DTYPE = np.dtype([("index",    np.int32),
+                         ("value",    np.float64),
+                         ("t_start",  np.float64), # wall clock of the
+                         ("t_stop",   np.float64), # exposure
+                         ("exposure", np.float64),
+                         ("counts",   np.int64)]   # -1: not counted
+                        + [(p, np.float64) for p in PHASES])
+
+
+class ScanTimer(object):
+    """ Per-step timing table of one scan. Rows are written by the scan
+    thread; summary() and duty_cycle() may be called from any thread. """
+    def __init__(self, capacity=1024):
+        self._table = np.zeros(capacity, TIMING_DTYPE)
+        self._n = 0
+        self._lock = threading.Lock()
+        self.t_begin = None   # perf_counter at the start of the scan
+        self.t_end = None
+
+    def begin(self):
+        """ Marks the start of the scan (before the first move) """
+        with self._lock:
+            self._n = 0
+        self.t_begin = time.perf_counter()
+        self.t_end = None
+
+    def end(self):
+        self.t_end = time.perf_counter()
+
+    def record(self, index, value, t_start, t_stop, exposure, counts=-1,
+               **phases):
+        """ Adds the row of one step. phases are the durations in seconds
+        (keywords from PHASES); missing phases are 0. """
+        with self._lock:
+            if self._n == len(self._table):
+                self._table = np.resize(self._table, 2 * len(self._table))
+            row = self._table[self._n]
+            row["index"] = index
+            row["value"] = value
+            row["t_start"] = t_start
+            row["t_stop"] = t_stop
+            row["exposure"] = exposure
+            row["counts"] = counts
+            for p in PHASES:
+                row[p] = phases.get(p, 0.0)
+            self._n += 1
+
+    def table(self):
+        """ Returns a copy of the recorded rows """
+        with self._lock:
+            return self._table[:self._n].copy()
+
+    def __len__(self):
+        return self._n
+
+    def elapsed(self):
+        """ Wall time of the scan in seconds (so far, if it is running) """
+        if self.t_begin is None:
+            return 0.0
+        end = self.t_end if self.t_end is not None else time.perf_counter()
+        return end - self.t_begin
+
+    def duty_cycle(self):
+        """ Exposure time / wall time of the scan """
+        with self._lock:
+            exposure = self._table["exposure"][:self._n].sum()
+        elapsed = self.elapsed()
+        return exposure / elapsed if elapsed > 0 else 0.0
+
+    def totals(self):
+        """ Dict with the total of every phase and the exposure time """
+        with self._lock:
+            t = self._table[:self._n]
+            totals = {p: float(t[p].sum()) for p in PHASES}
+            totals["exposure"] = float(t["exposure"].sum())
+        return totals
+
+    def summary(self):
+        """ One-line summary: steps, duty cycle and mean time per phase """
+        n = len(self)
+        if n == 0:
+            return "no steps recorded"
+        totals = self.totals()
+        phases = ", ".join("%s %.1f" % (p, totals[p] / n * 1e3)
+                           for p in PHASES if p != "step")
+        return ("%d steps in %.1f s, duty cycle %.1f %%, mean ms per step: %s"
+                % (n, self.elapsed(), self.duty_cycle() * 100, phases))
+
+    def save(self, path):
+        """ Writes the timing table as CSV (times in seconds) """
+        np.savetxt(path, self.table(), delimiter=",",
+                   header=",".join(TIMING_DTYPE.names),
+                   fmt=["%d", "%.6g", "%.6f", "%.6f", "%.6f", "%d"]
+                   + ["%.6f"] * len(PHASES))
+
+
+def append_scan_log(path, name, timer):
+    """ Appends one line with the totals of a scan to the CSV log 'path' """
+    columns = (["name", "t_start", "steps", "elapsed", "duty_cycle", "exposure"]
+               + list(PHASES))
+    totals = timer.totals()
+    table = timer.table()
+    t_start = table["t_start"][0] if len(table) else time.time()
+    values = ([name, "%.3f" % t_start, "%d" % len(table),
+               "%.3f" % timer.elapsed(), "%.4f" % timer.duty_cycle(),
+               "%.3f" % totals["exposure"]]
+              + ["%.3f" % totals[p] for p in PHASES])
+    new = not os.path.exists(path)
+    with open(path, mode='a') as f:
+        if new:
+            f.write(",".join(columns) + "\n")
+        f.write(",".join(values) + "\n")
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Single-file output for multi-step scans.
+
+Instead of one HDF5 file per delay step, ScanFileWriter appends the events of
+all steps to chunked, resizable 1D datasets (one per event data field, e.g.
+'dif1' and 'time') in one HDF5 file. The dataset 'steps' holds one record per
+step with the delay, the [start, stop) event offsets into the event datasets
+and the wall-clock start and stop time of the exposure, so that the events of
+one step can be read back with a single slice (see read_step). Scans of
+other quantities name the first field of the step records differently (e.g.
+'kinetic_energy'), see make_step_dtype.
+
+File layout:
+    /events/<field>   1D event data, all steps concatenated
+    /steps            records (delay_ps, start, stop, t_start, t_stop)
+    attribute 'user_comment' on the root group
+"""
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+def make_step_dtype(name="delay_ps", dtype=np.int32):
+    """ dtype of the step records, with the scanned quantity 'name' """
+    return np.dtype([(name,      dtype),
+                     ("start",   np.uint64),
+                     ("stop",    np.uint64),
+                     ("t_start", np.float64),
+                     ("t_stop",  np.float64)])
+
+STEP_DTYPE = make_step_dtype()
+
+
+class ScanFileWriter(object):
+    """ Appends the events of consecutive scan steps to one HDF5 file.
+    fields is a list of (name, dtype) pairs. chunk_len is the number of
+    events per HDF5 chunk; compression and compression_opts are passed on to
+    h5py (e.g. "gzip", 4). step_dtype is the dtype of the step records. """
+    def __init__(self, filepath, fields, comment="", chunk_len=(1<<16),
+                 compression=None, compression_opts=None,
+                 step_dtype=STEP_DTYPE):
+        if h5py is None:
+            raise ImportError("ScanFileWriter requires the h5py package")
+        self.filepath = filepath
+        self.file = h5py.File(filepath, "w-") # never overwrite data
+        self.file.attrs["user_comment"] = comment
+        grp = self.file.create_group("events")
+        self.datasets = {}
+        for name, dtype in fields:
+            self.datasets[name] = grp.create_dataset(
+                name, shape=(0,), maxshape=(None,), dtype=np.dtype(dtype),
+                chunks=(chunk_len,), compression=compression,
+                compression_opts=compression_opts)
+        self.steps = self.file.create_dataset(
+            "steps", shape=(0,), maxshape=(None,), dtype=step_dtype,
+            chunks=(1024,))
+        self.nevents = 0
+        self._step_start = 0
+
+    def append(self, data):
+        """ Appends events. data is a dictionary of equally long 1D arrays
+        with (at least) one entry per field of the file. """
+        n = None
+        for name, ds in self.datasets.items():
+            a = data[name]
+            if n is None:
+                n = len(a)
+            if n == 0:
+                return
+            ds.resize((self.nevents + n,))
+            ds[self.nevents:] = a
+        if n:
+            self.nevents += n
+
+    def add_step(self, value, t_start, t_stop):
+        """ Closes the current step: all events appended since the previous
+        call belong to it. Returns the index of the step. """
+        index = self.steps.shape[0]
+        self.steps.resize((index + 1,))
+        self.steps[index] = (value, self._step_start, self.nevents,
+                             t_start, t_stop)
+        self._step_start = self.nevents
+        return index
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_step(filepath, index, fields=None):
+    """ Returns the step record and a dictionary with the events of step
+    'index' (all fields, or only the given field names) from a file written
+    by ScanFileWriter. """
+    if h5py is None:
+        raise ImportError("read_step requires the h5py package")
+    with h5py.File(filepath, "r") as f:
+        step = f["steps"][index]
+        start, stop = int(step["start"]), int(step["stop"])
+        names = fields if fields is not None else list(f["events"].keys())
+        return step, {name: f["events"][name][start:stop] for name in names}
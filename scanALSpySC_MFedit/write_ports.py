@@ -1,10 +1,19 @@
 
-from mcculw import ul
-from mcculw.enums import InfoType, BoardInfo, DigitalPortType, DigitalInfo
-from mcculw.enums import InterfaceType, DigitalIODirection, FunctionType
+try:
+    from mcculw import ul
+    from mcculw.enums import InfoType, BoardInfo, DigitalPortType, DigitalInfo
+    from mcculw.enums import InterfaceType, DigitalIODirection, FunctionType
+except ImportError: # no MCC driver, only mcculw_sim.SimulatedUL can be used
+    ul = None
+    from mcculw_sim import InfoType, BoardInfo, DigitalPortType, DigitalInfo
+    from mcculw_sim import InterfaceType, DigitalIODirection, FunctionType
 
 from bitstring import BitArray
+import ctypes
+import os
+import pickle
 import struct
+import time
 
 from pdb import set_trace as bpt
 
@@ -100,7 +109,8 @@ class Props(object):
         return result
 
 class PortInfo(object):
-    def __init__(self, board_num, port_index):
+    def __init__(self, board_num, port_index, ul_backend=None):
+        self._ul = ul_backend or ul
         self._board_num = board_num
         self._port_index = port_index
 
@@ -121,7 +131,7 @@ class PortInfo(object):
         self.supports_output_scan = self._get_supports_output_scan()
 
     def _get_num_bits(self):
-        return ul.get_config(
+        return self._ul.get_config(
             InfoType.DIGITALINFO, self._board_num, self._port_index,
             DigitalInfo.NUMBITS)
 
@@ -130,15 +140,15 @@ class PortInfo(object):
 
     def _get_supports_input_scan(self):
         try:
-            ul.get_status(self._board_num, FunctionType.DIFUNCTION)
-        except ul.ULError:
+            self._ul.get_status(self._board_num, FunctionType.DIFUNCTION)
+        except self._ul.ULError:
             return False
         return True
 
     def _get_supports_output_scan(self):
         try:
-            ul.get_status(self._board_num, FunctionType.DOFUNCTION)
-        except ul.ULError:
+            self._ul.get_status(self._board_num, FunctionType.DOFUNCTION)
+        except self._ul.ULError:
             return False
         return True
 
@@ -161,13 +171,13 @@ class PortInfo(object):
         # completes without error
         if port_type == DigitalPortType.AUXPORT:
             try:
-                ul.d_config_bit(
+                self._ul.d_config_bit(
                     self._board_num, port_type, first_bit,
                     DigitalIODirection.OUT)
-                ul.d_config_bit(
+                self._ul.d_config_bit(
                     self._board_num, port_type, first_bit,
                     DigitalIODirection.IN)
-            except ul.ULError:
+            except self._ul.ULError:
                 return False
             return True
         return False
@@ -177,26 +187,26 @@ class PortInfo(object):
             return False
         # Check if d_config_port completes without error
         try:
-            ul.d_config_port(self._board_num, port_type,
+            self._ul.d_config_port(self._board_num, port_type,
                              DigitalIODirection.OUT)
-            ul.d_config_port(self._board_num, port_type,
+            self._ul.d_config_port(self._board_num, port_type,
                              DigitalIODirection.IN)
-        except ul.ULError:
+        except self._ul.ULError:
             return False
         return True
 
     def _get_digital_dev_type(self):
-        return DigitalPortType(ul.get_config(
+        return DigitalPortType(self._ul.get_config(
             InfoType.DIGITALINFO, self._board_num, self._port_index,
             DigitalInfo.DEVTYPE))
 
     def _get_in_mask(self):
-        return ul.get_config(
+        return self._ul.get_config(
             InfoType.DIGITALINFO, self._board_num, self._port_index,
             DigitalInfo.INMASK)
 
     def _get_out_mask(self):
-        return ul.get_config(
+        return self._ul.get_config(
             InfoType.DIGITALINFO, self._board_num, self._port_index,
             DigitalInfo.OUTMASK)
 
@@ -209,39 +219,174 @@ class DigitalProps(Props):
     values provided by this class be hard-coded in production code. 
     """
 
-    def __init__(self, board_num):
+    def __init__(self, board_num, ul_backend=None):
+        self._ul = ul_backend or ul
         self._board_num = board_num
         self.num_ports = self._get_num_digital_chans()
 
         self.port_info = []
         for port_index in range(self.num_ports):
-            self.port_info.append(PortInfo(board_num, port_index))
+            self.port_info.append(PortInfo(board_num, port_index, self._ul))
 
     def _get_num_digital_chans(self):
         try:
-            return ul.get_config(
+            return self._ul.get_config(
                 InfoType.BOARDINFO, self._board_num, 0,
                 BoardInfo.DINUMDEVS)
-        except ul.ULError:
+        except self._ul.ULError:
             return 0
 
+### cached board layout
+
+PORT_INFO_FIELDS = ('type', 'first_bit', 'num_bits', 'in_mask', 'out_mask',
+                    'is_bit_configurable', 'is_port_configurable',
+                    'supports_input', 'supports_input_scan',
+                    'supports_output', 'supports_output_scan')
+
+
+class CachedPortInfo(object):
+    """ PortInfo restored from the board cache, without probing the board """
+    def __init__(self, fields):
+        for name in PORT_INFO_FIELDS:
+            setattr(self, name, fields[name])
+        self.type = DigitalPortType(fields['type'])
+
+
+def save_board_cache(path, descriptor, dig_props):
+    """ Stores the device descriptor and the port layout found by
+    DigitalProps, so that later connects can skip the discovery """
+    ports = [{name: int(getattr(p, name)) if name == 'type'
+              else getattr(p, name) for name in PORT_INFO_FIELDS}
+             for p in dig_props.port_info]
+    with open(path, mode='wb') as f:
+        pickle.dump({'descriptor' : descriptor, 'ports' : ports}, f)
+
+
+def load_board_cache(path):
+    """ Returns the cached board layout, or None """
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path, mode='rb') as f:
+            cache = pickle.load(f)
+        cache['port_info'] = [CachedPortInfo(p) for p in cache['ports']]
+        return cache
+    except Exception as e: # unreadable or from another mcculw version
+        print('Ignoring the board cache %s: %s' % (path, e))
+        return None
+
+###
+
+STROBE = 1 << 10       # bit 10 latches the delay on its rising edge
+NUM_CODES = 1 << 10    # 10-bit delay codes, 5 ps each
+
+
+def _port_values(state):
+    """ (port A, port B) bytes of an 11-bit state: A holds bits 0-7, B bits
+    8-10 (i.e. state[3:] and state[:3] of the BitArray) """
+    return (state & 0xFF, state >> 8)
+
+# for every delay code the (port A, port B) values of the strobe sequence
+# high - low - high, so that set_delay needs no bit manipulation at all
+DELAY_LUT = [tuple(_port_values(s) for s in (STROBE | code, code,
+                                             STROBE | code))
+             for code in range(NUM_CODES)]
+
+
 class PhaseShifter:
 
-    def __init__(self, board_num=0):
+    def __init__(self, board_num=0, cache_path=None, ul_backend=None):
+        """ ul_backend replaces the mcculw.ul module, e.g. with
+        mcculw_sim.SimulatedUL() to run without the board """
+        self.ul = ul_backend or ul
+        if self.ul is None:
+            raise ImportError('mcculw is not installed, pass a ul_backend')
         self.board_num = board_num
+        self.cache_path = cache_path # board layout, see save_board_cache
         self.state = BitArray(uint=0, length=11)
+        self._last_out = None     # (A, B) last written by set_delay
+        self._out_array = None    # None: untested, True/False: d_out_array
 
-    def connect(self):
-        ul.ignore_instacal()
-        config_first_detected_device(self.board_num)
-        
-        self.dig_props = DigitalProps(self.board_num)
 
-        self.pA = self.dig_props.port_info[0]
-        self.pB = self.dig_props.port_info[1]
+    def connect(self):
+        """ Configures the board and ports A and B as outputs. With a
+        cache_path, the board layout of an earlier discovery is reused if a
+        cheap probe of the board confirms it; otherwise (and the first time)
+        the device inventory and DigitalProps are queried and cached. """
+        beg = time.perf_counter()
+        self.ul.ignore_instacal()
+        port_info = self._connect_cached()
+        if port_info is None:
+            port_info = self._discover()
+            how = 'discovered'
+        else:
+            how = 'from cache'
+        print('Phase shifter board %s in %.0f ms'
+              % (how, (time.perf_counter() - beg) * 1e3))
+
+        self.pA = port_info[0]
+        self.pB = port_info[1]
+
+        self.ul.d_config_port(self.board_num, self.pA.type,
+                              DigitalIODirection.OUT)
+        self.ul.d_config_port(self.board_num, self.pB.type,
+                              DigitalIODirection.OUT)
+        self._last_out = None
+        # one call for both ports needs them to be adjacent
+        self._out_array = None if self.pB.type == self.pA.type + 1 else False
+
+    def _discover(self):
+        devices = self.ul.get_daq_device_inventory(InterfaceType.ANY)
+        if len(devices) == 0:
+            raise RuntimeError('No DAQ devices found')
+        device = devices[0]
+        print("Found device: " + device.product_name +
+              " (" + device.unique_id + ")\n")
+        try:
+            self.ul.create_daq_device(self.board_num, device)
+        except self.ul.ULError: # already created by an earlier connect
+            self.ul.release_daq_device(self.board_num)
+            self.ul.create_daq_device(self.board_num, device)
+        self.dig_props = DigitalProps(self.board_num, self.ul)
+        if len(self.dig_props.port_info) < 2:
+            raise RuntimeError('%s has fewer than two digital ports'
+                               % device.product_name)
+        if self.cache_path is not None:
+            try:
+                save_board_cache(self.cache_path, devices[0], self.dig_props)
+            except (OSError, pickle.PicklingError) as e:
+                print('Could not save the board cache:', e)
+        return self.dig_props.port_info
 
-        ul.d_config_port(0, self.pA.type, DigitalIODirection.OUT)
-        ul.d_config_port(0, self.pB.type, DigitalIODirection.OUT)
+    def _probe(self, port_info):
+        """ Cheap check that the configured board has the cached layout """
+        try:
+            num_ports = self.ul.get_config(InfoType.BOARDINFO,
+                                           self.board_num, 0,
+                                           BoardInfo.DINUMDEVS)
+            first = self.ul.get_config(InfoType.DIGITALINFO, self.board_num,
+                                       0, DigitalInfo.DEVTYPE)
+        except self.ul.ULError:
+            return False
+        return num_ports == len(port_info) and first == port_info[0].type
+
+    def _connect_cached(self):
+        """ Returns the cached port infos if the board is (or can be)
+        configured with the cached descriptor, or None """
+        cache = load_board_cache(self.cache_path)
+        if cache is None:
+            return None
+        port_info = cache['port_info']
+        if self._probe(port_info): # still configured from a previous connect
+            return port_info
+        try:
+            self.ul.create_daq_device(self.board_num, cache['descriptor'])
+        except self.ul.ULError:
+            return None
+        if self._probe(port_info):
+            return port_info
+        self.ul.release_daq_device(self.board_num) # a different board
+        return None
 
 
     def write(self, delay):
@@ -252,8 +397,9 @@ class PhaseShifter:
         self.ps_delay = delay // 5
         self.state = BitArray(uint=self.ps_delay, length=11)
 
-        ul.d_out(self.board_num, self.pA.type, self.state[3:].uint)
-        ul.d_out(self.board_num, self.pB.type, self.state[:3].uint)
+        self.ul.d_out(self.board_num, self.pA.type, self.state[3:].uint)
+        self.ul.d_out(self.board_num, self.pB.type, self.state[:3].uint)
+        self._last_out = _port_values(self.state.uint)
         
 
     def flip_bit(self, n):
@@ -265,29 +411,52 @@ class PhaseShifter:
         else:
             self.state.set(1, n)
 
-        ul.d_out(self.board_num, self.pA.type, self.state[3:].uint)
-        ul.d_out(self.board_num, self.pB.type, self.state[:3].uint)
+        self.ul.d_out(self.board_num, self.pA.type, self.state[3:].uint)
+        self.ul.d_out(self.board_num, self.pB.type, self.state[:3].uint)
+        self._last_out = _port_values(self.state.uint)
 
         self.read()
         self.print()
 
     def write_state(self):
-        ul.d_out(self.board_num, self.pA.type, self.state[3:].uint)
-        ul.d_out(self.board_num, self.pB.type, self.state[:3].uint)
+        self.ul.d_out(self.board_num, self.pA.type, self.state[3:].uint)
+        self.ul.d_out(self.board_num, self.pB.type, self.state[:3].uint)
+        self._last_out = _port_values(self.state.uint)
 
     def set_delay(self, delay):
-        self.state.uint = (1 << 10) | delay
-        self.write_state()
-        self.state.uint = (0 << 10) | delay
-        self.write_state()
-        self.state.uint = (1 << 10) | delay
-        self.write_state()
+        """ Latches a 10-bit delay code with a high - low - high strobe on
+        bit 10. The port values come from DELAY_LUT. If the board accepts
+        d_out_array for ports A and B, each strobe phase is one call (3
+        instead of 6 USB transactions); otherwise port A, which does not
+        change during the strobe, is written once and skipped entirely if
+        it already holds the value (at most 4 transactions). """
+        seq = DELAY_LUT[delay]
+        if self._out_array is not False:
+            try:
+                data = (ctypes.c_ushort * 2)()
+                for a, b in seq:
+                    data[0], data[1] = a, b
+                    self.ul.d_out_array(self.board_num, self.pA.type,
+                                   self.pB.type, data)
+                self._out_array = True
+            except (self.ul.ULError, AttributeError):
+                if self._out_array: # worked before, so this is a real error
+                    raise
+                self._out_array = False
+        if not self._out_array:
+            a = seq[0][0]
+            if self._last_out is None or self._last_out[0] != a:
+                self.ul.d_out(self.board_num, self.pA.type, a)
+            for a, b in seq:
+                self.ul.d_out(self.board_num, self.pB.type, b)
+        self._last_out = seq[-1]
+        self.state = BitArray(uint=STROBE | delay, length=11)
 
 
 
     def read(self):
-        self.stA = BitArray(uint=ul.d_in(self.board_num, self.pA.type), length=8)
-        self.stB = BitArray(uint=ul.d_in(self.board_num, self.pB.type), length=3)
+        self.stA = BitArray(uint=self.ul.d_in(self.board_num, self.pA.type), length=8)
+        self.stB = BitArray(uint=self.ul.d_in(self.board_num, self.pB.type), length=3)
 
         self.state = self.stB + self.stA
 